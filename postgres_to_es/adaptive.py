@@ -0,0 +1,114 @@
+"""Размеры батчей, которые подстраиваются под задержку bulk запросов ElasticSearch и отказы кластера.
+
+Контроллер получает результат каждого bulk запроса: время ответа, количество документов, размер тела и были ли
+отказы 429 (переполнена очередь записи кластера). Пока запросы отвечают быстрее target_latency, чанк растёт; когда
+медленнее — уменьшается пропорционально превышению, а при отказе 429 — вдвое. Так размер чанка держится у
+наибольшего, с которым кластер отвечает за target_latency: больший чанк уже не ускоряет загрузку, а только
+увеличивает очередь кластера. Размер батча чтения из PostgreSQL меняется в той же пропорции, что и чанк.
+"""
+import threading
+
+from loguru import logger
+
+from postgres_to_es.metrics import BATCH_SIZE
+
+# Задержка внутри [LOW, HIGH] * target_latency считается целевой, и размеры не меняются.
+LOW_LATENCY_RATIO = 0.8
+HIGH_LATENCY_RATIO = 1.2
+# Рост чанка после быстрого запроса и уменьшение после отказа 429.
+INCREASE_FACTOR = 1.1
+REJECTION_FACTOR = 0.5
+# Сглаживание среднего размера документа.
+DOC_SIZE_SMOOTHING = 0.2
+
+
+class AdaptiveBatchSize:
+    """Текущие размеры чанка bulk запроса (в документах и байтах) и батча чтения из PostgreSQL.
+
+    Общий для всех producers, потому что нагрузку создают все они вместе. Потокобезопасен.
+
+    :param chunk_docs: Начальное количество документов в bulk запросе.
+    :param pg_batch_size: Начальный размер батча чтения из PostgreSQL.
+    :param target_latency: Целевое время ответа на bulk запрос в секундах.
+    :param max_chunk_docs: Наибольшее количество документов в bulk запросе.
+    :param max_chunk_bytes: Наибольший размер тела bulk запроса.
+    :param min_chunk_docs: Наименьшее количество документов в bulk запросе.
+    :param min_chunk_bytes: Наименьший размер тела bulk запроса.
+    """
+
+    def __init__(self, chunk_docs: int, pg_batch_size: int, target_latency: float = 1.0,
+                 max_chunk_docs: int = 10000, max_chunk_bytes: int = 10 * 1024 * 1024,
+                 min_chunk_docs: int = 10, min_chunk_bytes: int = 64 * 1024):
+        self.target_latency = target_latency
+        self.min_chunk_docs = min_chunk_docs
+        self.max_chunk_docs = max(max_chunk_docs, min_chunk_docs)
+        self.min_chunk_bytes = min_chunk_bytes
+        self.max_chunk_bytes = max(max_chunk_bytes, min_chunk_bytes)
+        # Батч чтения из PostgreSQL на столько больше чанка, во сколько раз он больше при запуске.
+        self._pg_ratio = pg_batch_size / chunk_docs
+        self._chunk_docs = float(min(max(chunk_docs, self.min_chunk_docs), self.max_chunk_docs))
+        self._chunk_bytes = float(self.max_chunk_bytes)
+        self.doc_bytes = 0.0
+        self._lock = threading.Lock()
+        self._report()
+
+    @property
+    def chunk_docs(self) -> int:
+        return int(self._chunk_docs)
+
+    @property
+    def chunk_bytes(self) -> int:
+        return int(self._chunk_bytes)
+
+    @property
+    def pg_batch_size(self) -> int:
+        return max(int(self._chunk_docs * self._pg_ratio), 1)
+
+    def observe(self, seconds: float, docs: int, size: int, rejected: bool) -> None:
+        """Учитывает результат bulk запроса.
+
+        :param seconds: Время ответа.
+        :param docs: Количество операций в запросе.
+        :param size: Размер тела запроса в байтах.
+        :param rejected: Кластер отклонил запрос или часть его операций с кодом 429.
+        """
+        with self._lock:
+            if docs:
+                doc_bytes = size / docs
+                self.doc_bytes = (doc_bytes if not self.doc_bytes
+                                  else self.doc_bytes + DOC_SIZE_SMOOTHING * (doc_bytes - self.doc_bytes))
+            if rejected:
+                factor = REJECTION_FACTOR
+            elif seconds > self.target_latency * HIGH_LATENCY_RATIO:
+                factor = max(self.target_latency / seconds, REJECTION_FACTOR)
+            elif seconds < self.target_latency * LOW_LATENCY_RATIO and self._is_full(docs, size):
+                factor = INCREASE_FACTOR
+            else:
+                return
+            self._resize(factor)
+            if factor < 1:
+                logger.info("Bulk request took {:.2f}s{}, reducing chunk to {} documents / {} bytes, PostgreSQL "
+                            "batch to {}", seconds, ' and was rejected' if rejected else '', self.chunk_docs,
+                            self.chunk_bytes, self.pg_batch_size)
+            else:
+                logger.debug("Bulk request took {:.2f}s, growing chunk to {} documents / {} bytes, PostgreSQL batch "
+                             "to {}", seconds, self.chunk_docs, self.chunk_bytes, self.pg_batch_size)
+            self._report()
+
+    def _is_full(self, docs: int, size: int) -> bool:
+        """Был ли чанк полным: по короткому хвосту батча нельзя судить, как быстро обработается полный чанк."""
+        return docs >= self.chunk_docs * LOW_LATENCY_RATIO or size >= self.chunk_bytes * LOW_LATENCY_RATIO
+
+    def _resize(self, factor: float) -> None:
+        self._chunk_bytes = min(max(self._chunk_bytes * factor, self.min_chunk_bytes), self.max_chunk_bytes)
+        max_docs = self.max_chunk_docs
+        if self.doc_bytes:
+            # Чанк из документов среднего размера должен помещаться в лимит байт.
+            max_docs = min(max_docs, max(int(self._chunk_bytes / self.doc_bytes), self.min_chunk_docs))
+        self._chunk_docs = min(max(self._chunk_docs * factor, self.min_chunk_docs), max_docs)
+
+    def _report(self) -> None:
+        BATCH_SIZE.labels('es_chunk_docs').set(self.chunk_docs)
+        BATCH_SIZE.labels('es_chunk_bytes').set(self.chunk_bytes)
+        BATCH_SIZE.labels('pg_batch').set(self.pg_batch_size)
+        BATCH_SIZE.labels('doc_bytes').set(self.doc_bytes)
@@ -0,0 +1,244 @@
+"""Асинхронный движок ETL: этапы конвейера работают параллельно и связаны ограниченными очередями.
+
+Пока ElasticSearch индексирует один батч, PostgreSQL уже отдаёт следующий. Размер очередей ограничивает количество
+батчей в работе: если загрузка отстаёт, чтение из PostgreSQL ждёт (backpressure). Каждый батч несёт исходные строки
+producer, и состояние сохраняется только после загрузки батча в ElasticSearch, в том же порядке, в каком батчи
+были прочитаны.
+"""
+import asyncio
+import json
+import uuid
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Sequence
+
+import asyncpg
+from elasticsearch import AsyncElasticsearch
+from elasticsearch.helpers import async_bulk
+from loguru import logger
+
+from postgres_to_es.daemon import (ETLProcessConfig, get_checkpoint, save_checkpoint, table_ids_by_join_query,
+                                   updated_entries_query)
+from postgres_to_es.elastic import (ELASTIC_ERRORS, BulkSettings, Document, IndexAliases, RawDocument, document_id,
+                                    generate_multi_index_actions, index_action, is_request_error, item_retry_delay,
+                                    rejected_for_retry)
+from postgres_to_es.metrics import ROWS_FETCHED, STAGE_SECONDS
+from postgres_to_es.retry import async_retry
+
+
+@dataclass
+class Batch:
+    """Батч данных между этапами конвейера.
+
+    :param payload: Данные этапа: строки таблицы, id, денормализованные записи или документы.
+    :param source_rows: Исходные строки producer, по которым сохраняется состояние после загрузки батча.
+    """
+    payload: list
+    source_rows: List[dict]
+
+
+async def create_postgres_pool(dsn: str, max_connections: int = 4) -> asyncpg.Pool:
+    """Пул соединений asyncpg, который декодирует jsonb так же, как psycopg2."""
+
+    async def init(connection):
+        await connection.set_type_codec('jsonb', encoder=json.dumps, decoder=json.loads, schema='pg_catalog')
+
+    return await asyncpg.create_pool(dsn, min_size=1, max_size=max_connections, init=init)
+
+
+@async_retry('elastic', exceptions=ELASTIC_ERRORS, giveup=is_request_error)
+async def async_bulk_index(es: AsyncElasticsearch, index: str, docs: List[Document], settings: BulkSettings,
+                           aliases: Optional[IndexAliases] = None) -> int:
+    """Асинхронный аналог bulk_index: индексирует документы и возвращает количество записанных.
+
+    Документы, отклонённые временно (429, 5xx), отправляются повторно, а отклонённые с кодом 400 записываются в
+    settings.dead_letters, так же как в bulk_index.
+    """
+    indices = aliases.write_targets(index) if aliases else [index]
+    actions = list(generate_multi_index_actions(indices, docs))
+    docs_by_id: Dict[str, Document] = {}
+    count = 0
+    attempts = 0
+    while True:
+        indexed, failed = await async_bulk(es, actions, raise_on_error=False, **settings.chunk_args())
+        count += indexed
+        if not failed:
+            return count
+
+        if not docs_by_id:
+            docs_by_id = {document_id(doc): doc for doc in docs}
+        retry_queue = rejected_for_retry(index, failed, docs_by_id, settings)
+        if not retry_queue:
+            return count
+
+        attempts += 1
+        await asyncio.sleep(item_retry_delay(index, retry_queue, attempts, failed))
+        actions = [index_action(target, docs_by_id[doc_id]) for target, doc_id in retry_queue]
+
+
+class AsyncETLPipeline:
+    """Асинхронный конвейер для одного ETL процесса: extract → ids → denormalize → transform → load."""
+
+    def __init__(self, process: ETLProcessConfig, postgres: asyncpg.Pool, elastic: AsyncElasticsearch,
+                 queue_size: int = 2):
+        self.process = process
+        self.postgres = postgres
+        self.elastic = elastic
+        self.queue_size = queue_size
+
+    async def extract(self, outgoing: asyncio.Queue) -> None:
+        """Читает все записи таблицы после сохраненного состояния постранично (keyset)."""
+        process = self.process
+        updated_at, last_id = await asyncio.to_thread(get_checkpoint, process.state, process.table,
+                                                      process.elastic_index)
+        query = updated_entries_query(process.table, process.timestamp_field).template
+        batch_size = process.pg_batch_size
+        while True:
+            with STAGE_SECONDS.labels('fetch', process.table).time():
+                rows = [dict(record) for record in await self.postgres.fetch(query, updated_at, last_id, batch_size)]
+            ROWS_FETCHED.labels(process.table, process.elastic_index).inc(len(rows))
+            if not rows:
+                break
+            logger.info("Fetched {} updated rows from table {}", len(rows), process.table)
+            await outgoing.put(Batch(rows, rows))
+            updated_at, last_id = rows[-1][process.timestamp_field], rows[-1]['id']
+            if len(rows) < batch_size:
+                break
+        await outgoing.put(None)
+
+    async def extract_ids(self, incoming: asyncio.Queue, outgoing: asyncio.Queue) -> None:
+        """Получает из строк таблицы id документов индекса так же, как film_id_function процесса."""
+        process = self.process
+        join_query = None
+        if process.film_id_function.__name__ == 'get_table_ids_by_join':
+            join_query = table_ids_by_join_query(*process.get_film_id_args[1:]).template
+        batch_size = process.pg_batch_size
+        while (batch := await incoming.get()) is not None:
+            if join_query:
+                records = await self.postgres.fetch(join_query, [row['id'] for row in batch.payload],
+                                                   uuid.UUID(int=0))
+                ids = [record['id'] for record in records]
+            else:
+                id_field = process.get_film_id_args[0]
+                ids = [row[id_field] for row in batch.payload]
+            # Id популярного жанра или персоны отправляются дальше несколькими батчами; состояние сохраняется после
+            # последнего из них.
+            for start in range(0, len(ids) - batch_size, batch_size):
+                await outgoing.put(Batch(ids[start:start + batch_size], []))
+            last_start = max(len(ids) - 1, 0) // batch_size * batch_size
+            await outgoing.put(Batch(ids[last_start:], batch.source_rows))
+        await outgoing.put(None)
+
+    async def denormalize(self, incoming: asyncio.Queue, outgoing: asyncio.Queue) -> None:
+        """Денормализует id; в режиме documents_in_postgres сразу получает готовые JSON документы."""
+        documents_in_postgres = self.process.documents_in_postgres
+        query = (self.process.documents_query if documents_in_postgres else self.process.denormalize_query).template
+        while (batch := await incoming.get()) is not None:
+            rows = []
+            if batch.payload:
+                with STAGE_SECONDS.labels('denormalize', self.process.elastic_index).time():
+                    records = await self.postgres.fetch(query, batch.payload)
+                if documents_in_postgres:
+                    rows = [RawDocument(record['id'], record['doc']) for record in records]
+                else:
+                    rows = [dict(record) for record in records]
+                logger.debug("Extracted {} rows from database", len(rows))
+            await outgoing.put(Batch(rows, batch.source_rows))
+        await outgoing.put(None)
+
+    async def transform(self, incoming: asyncio.Queue, outgoing: asyncio.Queue) -> None:
+        loop = asyncio.get_running_loop()
+        while (batch := await incoming.get()) is not None:
+            if self.process.documents_in_postgres:
+                await outgoing.put(batch)
+                continue
+            with STAGE_SECONDS.labels('transform', self.process.elastic_index).time():
+                docs = await loop.run_in_executor(self.process.transform_executor, self.process.document_builder(),
+                                                  batch.payload)
+            await outgoing.put(Batch(docs, batch.source_rows))
+        await outgoing.put(None)
+
+    async def load(self, incoming: asyncio.Queue) -> int:
+        """Загружает документы в ElasticSearch и сохраняет состояние producer после каждого батча."""
+        process = self.process
+        es_batch_size = process.es_batch_size
+        processed = 0
+        while (batch := await incoming.get()) is not None:
+            docs_to_load, fingerprints = batch.payload, None
+            if process.fingerprints is not None:
+                docs_to_load, fingerprints = await asyncio.to_thread(process.fingerprints.changed,
+                                                                     process.elastic_index, batch.payload)
+            for start in range(0, len(docs_to_load), es_batch_size):
+                docs = docs_to_load[start:start + es_batch_size]
+                with STAGE_SECONDS.labels('load', process.elastic_index).time():
+                    count = await async_bulk_index(self.elastic, process.elastic_index, docs, process.bulk_settings,
+                                                   process.index_aliases)
+                logger.info("Updated {} documents in Elastic", count)
+            dead_letters = process.bulk_settings.dead_letters
+            if fingerprints and dead_letters is not None:
+                for doc_id in dead_letters.take_failed(process.elastic_index, fingerprints):
+                    del fingerprints[doc_id]
+            if fingerprints:
+                await asyncio.to_thread(process.fingerprints.save, process.elastic_index, fingerprints)
+            if batch.source_rows:
+                await asyncio.to_thread(save_checkpoint, process.state, process.table, process.elastic_index,
+                                        batch.source_rows, process.timestamp_field)
+            processed += len(batch.source_rows)
+        return processed
+
+    async def run(self) -> int:
+        """Прогоняет через конвейер все изменения таблицы и возвращает количество обработанных строк."""
+        queues = [asyncio.Queue(maxsize=self.queue_size) for _ in range(4)]
+        tasks = [
+            asyncio.create_task(self.extract(queues[0])),
+            asyncio.create_task(self.extract_ids(queues[0], queues[1])),
+            asyncio.create_task(self.denormalize(queues[1], queues[2])),
+            asyncio.create_task(self.transform(queues[2], queues[3])),
+            asyncio.create_task(self.load(queues[3])),
+        ]
+        try:
+            results = await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            raise
+        return results[-1]
+
+
+async def run_pipeline_forever(pipeline: AsyncETLPipeline, poll_period: float) -> None:
+    """Цикл одного конвейера, независимый от конвейеров других таблиц.
+
+    Пока конвейер находит изменения, следующий проход начинается сразу, иначе через poll_period. Ошибка прохода
+    пишется в лог, и проход повторяется через poll_period с сохраненного состояния.
+    """
+    while True:
+        try:
+            processed = await pipeline.run()
+        except Exception:
+            logger.opt(exception=True).error("Async ETL pipeline for table {} failed.", pipeline.process.table)
+            processed = 0
+        if not processed:
+            await asyncio.sleep(poll_period)
+
+
+async def run_async(etl_processes: Sequence[ETLProcessConfig], postgres_url: str, elastic_host: str,
+                    poll_period: float, pg_pool_size: int = 4, es_max_connections: int = 10,
+                    queue_size: int = 2, once: bool = False) -> Optional[int]:
+    """Цикл асинхронного движка: процессы всех таблиц работают одновременно и независимо друг от друга.
+
+    :param once: Выполнить по одному проходу каждого конвейера и вернуть количество обработанных строк. Ошибка
+        одного конвейера не прерывает остальные и пробрасывается после их завершения.
+    """
+    postgres = await create_postgres_pool(postgres_url, pg_pool_size)
+    elastic = AsyncElasticsearch(hosts=elastic_host, maxsize=es_max_connections)
+    pipelines = [AsyncETLPipeline(process, postgres, elastic, queue_size) for process in etl_processes]
+    try:
+        if once:
+            results = await asyncio.gather(*(pipeline.run() for pipeline in pipelines), return_exceptions=True)
+            errors = [result for result in results if isinstance(result, BaseException)]
+            if errors:
+                raise errors[0]
+            return sum(results)
+        await asyncio.gather(*(run_pipeline_forever(pipeline, poll_period) for pipeline in pipelines))
+    finally:
+        await elastic.close()
+        await postgres.close()
@@ -0,0 +1,336 @@
+import json
+import multiprocessing
+import os
+import time
+import uuid
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import replace
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+from elasticsearch import Elasticsearch
+from loguru import logger
+
+from postgres_to_es.elastic import (IndexAliases, create_index_for_bulk_load, finish_bulk_load, resume_bulk_load,
+                                    warm_up_index)
+from postgres_to_es.metrics import BACKFILL_PROGRESS
+from postgres_to_es.postgres import PostgresClient, PreparedQuery
+from postgres_to_es.state import RedisState, State, set_checkpoint
+from postgres_to_es.utils import datetime_to_iso_string
+
+# Таблица, id которой являются id документов индекса.
+BACKFILL_SOURCES: Dict[str, str] = {
+    'movies': 'public.film_work',
+    'persons': 'public.person',
+    'genres': 'public.genre',
+}
+
+# Запас времени при передаче индекса инкрементальным процессам на случай транзакций, начатых до загрузки.
+HANDOFF_MARGIN = timedelta(minutes=1)
+
+DATABASE_NOW_QUERY = PreparedQuery(prefix='database_now', template='SELECT now() AS now', params=())
+
+# Сколько раз запускается загрузка диапазона ключей, прежде чем параллельная загрузка индекса считается неудачной.
+MAX_RANGE_ATTEMPTS = 3
+# Как часто параллельная загрузка пишет в лог общий прогресс, в секундах.
+PROGRESS_INTERVAL = 30
+
+
+class KeyRange(NamedTuple):
+    """Диапазон id (start, end] таблицы: часть пространства UUID, которую загружает один процесс.
+
+    :param number: Номер диапазона, начиная с нуля.
+    :param count: Количество диапазонов, на которые разделено пространство UUID.
+    """
+    number: int
+    count: int
+    start: str
+    end: str
+
+    @property
+    def name(self) -> str:
+        return f'{self.number + 1}-of-{self.count}'
+
+    def covered(self, last_id: str) -> float:
+        """Доля диапазона до last_id включительно."""
+        start = uuid.UUID(self.start).int
+        return (uuid.UUID(last_id).int - start) / (uuid.UUID(self.end).int - start)
+
+
+def split_key_space(count: int) -> List[KeyRange]:
+    """Делит пространство UUID на count равных диапазонов.
+
+    id таблиц — случайные UUID4, поэтому строки распределяются по диапазонам почти поровну.
+    """
+    bounds = [2 ** 128 * number // count for number in range(count)] + [2 ** 128 - 1]
+    return [KeyRange(number, count, str(uuid.UUID(int=bounds[number])), str(uuid.UUID(int=bounds[number + 1])))
+            for number in range(count)]
+
+
+# Все id таблицы.
+FULL_KEY_RANGE = split_key_space(1)[0]
+
+
+def keyset_ids_query(table: str) -> PreparedQuery:
+    """Подготовленный запрос для постраничного чтения id таблицы в диапазоне по возрастанию id."""
+    return PreparedQuery(
+        prefix='keyset_ids',
+        template=f"""
+            SELECT id
+            FROM {table}
+            WHERE id > $1 AND id <= $2
+            ORDER BY id
+            LIMIT $3
+        """,
+        params=(('last_id', 'uuid'), ('end_id', 'uuid'), ('batch_size', 'integer')),
+    )
+
+
+def load_index_schema(schemas_dir: str, index: str) -> dict:
+    """Читает схему индекса из файла <index>.es.schema.json."""
+    with open(os.path.join(schemas_dir, f'{index}.es.schema.json'), encoding='utf-8') as schema_file:
+        return json.load(schema_file)
+
+
+def stream_table_ids(postgres: PostgresClient, table: str, target, batch_size: int,
+                     key_range: KeyRange = FULL_KEY_RANGE,
+                     on_batch: Optional[Callable[[str, int], None]] = None) -> int:
+    """Отправляет в target все id таблицы из key_range батчами по batch_size, читая их постранично по ключу.
+
+    :param on_batch: Вызывается после обработки каждого батча с последним id и количеством отправленных id.
+    :return: Количество отправленных id.
+    """
+    query = keyset_ids_query(table)
+    last_id = key_range.start
+    sent = 0
+    while rows := postgres.query(query, {'last_id': last_id, 'end_id': key_range.end, 'batch_size': batch_size}):
+        ids = [row['id'] for row in rows]
+        target.send(ids)
+        sent += len(ids)
+        last_id = str(ids[-1])
+        if on_batch is not None:
+            on_batch(last_id, sent)
+        logger.info("Backfilled {} rows from {} (key range {})", sent, table, key_range.name)
+    return sent
+
+
+def range_progress_keys(index: str, key_range: KeyRange) -> Tuple[str, str]:
+    """Ключи состояния загрузки диапазона ключей в индекс: последний загруженный id и количество строк."""
+    prefix = f'backfill.{index}.{key_range.name}'
+    return f'{prefix}.last_id', f'{prefix}.rows'
+
+
+def get_range_progress(state: State, index: str, key_range: KeyRange) -> Tuple[str, int]:
+    """Последний загруженный id диапазона и количество загруженных строк."""
+    last_id_key, rows_key = range_progress_keys(index, key_range)
+    values = state.state_get_keys([last_id_key, rows_key])
+    return values[last_id_key] or key_range.start, int(values[rows_key] or 0)
+
+
+def set_range_progress(state: State, index: str, key_range: KeyRange, last_id: str, rows: int) -> None:
+    last_id_key, rows_key = range_progress_keys(index, key_range)
+    state.state_set_keys({last_id_key: last_id, rows_key: str(rows)})
+
+
+def fill_key_range(index: str, etl_processes: Sequence, postgres: PostgresClient, state: State, batch_size: int,
+                   key_range: KeyRange = FULL_KEY_RANGE) -> int:
+    """Заполняет версию индекса документами для id исходной таблицы алиаса из key_range, минуя алиас.
+
+    Прогресс сохраняется в State после каждого батча, и повторный вызов продолжает загрузку диапазона с места
+    остановки.
+
+    :param etl_processes: Процессы алиаса; первый из них используется для денормализации и загрузки документов.
+    :return: Количество загруженных id диапазона, включая загруженные предыдущими вызовами.
+    """
+    alias = etl_processes[0].elastic_index
+    loader = replace(etl_processes[0], elastic_index=index, index_aliases=None)
+    last_id, loaded = get_range_progress(state, index, key_range)
+    if last_id == key_range.end:
+        return loaded
+    if loaded:
+        logger.info("Resuming backfill of {} key range {} after {} rows", index, key_range.name, loaded)
+
+    count = stream_table_ids(
+        postgres, BACKFILL_SOURCES[alias], loader.denormalize_pipeline(), batch_size, key_range._replace(start=last_id),
+        lambda batch_last_id, sent: set_range_progress(state, index, key_range, batch_last_id, loaded + sent),
+    )
+    set_range_progress(state, index, key_range, key_range.end, loaded + count)
+    return loaded + count
+
+
+def log_backfill_progress(state: State, index: str, key_ranges: Sequence[KeyRange], started: float) -> None:
+    """Пишет в лог и в метрики общий прогресс загрузки индекса по сохранённому прогрессу диапазонов."""
+    keys = [key for key_range in key_ranges for key in range_progress_keys(index, key_range)]
+    if isinstance(state, RedisState):
+        # Прогресс пишут процессы загрузки, локальная копия состояния его не видит.
+        state.preload(keys)
+    progress = [get_range_progress(state, index, key_range) for key_range in key_ranges]
+    covered = sum(key_range.covered(last_id) for key_range, (last_id, _) in zip(key_ranges, progress)) / len(key_ranges)
+    rows = sum(loaded for _, loaded in progress)
+    elapsed = time.monotonic() - started
+    BACKFILL_PROGRESS.labels(index).set(covered)
+    logger.info("Backfill of {}: {:.1%} of key space, {} rows, {:.0f} rows/s", index, covered, rows,
+                rows / elapsed if elapsed else 0)
+
+
+def fill_index_version_parallel(alias: str, index: str, state: State, workers: int,
+                                range_worker: Callable[[str, str, KeyRange], int],
+                                progress_interval: float = PROGRESS_INTERVAL) -> int:
+    """Заполняет версию индекса в workers процессах, каждый из которых загружает свой диапазон ключей.
+
+    :param range_worker: Функция (alias, index, key_range), которая создаёт в процессе загрузки свои соединения и
+        вызывает fill_key_range. Она запускается в новом процессе, поэтому должна передаваться через pickle.
+    :return: Количество загруженных id.
+    """
+    key_ranges = split_key_space(workers)
+    started = time.monotonic()
+    attempts = Counter()
+    total = 0
+    with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+        futures = {executor.submit(range_worker, alias, index, key_range): key_range for key_range in key_ranges}
+        while futures:
+            done, _ = wait(futures, timeout=progress_interval, return_when=FIRST_COMPLETED)
+            for future in done:
+                key_range = futures.pop(future)
+                try:
+                    total += future.result()
+                except BrokenProcessPool:
+                    # Процесс загрузки упал целиком, пул больше не принимает задачи.
+                    raise
+                except Exception:
+                    attempts[key_range] += 1
+                    if attempts[key_range] >= MAX_RANGE_ATTEMPTS:
+                        raise
+                    logger.opt(exception=True).error("Backfill of {} key range {} failed, resuming it", index,
+                                                     key_range.name)
+                    futures[executor.submit(range_worker, alias, index, key_range)] = key_range
+            log_backfill_progress(state, index, key_ranges, started)
+    return total
+
+
+# Запросы для прогрева новой версии индекса перед переключением алиаса.
+WARM_UP_QUERIES = [
+    {'query': {'match_all': {}}, 'size': 50},
+    {'query': {'match_all': {}}, 'size': 50, 'sort': [{'id': 'asc'}]},
+    {'query': {'multi_match': {'query': 'star', 'fuzziness': 'auto', 'fields': ['*']}}, 'size': 50},
+]
+
+
+def fill_index_version(index: str, etl_processes: Sequence, postgres: PostgresClient, state: State, batch_size: int,
+                       workers: int = 1, range_worker: Optional[Callable[[str, str, KeyRange], int]] = None) -> int:
+    """Заполняет версию индекса документами для всех id исходной таблицы алиаса, минуя алиас.
+
+    :param etl_processes: Процессы алиаса; первый из них используется для денормализации и загрузки документов.
+    :param workers: Количество процессов загрузки; если больше одного, загрузка идёт через range_worker.
+    :return: Количество загруженных id.
+    """
+    alias = etl_processes[0].elastic_index
+    if workers > 1 and range_worker is not None:
+        count = fill_index_version_parallel(alias, index, state, workers, range_worker)
+    else:
+        count = fill_key_range(index, etl_processes, postgres, state, batch_size)
+    logger.info("Filled index {}: {} documents", index, count)
+    return count
+
+
+def database_now(postgres: PostgresClient, margin: timedelta) -> datetime:
+    """Текущее время PostgreSQL за вычетом margin."""
+    return postgres.query(DATABASE_NOW_QUERY, {})[0]['now'] - margin
+
+
+def build_started_key(index: str) -> str:
+    """Ключ состояния с временем начала загрузки версии индекса; пустая строка — версия загружена и переключена."""
+    return f'backfill.{index}.started_at'
+
+
+def start_index_version(alias: str, postgres: PostgresClient, elastic: Elasticsearch, state: State,
+                        aliases: IndexAliases, schemas_dir: str,
+                        handoff_margin: timedelta) -> Tuple[str, datetime, dict]:
+    """Создаёт новую версию индекса алиаса для загрузки или продолжает построение, прерванное падением демона.
+
+    Версия новее версий за алиасом, для которой в State сохранено время начала загрузки, продолжает загружаться с
+    сохранённого прогресса диапазонов ключей, и изменения перечитываются с исходного времени начала. Такая версия без
+    сохранённого времени создана, но загрузка в неё не начиналась, и она пересоздаётся под тем же именем.
+
+    :return: Имя версии, время начала загрузки и настройки, которые нужно вернуть индексу после загрузки.
+    """
+    schema = load_index_schema(schemas_dir, alias)
+    index = aliases.unfinished_version(alias)
+    started_at = state.state_get_key(build_started_key(index)) if index is not None else None
+    if started_at:
+        logger.info("Resuming interrupted build of {} started at {}", index, started_at)
+        return index, datetime.fromisoformat(started_at), resume_bulk_load(elastic, index, schema)
+
+    if index is None or started_at == '':
+        # Незавершённой версии нет, или она уже была переключена, а затем алиас вернули на предыдущую.
+        index = aliases.next_version(alias)
+    started = database_now(postgres, handoff_margin)
+    restore_settings = create_index_for_bulk_load(elastic, index, schema)
+    state.state_set_key(build_started_key(index), datetime_to_iso_string(started))
+    return index, started, restore_settings
+
+
+def full_reindex(alias: str, etl_processes: Sequence, postgres: PostgresClient, elastic: Elasticsearch,
+                 state: State, aliases: IndexAliases, schemas_dir: str, batch_size: int,
+                 handoff_margin: timedelta = HANDOFF_MARGIN, workers: int = 1,
+                 range_worker: Optional[Callable[[str, str, KeyRange], int]] = None) -> None:
+    """Строит индекс с нуля до запуска инкрементальных процессов и передаёт его им.
+
+    Новая версия индекса заполняется с настройками для быстрой загрузки, после чего на неё переключается алиас.
+    Загрузка, прерванная падением демона, продолжается при следующем запуске (start_index_version).
+    Состояние всех процессов алиаса переводится на момент начала загрузки (с запасом handoff_margin), поэтому
+    изменения, сделанные во время загрузки, будут обработаны в инкрементальном режиме.
+
+    :param workers: Количество процессов, между которыми делится пространство ключей таблицы (fill_index_version).
+    """
+    index, started_at, restore_settings = start_index_version(alias, postgres, elastic, state, aliases, schemas_dir,
+                                                              handoff_margin)
+    logger.info("Starting full reindex of {} into {}", alias, index)
+
+    fill_index_version(index, etl_processes, postgres, state, batch_size, workers, range_worker)
+    finish_bulk_load(elastic, index, restore_settings)
+    aliases.swap(alias, index)
+    hand_off_to_incremental(alias, etl_processes, state, started_at)
+    state.state_set_key(build_started_key(index), '')
+
+
+def blue_green_reindex(alias: str, etl_processes: Sequence, postgres: PostgresClient, elastic: Elasticsearch,
+                       state: State, aliases: IndexAliases, schemas_dir: str, batch_size: int,
+                       handoff_margin: timedelta = HANDOFF_MARGIN, workers: int = 1,
+                       range_worker: Optional[Callable[[str, str, KeyRange], int]] = None) -> None:
+    """Строит новую версию индекса параллельно с работающими инкрементальными процессами и переключает на неё алиас.
+
+    Пока версия строится, инкрементальные процессы пишут и в алиас, и в новую версию. Загрузка могла записать
+    документ, прочитанный раньше его изменения, поверх более нового, поэтому после неё изменения с момента начала
+    загрузки перечитываются в новую версию отдельными процессами со своим состоянием. Затем индексу возвращаются рабочие
+    настройки, он прогревается запросами и алиас атомарно переключается; старая версия остаётся для отката.
+    """
+    index, started_at, restore_settings = start_index_version(alias, postgres, elastic, state, aliases, schemas_dir,
+                                                              handoff_margin)
+    logger.info("Starting blue/green reindex of {} into {}", alias, index)
+    aliases.begin_dual_write(alias, index)
+    try:
+        fill_index_version(index, etl_processes, postgres, state, batch_size, workers, range_worker)
+        finish_bulk_load(elastic, index, restore_settings)
+
+        catch_up_processes = [replace(process, elastic_index=index, index_aliases=None, catch_up=True)
+                              for process in etl_processes]
+        hand_off_to_incremental(index, catch_up_processes, state, started_at)
+        for process in catch_up_processes:
+            process.run()
+
+        warm_up_index(elastic, index, WARM_UP_QUERIES)
+        aliases.swap(alias, index)
+        state.state_set_key(build_started_key(index), '')
+    finally:
+        aliases.end_dual_write(alias)
+    logger.info("Blue/green reindex of {} finished", alias)
+
+
+def hand_off_to_incremental(index: str, etl_processes: Sequence, state: State, started_at: datetime) -> None:
+    """Переводит состояние процессов индекса на момент started_at."""
+    for process in etl_processes:
+        set_checkpoint(state, process.table, index, datetime_to_iso_string(started_at), str(uuid.UUID(int=0)))
+    logger.info("Incremental processes of {} continue from {}", index, started_at)
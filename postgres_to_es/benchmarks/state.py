@@ -0,0 +1,70 @@
+"""Бенчмарк хранилищ состояния: сохранение и чтение состояния producers.
+
+Одна операция — цикл producer: чтение состояния (get_checkpoint) и запись нового (set_checkpoint). RedisState
+измеряется, только если Redis доступен.
+
+    python -m postgres_to_es.benchmarks.state --count 2000 --redis-host localhost
+"""
+import argparse
+import os
+import tempfile
+import time
+import uuid
+from datetime import datetime, timezone
+
+from redis import Redis
+from redis.exceptions import ConnectionError as RedisConnectionError
+
+from postgres_to_es.state import (DBMState, RedisState, SQLiteState, State, checkpoint_keys, get_checkpoint,
+                                  set_checkpoint)
+from postgres_to_es.utils import datetime_to_iso_string
+
+# Индекс в ключах состояния, чтобы не задеть состояние настоящих producers в Redis.
+BENCHMARK_INDEX = 'state_benchmark'
+TABLES = ('public.film_work', 'public.person', 'public.genre', 'public.person_film_work', 'public.genre_film_work')
+
+
+def checkpoints_per_second(state: State, count: int) -> float:
+    started = time.perf_counter()
+    for i in range(count):
+        table = TABLES[i % len(TABLES)]
+        get_checkpoint(state, table, BENCHMARK_INDEX)
+        set_checkpoint(state, table, BENCHMARK_INDEX, datetime_to_iso_string(datetime.now(tz=timezone.utc)),
+                       str(uuid.uuid4()))
+    return count / (time.perf_counter() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк хранилищ состояния.")
+    parser.add_argument("--count", default=2000, type=int, help="Количество циклов чтения и записи состояния.")
+    parser.add_argument("--redis-host", dest="redis_host", default='localhost', help="Хост Redis.")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        # DBMState всегда пишет в файл state в текущем каталоге.
+        os.chdir(directory)
+        backends = [
+            ('dbm', lambda: DBMState()),
+            ('sqlite full', lambda: SQLiteState('full.sqlite3', durability='full')),
+            ('sqlite normal', lambda: SQLiteState('normal.sqlite3', durability='normal')),
+            ('sqlite group 1s', lambda: SQLiteState('group.sqlite3', durability='full', group_commit_interval=1.0)),
+        ]
+        redis = Redis(host=args.redis_host)
+        try:
+            redis.ping()
+            backends.append(('redis', lambda: RedisState(redis)))
+        except RedisConnectionError:
+            print(f"Redis at {args.redis_host} is not available, skipping RedisState.")
+
+        print(f"{'backend':<18}{'checkpoints/s':>16}")
+        for name, create_state in backends:
+            state = create_state()
+            print(f"{name:<18}{checkpoints_per_second(state, args.count):>16,.0f}")
+            if isinstance(state, SQLiteState):
+                state.close()
+        if any(name == 'redis' for name, _ in backends):
+            redis.delete(*(key for table in TABLES for key in checkpoint_keys(table, BENCHMARK_INDEX)))
+
+
+if __name__ == '__main__':
+    main()
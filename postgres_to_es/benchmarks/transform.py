@@ -0,0 +1,175 @@
+"""Микро-бенчмарк преобразования денормализованных записей в документы ElasticSearch.
+
+Сравнивает скорость (документов в секунду) исходного преобразования (отдельный проход по персонам для каждого поля
+и проверка каждого документа pydantic моделью), текущего преобразования с проверкой (--validate-documents) и
+текущего быстрого преобразования на синтетических записях в формате денормализующих запросов. Ускорение считается
+относительно исходного преобразования.
+
+    python -m postgres_to_es.benchmarks.transform --count 20000
+"""
+import argparse
+import copy
+import random
+import time
+import uuid
+from typing import Callable, List
+
+from postgres_to_es.daemon import (GenreElastic, MovieElastic, PersonElastic, build_genre_documents,
+                                   build_movie_documents, build_person_documents)
+
+ROLES = ('actor', 'writer', 'director')
+
+
+def fake_film_works(count: int, persons_per_film: int = 15, genres_per_film: int = 3) -> List[dict]:
+    return [
+        {
+            'id': uuid.uuid4(),
+            'title': f'Film {i}',
+            'description': 'Description ' * 20,
+            'rating': round(random.uniform(1, 10), 1),
+            'persons': [{'id': str(uuid.uuid4()), 'full_name': f'Person {j}', 'role': random.choice(ROLES)}
+                        for j in range(persons_per_film)],
+            'genres': [{'id': str(uuid.uuid4()), 'name': f'Genre {j}'} for j in range(genres_per_film)],
+        }
+        for i in range(count)
+    ]
+
+
+def fake_persons(count: int, films_per_person: int = 10) -> List[dict]:
+    return [
+        {
+            'id': uuid.uuid4(),
+            'full_name': f'Person {i}',
+            'films': [{'id': str(uuid.uuid4()), 'role': random.choice(ROLES)} for _ in range(films_per_person)],
+        }
+        for i in range(count)
+    ]
+
+
+def fake_genres(count: int, films_per_genre: int = 50) -> List[dict]:
+    return [
+        {
+            'id': uuid.uuid4(),
+            'name': f'Genre {i}',
+            'filmworks': [{'id': str(uuid.uuid4()), 'title': f'Film {j}', 'imdb_rating': 7.5}
+                          for j in range(films_per_genre)],
+        }
+        for i in range(count)
+    ]
+
+
+# Исходное преобразование до однопроходной сборки документов, без изменений. Оно дополняет входные записи пустыми
+# списками и собирает film_ids и roles персон прямо в записи, поэтому каждый запуск получает свою копию записей.
+
+
+def baseline_movie_documents(film_works: List[dict]) -> List[dict]:
+    batch = []
+    for film_work in film_works:
+        if not film_work['genres']:
+            film_work['genres'] = []
+        if not film_work['persons']:
+            film_work['persons'] = []
+        actors = [{'id': person['id'], 'name': person['full_name']}
+                  for person in film_work['persons']
+                  if person['role'] == 'actor']
+        writers = [{'id': person['id'], 'name': person['full_name']}
+                   for person in film_work['persons']
+                   if person['role'] == 'writer']
+        directors = [{'id': person['id'], 'name': person['full_name']}
+                     for person in film_work['persons']
+                     if person['role'] == 'director']
+
+        genres = [{'id': genre['id'], 'name': genre['name']}
+                  for genre in film_work['genres']]
+
+        directors_names = [person['full_name'] for person in film_work['persons'] if person['role'] == 'director']
+        actors_names = [person['full_name'] for person in film_work['persons'] if person['role'] == 'actor']
+        writers_names = [person['full_name'] for person in film_work['persons'] if person['role'] == 'writer']
+        genres_names = [genre['name'] for genre in film_work['genres']]
+
+        movie = MovieElastic(id=str(film_work['id']),
+                             imdb_rating=film_work['rating'],
+                             genres_names=genres_names,
+                             title=film_work['title'],
+                             description=film_work['description'],
+                             actors_names=actors_names,
+                             writers_names=writers_names,
+                             directors_names=directors_names,
+                             actors=actors,
+                             writers=writers,
+                             directors=directors,
+                             genres=genres)
+
+        batch.append(movie.dict())
+    return batch
+
+
+def baseline_person_documents(persons: List[dict]) -> List[dict]:
+    batch = []
+    for person in persons:
+        if not person.get('film_ids'):
+            person['film_ids'] = []
+        if not person.get('roles'):
+            person['roles'] = set()
+        for person_film in person['films'] or []:
+            person['film_ids'].append(person_film['id'])
+            person['roles'].add(person_film['role'])
+        person = PersonElastic(id=str(person['id']),
+                               full_name=person['full_name'],
+                               film_ids=person['film_ids'],
+                               roles=list(person['roles']))
+
+        batch.append(person.dict())
+    return batch
+
+
+def baseline_genre_documents(genres: List[dict]) -> List[dict]:
+    batch = []
+    for genre in genres:
+        if not genre['filmworks']:
+            genre['filmworks'] = []
+
+        filmworks = [{'id': filmwork['id'], 'title': filmwork['title'], 'imdb_rating': filmwork['imdb_rating']}
+                     for filmwork in genre['filmworks']]
+        genre = GenreElastic(id=str(genre['id']),
+                             name=genre['name'],
+                             filmworks=filmworks)
+
+        batch.append(genre.dict())
+    return batch
+
+
+def docs_per_second(build_documents: Callable[[List[dict]], List[dict]], records: List[dict], repeat: int) -> float:
+    """Лучший из repeat запусков на копиях records, документов в секунду. Копирование не входит в замер."""
+    best = float('inf')
+    for _ in range(repeat):
+        batch = copy.deepcopy(records)
+        started = time.perf_counter()
+        build_documents(batch)
+        best = min(best, time.perf_counter() - started)
+    return len(records) / best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк преобразования записей в документы ElasticSearch.")
+    parser.add_argument("--count", default=20000, type=int, help="Количество записей каждого индекса.")
+    parser.add_argument("--repeat", default=5, type=int, help="Количество повторов, берётся лучший.")
+    args = parser.parse_args()
+
+    cases = [
+        ('movies', baseline_movie_documents, build_movie_documents, fake_film_works(args.count)),
+        ('persons', baseline_person_documents, build_person_documents, fake_persons(args.count)),
+        ('genres', baseline_genre_documents, build_genre_documents, fake_genres(args.count)),
+    ]
+    print(f"{'index':<10}{'baseline, docs/s':>18}{'validated, docs/s':>20}{'fast, docs/s':>16}"
+          f"{'validated':>11}{'fast':>8}")
+    for index, baseline_documents, build_documents, records in cases:
+        baseline = docs_per_second(baseline_documents, records, args.repeat)
+        validated = docs_per_second(lambda batch: build_documents(batch, validate=True), records, args.repeat)
+        fast = docs_per_second(build_documents, records, args.repeat)
+        print(f"{index:<10}{baseline:>18,.0f}{validated:>20,.0f}{fast:>16,.0f}"
+              f"{validated / baseline:>10.1f}x{fast / baseline:>7.1f}x")
+
+
+if __name__ == '__main__':
+    main()
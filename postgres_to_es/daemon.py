@@ -1,27 +1,45 @@
 import sys
 import os
 import argparse
+import asyncio
+import math
+import threading
 import time
 import uuid
+from concurrent.futures import Executor, ProcessPoolExecutor
+from contextlib import nullcontext
 from dataclasses import dataclass
-from datetime import datetime, timezone
-from functools import wraps
-from typing import List, Optional, Dict, Any, Union, Callable, Sequence
+from datetime import timedelta
+from functools import partial, wraps
+from typing import List, Optional, Dict, Union, Callable, ClassVar, Sequence, Set, Tuple
 
 import psycopg2
-from elasticsearch import Elasticsearch, helpers
+from elasticsearch import Elasticsearch
 from psycopg2.extras import DictCursor
-from psycopg2 import sql
 from loguru import logger
 from pydantic import BaseModel
 from redis import Redis
 
-from postgres_to_es.state import State, RedisState
+from postgres_to_es.adaptive import AdaptiveBatchSize
+from postgres_to_es.backfill import BACKFILL_SOURCES, KeyRange, blue_green_reindex, fill_key_range, full_reindex
+from postgres_to_es.deadletter import DeadLetterFile
+from postgres_to_es.elastic import (BULK_MODES, BulkSettings, IndexAliases, RawDocument, bulk_delete, bulk_index,
+                                    create_elastic_client, put_rename_script, rename_references)
+from postgres_to_es.fingerprint import FingerprintStore
+from postgres_to_es.metrics import ROWS_FETCHED, STAGE_SECONDS, serve_metrics
+from postgres_to_es.notify import ChangeListener
+from postgres_to_es.postgres import CONNECTION_ERRORS, PostgresClient, PreparedQuery
+from postgres_to_es.replication import ReplicationSource, run_replication
+from postgres_to_es.scheduler import (CONNECTIONS_PER_PRODUCER, ProducerSchedule, ProducerScheduler,
+                                      connections_per_producer, parse_schedules)
+from postgres_to_es.state import (SQLITE_DURABILITY, State, RedisState, SQLiteState, checkpoint_keys, get_checkpoint,
+                                  set_checkpoint)
 
 logger.remove()
 logger.add(sys.stderr, level=os.environ.get("LOG_LEVEL", "INFO"))
 
-from postgres_to_es.utils import datetime_to_iso_string, backoff
+from postgres_to_es.retry import RetryPolicy, configure_retries, retry_stream
+from postgres_to_es.utils import datetime_to_iso_string
 
 
 def coroutine(func):
@@ -77,56 +95,310 @@ class GenreElastic(BaseModel):
     filmworks: List[Filmwork]
 
 
-@backoff()
-def query_postgresql(pg_url: str, template: Union[str, sql.Composable], params: Dict[str, Any]) -> List[dict]:
-    """Функция для запросов к postgresql."""
-    with psycopg2.connect(pg_url) as connection:
-        with connection.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cursor:
-            cursor.execute(template, params)
-            results = [dict(r) for r in cursor.fetchall()]
-    return results
+def updated_entries_query(table: str, timestamp_field: str = 'updated_at',
+                          columns: List[str] = None, limit: bool = True) -> PreparedQuery:
+    """Подготовленный запрос для поиска записей таблицы, обновленных после сохраненного состояния.
+
+    Без limit запрос возвращает весь накопившийся хвост изменений и используется для чтения серверным курсором.
+    """
+    column_names = ','.join(columns) if columns else '*'
+    params = (('timestamp', 'timestamptz'), ('last_id', 'uuid'))
+    if limit:
+        params += (('batch_size', 'integer'),)
+    return PreparedQuery(
+        prefix='updated_entries' if limit else 'updated_entries_stream',
+        template=f"""
+            select {column_names}, {timestamp_field}
+            from {table}
+            where ({timestamp_field} = $1 and id > $2)
+                  or {timestamp_field} > $1
+            order by {timestamp_field}, id
+            {'limit $3' if limit else ''}
+        """,
+        params=params,
+    )
+
+
+def table_ids_by_join_query(select_field: str, join_table: str, join_field: str) -> PreparedQuery:
+    """Подготовленный запрос для получения уникальных значений поля select_field таблицы join_table по списку id в
+    join_field.
+
+    Значения упорядочены, чтобы после ошибки чтение можно было продолжить после последнего полученного значения.
+    """
+    return PreparedQuery(
+        prefix='ids_by_join',
+        template=f"""
+            SELECT DISTINCT t.{select_field} as id
+            FROM {join_table} t
+            WHERE t.{join_field} = ANY($1) AND t.{select_field} > $2
+            ORDER BY id
+        """,
+        params=(('ids', 'uuid[]'), ('last_id', 'uuid')),
+    )
+
+
+DENORMALIZE_FILMS_QUERY = PreparedQuery(
+    prefix='denormalize_films',
+    template="""
+        SELECT 
+            fw.id AS id,
+            fw.title,
+            fw.description,
+            fw.rating,
+            fw.type,
+            fwp.persons,
+            fwg.genres
+        FROM "public".film_work fw
+        LEFT JOIN LATERAL ( 
+            SELECT 
+                pfw.film_work_id,
+                array_agg(jsonb_build_object(
+                    'id', p.id, 
+                    'full_name', p.full_name, 
+                    'role', pfw.role
+                ) ORDER BY p.full_name, p.id, pfw.role) AS persons
+            FROM "public".person_film_work pfw
+            JOIN "public".person p ON p.id = pfw.person_id
+            WHERE pfw.film_work_id = fw.id
+            GROUP BY 1 
+            ) fwp ON TRUE
+        LEFT JOIN LATERAL ( 
+            SELECT 
+                gfw.film_work_id,
+                array_agg(jsonb_build_object(
+                    'id', g.id, 
+                    'name', g.name
+                ) ORDER BY g.name, g.id) AS genres
+            FROM "public".genre_film_work gfw
+            JOIN "public".genre g ON g.id = gfw.genre_id
+            WHERE gfw.film_work_id = fw.id
+            GROUP BY 1
+            ) fwg ON TRUE
+        WHERE fw.id = ANY($1)
+    """,
+    params=(('film_ids', 'uuid[]'),),
+)
+
+DENORMALIZE_PERSONS_QUERY = PreparedQuery(
+    prefix='denormalize_persons',
+    template="""
+        SELECT p.id, p.full_name, fwp.films 
+        FROM person p 
+        LEFT JOIN LATERAL (
+            SELECT
+                array_agg(jsonb_build_object(
+                'id', pfw.film_work_id, 
+                'role', pfw.role) ORDER BY pfw.film_work_id, pfw.role) AS films
+            FROM person_film_work pfw 
+            WHERE pfw.person_id = p.id
+            ) fwp ON TRUE 
+        WHERE p.id = ANY($1)
+    """,
+    params=(('person_ids', 'uuid[]'),),
+)
+
+DENORMALIZE_GENRES_QUERY = PreparedQuery(
+    prefix='denormalize_genres',
+    template="""
+        SELECT g.id, g.name, fwg.filmworks
+        FROM "public".genre g
+        LEFT JOIN LATERAL ( 
+        SELECT 
+            array_agg(jsonb_build_object(
+                'id', fw.id, 
+                'title', fw.title,
+                'imdb_rating', fw.rating
+            ) ORDER BY fw.title, fw.id) AS filmworks
+        FROM "public".genre_film_work gfw
+        JOIN "public".film_work fw ON fw.id = gfw.film_work_id
+        WHERE gfw.genre_id = g.id
+        ) fwg ON TRUE
+        WHERE g.id = ANY($1)
+    """,
+    params=(('genre_ids', 'uuid[]'),),
+)
+
+
+# Запросы, которые собирают документы индексов в PostgreSQL и отдают их JSON текстом в колонке doc.
+MOVIE_DOCUMENTS_QUERY = PreparedQuery(
+    prefix='movie_documents',
+    template="""
+        SELECT
+            fw.id::text AS id,
+            json_build_object(
+                'id', fw.id,
+                'imdb_rating', fw.rating,
+                'title', fw.title,
+                'description', fw.description,
+                'actors_names', COALESCE(fwp.actors_names, '[]'),
+                'writers_names', COALESCE(fwp.writers_names, '[]'),
+                'directors_names', COALESCE(fwp.directors_names, '[]'),
+                'genres_names', COALESCE(fwg.genres_names, '[]'),
+                'actors', COALESCE(fwp.actors, '[]'),
+                'writers', COALESCE(fwp.writers, '[]'),
+                'directors', COALESCE(fwp.directors, '[]'),
+                'genres', COALESCE(fwg.genres, '[]')
+            )::text AS doc
+        FROM "public".film_work fw
+        LEFT JOIN LATERAL (
+            SELECT
+                json_agg(p.full_name ORDER BY p.full_name, p.id) FILTER (WHERE pfw.role = 'actor') AS actors_names,
+                json_agg(p.full_name ORDER BY p.full_name, p.id) FILTER (WHERE pfw.role = 'writer') AS writers_names,
+                json_agg(p.full_name ORDER BY p.full_name, p.id) FILTER (WHERE pfw.role = 'director')
+                    AS directors_names,
+                json_agg(json_build_object('id', p.id, 'name', p.full_name) ORDER BY p.full_name, p.id)
+                    FILTER (WHERE pfw.role = 'actor') AS actors,
+                json_agg(json_build_object('id', p.id, 'name', p.full_name) ORDER BY p.full_name, p.id)
+                    FILTER (WHERE pfw.role = 'writer') AS writers,
+                json_agg(json_build_object('id', p.id, 'name', p.full_name) ORDER BY p.full_name, p.id)
+                    FILTER (WHERE pfw.role = 'director') AS directors
+            FROM "public".person_film_work pfw
+            JOIN "public".person p ON p.id = pfw.person_id
+            WHERE pfw.film_work_id = fw.id
+            ) fwp ON TRUE
+        LEFT JOIN LATERAL (
+            SELECT
+                json_agg(g.name ORDER BY g.name, g.id) AS genres_names,
+                json_agg(json_build_object('id', g.id, 'name', g.name) ORDER BY g.name, g.id) AS genres
+            FROM "public".genre_film_work gfw
+            JOIN "public".genre g ON g.id = gfw.genre_id
+            WHERE gfw.film_work_id = fw.id
+            ) fwg ON TRUE
+        WHERE fw.id = ANY($1)
+    """,
+    params=(('ids', 'uuid[]'),),
+)
+
+PERSON_DOCUMENTS_QUERY = PreparedQuery(
+    prefix='person_documents',
+    template="""
+        SELECT
+            p.id::text AS id,
+            json_build_object(
+                'id', p.id,
+                'full_name', p.full_name,
+                'roles', COALESCE(fwp.roles, '[]'),
+                'film_ids', COALESCE(fwp.film_ids, '[]')
+            )::text AS doc
+        FROM "public".person p
+        LEFT JOIN LATERAL (
+            SELECT
+                json_agg(DISTINCT pfw.role ORDER BY pfw.role) AS roles,
+                json_agg(pfw.film_work_id ORDER BY pfw.film_work_id, pfw.role) AS film_ids
+            FROM "public".person_film_work pfw
+            WHERE pfw.person_id = p.id
+            ) fwp ON TRUE
+        WHERE p.id = ANY($1)
+    """,
+    params=(('ids', 'uuid[]'),),
+)
+
+GENRE_DOCUMENTS_QUERY = PreparedQuery(
+    prefix='genre_documents',
+    template="""
+        SELECT
+            g.id::text AS id,
+            json_build_object(
+                'id', g.id,
+                'name', g.name,
+                'filmworks', COALESCE(fwg.filmworks, '[]')
+            )::text AS doc
+        FROM "public".genre g
+        LEFT JOIN LATERAL (
+            SELECT
+                json_agg(json_build_object('id', fw.id, 'title', fw.title, 'imdb_rating', fw.rating)
+                         ORDER BY fw.title, fw.id) AS filmworks
+            FROM "public".genre_film_work gfw
+            JOIN "public".film_work fw ON fw.id = gfw.film_work_id
+            WHERE gfw.genre_id = g.id
+            ) fwg ON TRUE
+        WHERE g.id = ANY($1)
+    """,
+    params=(('ids', 'uuid[]'),),
+)
+
+
+def save_checkpoint(state: State, table: str, es_index: str, rows: List[dict], timestamp_field: str) -> None:
+    """Сохраняет в состояние producer время и id последней из обработанных записей."""
+    current_last_timestamp = datetime_to_iso_string(rows[-1][timestamp_field])
+    current_last_id = str(rows[-1]['id'])
+    set_checkpoint(state, table, es_index, current_last_timestamp, current_last_id)
+    logger.debug("Updated state with updated_at: {}, last_id: {}", current_last_timestamp, current_last_id)
+
+
+def fetch_updated_postgres_entries(table: str, postgres: PostgresClient, state: State, es_index: str,
+                                   batch_size: int = 1000, timestamp_field: str = 'updated_at',
+                                   columns: List[str] = None) -> List[dict]:
+    """Возвращает батч записей таблицы, обновленных после сохраненного состояния, не сдвигая состояние."""
+    updated_at, last_id = get_checkpoint(state, table, es_index)
+
+    query = updated_entries_query(table, timestamp_field, columns)
+    with STAGE_SECONDS.labels('fetch', table).time():
+        rows = postgres.query(query, {'timestamp': updated_at, 'last_id': last_id, 'batch_size': batch_size})
+    ROWS_FETCHED.labels(table, es_index).inc(len(rows))
+    if rows:
+        logger.info("Fetched {} updated rows from table {}", len(rows), table)
+    else:
+        logger.debug("No updated rows in table {}", table)
+    return rows
 
 
-def get_updated_postgres_entries(table: str, pg_url: str, target, state: State, es_index: str, batch_size: int = 1000,
-                                 timestamp_field: str = 'updated_at',
-                                 columns: List[str] = None) -> None:
+def get_updated_postgres_entries(table: str, postgres: PostgresClient, target, state: State, es_index: str,
+                                 batch_size: int = 1000, timestamp_field: str = 'updated_at',
+                                 columns: List[str] = None) -> int:
     """Producer, отправляющий в корутину обновленные записи из таблицы.
 
     :param table: PostgreSQL таблица, в которой ищутся обновленные записи.
-    :param pg_url: URL к PostgreSQL.
+    :param postgres: Пул соединений с PostgreSQL.
     :param target: Корутина-получатель.
     :param state: Объект для сохранения состояния ETL.
     :param es_index: Имя индекса в elastic search для формирования пути для сохранения состояния ETL.
     :param batch_size: Размер батча для получения записей из бд.
     :param timestamp_field: Поле, по которому определяются обновленные записи.
     :param columns: столбцы, которые должны быть в ответе.
+    :return: Количество обработанных записей.
     """
-    updated_at = datetime.fromisoformat(state.state_get_key(f'{table}.{es_index}.updated_at',
-                                                            datetime_to_iso_string(
-                                                                datetime.fromtimestamp(0, tz=timezone.utc))))
-    last_id = state.state_get_key(f'{table}.{es_index}.last_id', str(uuid.UUID(int=0)))
+    rows = fetch_updated_postgres_entries(table, postgres, state, es_index, batch_size, timestamp_field, columns)
+    if rows:
+        target.send(rows)
+        save_checkpoint(state, table, es_index, rows, timestamp_field)
+    return len(rows)
 
-    column_names = ','.join(columns) if columns else '*'
-    query = sql.SQL(f"""
-            select {column_names}, {timestamp_field}
-            from {table}
-            where ({timestamp_field} = %(timestamp)s and id > %(last_id)s)
-                  or {timestamp_field} > %(timestamp)s
-            order by {timestamp_field}, id
-            limit {batch_size}
-        """)
-    rows = query_postgresql(pg_url, query, {'timestamp': updated_at, 'last_id': last_id})
 
-    if rows:
+def drain_updated_postgres_entries(table: str, postgres: PostgresClient, target, state: State, es_index: str,
+                                   batch_size: int = 1000, timestamp_field: str = 'updated_at',
+                                   columns: List[str] = None, itersize: int = 2000) -> int:
+    """Producer режима догоняющей загрузки: отправляет в корутину все записи после сохраненного состояния.
+
+    Записи читаются одним серверным курсором, состояние сохраняется после каждого батча, который target отправил
+    в ElasticSearch. При ошибке чтения курсор открывается заново с последнего сохраненного батча. Ошибка target
+    не повторяется: корутины конвейера после неё закрыты, и процесс повторит загрузку в следующем цикле с новым
+    конвейером.
+
+    :param itersize: Количество строк, забираемых курсором с сервера за один раз.
+    :return: Количество обработанных записей.
+    """
+    query = updated_entries_query(table, timestamp_field, columns, limit=False)
+
+    def read(_):
+        # Состояние сохраняется после каждого отправленного батча, поэтому чтение продолжается с него.
+        updated_at, last_id = get_checkpoint(state, table, es_index)
+        return postgres.stream(query, {'timestamp': updated_at, 'last_id': last_id}, batch_size, itersize)
+
+    processed = 0
+    started = time.perf_counter()
+    for rows in retry_stream('drain_updated_postgres_entries', read, 'postgres', exceptions=CONNECTION_ERRORS):
+        STAGE_SECONDS.labels('fetch', table).observe(time.perf_counter() - started)
+        ROWS_FETCHED.labels(table, es_index).inc(len(rows))
         logger.info("Fetched {} updated rows from table {}", len(rows), table)
         target.send(rows)
-        current_last_timestamp = datetime_to_iso_string(rows[-1][timestamp_field])
-        current_last_id = str(rows[-1]['id'])
-        state.state_set_key(f'{table}.{es_index}.updated_at', current_last_timestamp)
-        state.state_set_key(f'{table}.{es_index}.last_id', current_last_id)
-        logger.debug("Updated state with updated_at: {}, last_id: {}", current_last_timestamp, current_last_id)
-    else:
+        save_checkpoint(state, table, es_index, rows, timestamp_field)
+        processed += len(rows)
+        started = time.perf_counter()
+
+    if not processed:
         logger.debug("No updated rows in table {}", table)
+    return processed
 
 
 @coroutine
@@ -137,206 +409,212 @@ def table_with_fwkey_get_film_ids(film_work_id_field: str, target):
 
 
 @coroutine
-def get_table_ids_by_join(pg_url: str, select_field: str, join_table: str, join_field: str, target):
-    """Отправляет в target поле (select_field) таблицы, полученное пересечением входящих id с записями в join_table по
-    join_field.
+def collect_ids(ids: Set):
+    """Собирает входящие id в множество ids, убирая дубликаты."""
+    while new_ids := (yield):
+        ids.update(new_ids)
+
+
+@coroutine
+def get_table_ids_by_join(postgres: PostgresClient, select_field: str, join_table: str, join_field: str, target,
+                          batch_size: int = 1000, itersize: int = 2000):
+    """Отправляет в target уникальные значения поля (select_field) таблицы, полученные пересечением входящих id с
+    записями в join_table по join_field.
+
+    Результат читается серверным курсором и отправляется батчами не больше batch_size, поэтому память и размер
+    следующих запросов не зависят от того, сколько фильмов у жанра или персоны. После ошибки чтения курсор
+    открывается заново после последнего отправленного id.
     """
+    query = table_ids_by_join_query(select_field, join_table, join_field)
+    stage_seconds = STAGE_SECONDS.labels('extract_ids', join_table)
     while rows := (yield):
         ids = [row['id'] for row in rows]
-        query = f"""SELECT t.{select_field} as id
-        FROM {join_table} t
-        WHERE t.{join_field} = ANY(%(ids)s::uuid[])
-        """
-        rows = query_postgresql(pg_url, query, {'ids': ids})
-        if rows:
-            target.send([row['id'] for row in rows])
+
+        def read(last_batch):
+            last_id = str(last_batch[-1]['id'] if last_batch else uuid.UUID(int=0))
+            return postgres.stream(query, {'ids': ids, 'last_id': last_id}, batch_size, itersize)
+
+        started = time.perf_counter()
+        for batch in retry_stream('get_table_ids_by_join', read, 'postgres', exceptions=CONNECTION_ERRORS):
+            stage_seconds.observe(time.perf_counter() - started)
+            target.send([row['id'] for row in batch])
+            started = time.perf_counter()
 
 
 @coroutine
-def denormalize_film_data(pg_url: str, target):
+def denormalize_film_data(postgres: PostgresClient, target):
     """Отправляет в target информацию о фильме из нескольких таблиц для ElasticSearch."""
     while film_ids := (yield):
         logger.debug("Denormalizing data.")
-        query = """
-                SELECT 
-                    fw.id AS id,
-                    fw.title,
-                    fw.description,
-                    fw.rating,
-                    fw.type,
-                    fwp.persons,
-                    fwg.genres
-                FROM "public".film_work fw
-                LEFT JOIN LATERAL ( 
-                    SELECT 
-                        pfw.film_work_id,
-                        array_agg(jsonb_build_object(
-                            'id', p.id, 
-                            'full_name', p.full_name, 
-                            'role', pfw.role
-                        )) AS persons
-                    FROM "public".person_film_work pfw
-                    JOIN "public".person p ON p.id = pfw.person_id
-                    WHERE pfw.film_work_id = fw.id
-                    GROUP BY 1 
-                    ) fwp ON TRUE
-                LEFT JOIN LATERAL ( 
-                    SELECT 
-                        gfw.film_work_id,
-                        array_agg(jsonb_build_object(
-                            'id', g.id, 
-                            'name', g.name
-                        )) AS genres
-                    FROM "public".genre_film_work gfw
-                    JOIN "public".genre g ON g.id = gfw.genre_id
-                    WHERE gfw.film_work_id = fw.id
-                    GROUP BY 1
-                    ) fwg ON TRUE
-                WHERE fw.id = ANY(%(film_ids)s::uuid[]);
-                """
-
-        films = query_postgresql(pg_url, query, {'film_ids': film_ids})
+        with STAGE_SECONDS.labels('denormalize', 'movies').time():
+            films = postgres.query(DENORMALIZE_FILMS_QUERY, {'film_ids': film_ids})
         logger.debug("Extracted {} film works from database", len(films))
-        target.send(films)
+        if films:
+            target.send(films)
 
 
 @coroutine
-def transform_movies_data(target):
+def fetch_documents(postgres: PostgresClient, documents_query: PreparedQuery, target, index: str = ''):
+    """Отправляет в target готовые JSON документы индекса для входящих id, собранные запросом в PostgreSQL."""
+    stage_seconds = STAGE_SECONDS.labels('denormalize', index)
+    while ids := (yield):
+        with stage_seconds.time():
+            rows = postgres.query(documents_query, {'ids': ids})
+        logger.debug("Extracted {} documents from database", len(rows))
+        if rows:
+            target.send([RawDocument(row['id'], row['doc']) for row in rows])
+
+
+# Роли персон в фильме и поля документа movies, в которые они попадают.
+MOVIE_PERSON_ROLES = {
+    'actor': ('actors', 'actors_names'),
+    'writer': ('writers', 'writers_names'),
+    'director': ('directors', 'directors_names'),
+}
+
+
+def movie_document(film_work: dict) -> dict:
+    """Документ индекса movies из денормализованной записи фильма за один проход по персонам.
+
+    Типы значений уже приведены PostgreSQL, поэтому документ собирается из обычных dict без проверки схемой.
+    """
+    doc = {
+        'id': str(film_work['id']),
+        'imdb_rating': film_work['rating'],
+        'title': film_work['title'],
+        'description': film_work['description'],
+    }
+    for objects_field, names_field in MOVIE_PERSON_ROLES.values():
+        doc[objects_field] = []
+        doc[names_field] = []
+    for person in film_work['persons'] or ():
+        fields = MOVIE_PERSON_ROLES.get(person['role'])
+        if fields:
+            doc[fields[0]].append({'id': person['id'], 'name': person['full_name']})
+            doc[fields[1]].append(person['full_name'])
+
+    genres = film_work['genres'] or ()
+    doc['genres'] = [{'id': genre['id'], 'name': genre['name']} for genre in genres]
+    doc['genres_names'] = [genre['name'] for genre in genres]
+    return doc
+
+
+def build_movie_documents(film_works: List[dict], validate: bool = False) -> List[dict]:
+    """Преобразует денормализованные записи фильмов в документы индекса movies.
+
+    :param validate: Проверять каждый документ схемой MovieElastic (для отладки).
+    """
+    if validate:
+        return [MovieElastic(**movie_document(film_work)).dict() for film_work in film_works]
+    return [movie_document(film_work) for film_work in film_works]
+
+
+@coroutine
+def transform_movies_data(target, validate: bool = False):
     """Преобразует входящие записи в схему ElasticSearch."""
     while film_works := (yield):
         logger.debug('transforming movies data')
-        batch = []
-        for film_work in film_works:
-            if not film_work['genres']:
-                film_work['genres'] = []
-            if not film_work['persons']:
-                film_work['persons'] = []
-            actors = [{'id': person['id'], 'name': person['full_name']}
-                      for person in film_work['persons']
-                      if person['role'] == 'actor']
-            writers = [{'id': person['id'], 'name': person['full_name']}
-                       for person in film_work['persons']
-                       if person['role'] == 'writer']
-            directors = [{'id': person['id'], 'name': person['full_name']}
-                         for person in film_work['persons']
-                         if person['role'] == 'director']
-
-            genres = [{'id': genre['id'], 'name': genre['name']}
-                      for genre in film_work['genres']]
-
-            directors_names = [person['full_name'] for person in film_work['persons'] if person['role'] == 'director']
-            actors_names = [person['full_name'] for person in film_work['persons'] if person['role'] == 'actor']
-            writers_names = [person['full_name'] for person in film_work['persons'] if person['role'] == 'writer']
-            genres_names = [genre['name'] for genre in film_work['genres']]
-
-            movie = MovieElastic(id=str(film_work['id']),
-                                 imdb_rating=film_work['rating'],
-                                 genres_names=genres_names,
-                                 title=film_work['title'],
-                                 description=film_work['description'],
-                                 actors_names=actors_names,
-                                 writers_names=writers_names,
-                                 directors_names=directors_names,
-                                 actors=actors,
-                                 writers=writers,
-                                 directors=directors,
-                                 genres=genres)
-
-            batch.append(movie.dict())
-        target.send(batch)
+        with STAGE_SECONDS.labels('transform', 'movies').time():
+            docs = build_movie_documents(film_works, validate)
+        target.send(docs)
 
 
 @coroutine
-def denormalize_person_data(pg_url: str, target):
+def denormalize_person_data(postgres: PostgresClient, target):
     """Отправляет в target информацию о персонах из нескольких таблиц для ElasticSearch."""
     while person_ids := (yield):
         logger.debug("Denormalizing persons data.")
+        with STAGE_SECONDS.labels('denormalize', 'persons').time():
+            persons = postgres.query(DENORMALIZE_PERSONS_QUERY, {'person_ids': person_ids})
+        logger.debug("Extracted {} persons from database", len(persons))
+        if persons:
+            target.send(persons)
 
-        query = """
-                    SELECT p.id, p.full_name, fwp.films 
-                    FROM person p 
-                    LEFT JOIN LATERAL (
-                        SELECT
-                            array_agg(jsonb_build_object(
-                            'id', pfw.film_work_id, 
-                            'role', pfw.role)) AS films 
-                        FROM person_film_work pfw 
-                        WHERE pfw.person_id = p.id
-                        ) fwp ON TRUE 
-                    WHERE p.id = ANY(%(person_ids)s::uuid[])
-        """
 
-        persons = query_postgresql(pg_url, query, {'person_ids': person_ids})
-        logger.debug("Extracted {} persons from database", len(persons))
-        target.send(persons)
+def person_document(person: dict) -> dict:
+    """Документ индекса persons из денормализованной записи персоны."""
+    film_ids = []
+    roles = set()
+    for person_film in person['films'] or ():
+        film_ids.append(person_film['id'])
+        roles.add(person_film['role'])
+    return {'id': str(person['id']), 'full_name': person['full_name'], 'roles': sorted(roles),
+            'film_ids': film_ids}
+
+
+def build_person_documents(persons: List[dict], validate: bool = False) -> List[dict]:
+    """Преобразует денормализованные записи персон в документы индекса persons.
+
+    :param validate: Проверять каждый документ схемой PersonElastic (для отладки).
+    """
+    if validate:
+        return [PersonElastic(**person_document(person)).dict() for person in persons]
+    return [person_document(person) for person in persons]
 
 
 @coroutine
-def transform_persons_data(target):
+def transform_persons_data(target, validate: bool = False):
     while persons := (yield):
         logger.debug('transforming persons data')
-        batch = []
-        for person in persons:
-            if not person.get('film_ids'):
-                person['film_ids'] = []
-            if not person.get('roles'):
-                person['roles'] = set()
-            for person_film in person['films']:
-                person['film_ids'].append(person_film['id'])
-                person['roles'].add(person_film['role'])
-            person = PersonElastic(id=str(person['id']),
-                                   full_name=person['full_name'],
-                                   film_ids=person['film_ids'],
-                                   roles=list(person['roles']))
-
-            batch.append(person.dict())
-        target.send(batch)
+        with STAGE_SECONDS.labels('transform', 'persons').time():
+            docs = build_person_documents(persons, validate)
+        target.send(docs)
 
 
 @coroutine
-def denormalize_genres_data(pg_url, target):
+def denormalize_genres_data(postgres: PostgresClient, target):
     """Отправляет в target информацию о жанрах из нескольких таблиц для ElasticSearch."""
     while genre_ids := (yield):
         logger.debug("Denormalizing genres data.")
+        with STAGE_SECONDS.labels('denormalize', 'genres').time():
+            genres = postgres.query(DENORMALIZE_GENRES_QUERY, {'genre_ids': genre_ids})
+        logger.debug("Extracted {} genres from database", len(genres))
+        if genres:
+            target.send(genres)
 
-        query = """
-                    SELECT g.id, g.name, fwg.filmworks
-                    FROM "public".genre g
-                    LEFT JOIN LATERAL ( 
-                    SELECT 
-                        array_agg(jsonb_build_object(
-                            'id', fw.id, 
-                            'title', fw.title,
-                            'imdb_rating', fw.rating
-                        )) AS filmworks
-                    FROM "public".genre_film_work gfw
-                    JOIN "public".film_work fw ON fw.id = gfw.film_work_id
-                    WHERE gfw.genre_id = g.id
-                    ) fwg ON TRUE
-                    WHERE g.id = ANY(%(genre_ids)s::uuid[])
-        """
 
-        genres = query_postgresql(pg_url, query, {'genre_ids': genre_ids})
-        logger.debug("Extracted {} genres from database", len(genres))
-        target.send(genres)
+def genre_document(genre: dict) -> dict:
+    """Документ индекса genres из денормализованной записи жанра."""
+    filmworks = [{'id': filmwork['id'], 'title': filmwork['title'], 'imdb_rating': filmwork['imdb_rating']}
+                 for filmwork in genre['filmworks'] or ()]
+    return {'id': str(genre['id']), 'name': genre['name'], 'filmworks': filmworks}
+
+
+def build_genre_documents(genres: List[dict], validate: bool = False) -> List[dict]:
+    """Преобразует денормализованные записи жанров в документы индекса genres.
+
+    :param validate: Проверять каждый документ схемой GenreElastic (для отладки).
+    """
+    if validate:
+        return [GenreElastic(**genre_document(genre)).dict() for genre in genres]
+    return [genre_document(genre) for genre in genres]
 
 
 @coroutine
-def transform_genres_data(target):
+def transform_genres_data(target, validate: bool = False):
     while genres := (yield):
         logger.debug('transforming genres data')
-        batch = []
-        for genre in genres:
-            if not genre['filmworks']:
-                genre['filmworks'] = []
+        with STAGE_SECONDS.labels('transform', 'genres').time():
+            docs = build_genre_documents(genres, validate)
+        target.send(docs)
 
-            filmworks = [{'id': filmwork['id'], 'title': filmwork['title'], 'imdb_rating': filmwork['imdb_rating']}
-                         for filmwork in genre['filmworks']]
-            genre = GenreElastic(id=str(genre['id']),
-                                 name=genre['name'],
-                                 filmworks=filmworks)
 
-            batch.append(genre.dict())
+@coroutine
+def parallel_transform(build_documents: Callable, executor: Executor, workers: int, target, index: str = ''):
+    """Преобразует входящие записи в документы в пуле процессов.
+
+    Батч делится на workers частей, которые преобразуются параллельно; документы отправляются в target в порядке
+    входящих записей.
+    """
+    stage_seconds = STAGE_SECONDS.labels('transform', index)
+    while rows := (yield):
+        logger.debug('transforming {} rows in {} workers', len(rows), workers)
+        chunk_size = math.ceil(len(rows) / workers)
+        chunks = [rows[start:start + chunk_size] for start in range(0, len(rows), chunk_size)]
+        batch = []
+        with stage_seconds.time():
+            for docs in executor.map(build_documents, chunks):
+                batch.extend(docs)
         target.send(batch)
 
 
@@ -356,29 +634,586 @@ def batcher(batch_size, target):
 
 
 @coroutine
-def load_to_elastic(elastic_host, index):
-    """Сохраняет входящие данные в ElasticSearch."""
+def load_to_elastic(es: Elasticsearch, index: str, bulk_settings: BulkSettings = BulkSettings(),
+                    aliases: Optional[IndexAliases] = None):
+    """Сохраняет входящие данные в ElasticSearch через общий для процесса клиент.
+
+    Если передан aliases, index — имя алиаса, и документы пишутся во все его текущие индексы.
+    """
+    stage_seconds = STAGE_SECONDS.labels('load', index)
     while docs := (yield):
         logger.debug('writing to ES')
+        with stage_seconds.time():
+            count = bulk_index(es, index, docs, bulk_settings, aliases)
+        logger.info("Updated {} documents in Elastic", count)
+
+
+@coroutine
+def skip_unchanged(fingerprints: FingerprintStore, index: str, target,
+                   dead_letters: Optional[DeadLetterFile] = None):
+    """Отбрасывает документы, которые уже загружены в индекс в том же виде, и запоминает хеши загруженных.
+
+    Хеши документов, которые ElasticSearch отклонил и которые записаны в dead_letters, не запоминаются, чтобы
+    документ загрузился при следующей обработке, даже если он не изменится.
+    """
+    while docs := (yield):
+        changed_docs, changed_fingerprints = fingerprints.changed(index, docs)
+        if changed_docs:
+            target.send(changed_docs)
+            if dead_letters is not None:
+                for doc_id in dead_letters.take_failed(index, changed_fingerprints):
+                    del changed_fingerprints[doc_id]
+            fingerprints.save(index, changed_fingerprints)
 
-        elastic_settings = dict(
-            hosts=elastic_host,
-        )
 
-        def generate_doc(docs):
-            for doc in docs:
-                yield {
-                    '_index': index,
-                    '_id': doc['id'],
-                    '_source': doc
-                }
-
-        with Elasticsearch(**elastic_settings) as es:
-            count, _ = helpers.bulk(
-                es,
-                generate_doc(docs)
+@coroutine
+def serialized(lock: threading.Lock, target):
+    """Отправляет в target каждый входящий батч под блокировкой lock.
+
+    Процессы одного индекса, работающие параллельно, денормализуют и загружают батчи по очереди. Иначе документ,
+    прочитанный из базы раньше, мог бы попасть в индекс позже и перезаписать более новую версию.
+    """
+    while ids := (yield):
+        with lock:
+            target.send(ids)
+
+
+@dataclass(frozen=True)
+class ETLProcessConfig:
+    table: str
+    postgres: PostgresClient
+    elastic: Elasticsearch
+
+    state: State
+    film_id_function: Callable
+    get_film_id_args: Sequence
+    elastic_index: str = 'movies'
+
+    timestamp_field: str = 'updated_at'
+    pg_batch_size: int = 1000
+    es_batch_size: int = 1000
+    bulk_settings: BulkSettings = BulkSettings()
+
+    catch_up: bool = False
+    itersize: int = 2000
+
+    transform_executor: Optional[Executor] = None
+    transform_workers: int = 1
+    validate_documents: bool = False
+    # Собирать JSON документов в PostgreSQL и передавать его в ElasticSearch без разбора в Python.
+    documents_in_postgres: bool = False
+
+    # Алиасы версионированных индексов; None — elastic_index пишется напрямую.
+    index_aliases: Optional[IndexAliases] = None
+    # Хеши загруженных документов; если заданы, неизменившиеся документы не индексируются повторно.
+    fingerprints: Optional[FingerprintStore] = None
+    # Блокировки индексов для процессов, которые работают параллельно (ProducerScheduler).
+    index_locks: Optional[Dict[str, threading.Lock]] = None
+
+    # Запрос денормализации и преобразование в документы индекса, используются асинхронным движком.
+    denormalize_query: ClassVar[PreparedQuery] = DENORMALIZE_FILMS_QUERY
+    build_documents: ClassVar[Callable] = staticmethod(build_movie_documents)
+    # Запрос, который собирает документы индекса в PostgreSQL (documents_in_postgres).
+    documents_query: ClassVar[PreparedQuery] = MOVIE_DOCUMENTS_QUERY
+    # Можно ли объединять процесс с другими процессами индекса в CoalescedETLProcess.
+    coalescable: ClassVar[bool] = True
+
+    def transform_stage(self, transform: Callable, target):
+        """Этап трансформации: корутина transform в текущем процессе или build_documents в пуле процессов."""
+        if self.transform_executor is not None:
+            return parallel_transform(self.document_builder(), self.transform_executor, self.transform_workers,
+                                      target, self.elastic_index)
+        return transform(target, self.validate_documents)
+
+    def document_builder(self) -> Callable[[List[dict]], List[dict]]:
+        """build_documents с режимом проверки документов процесса; функцию можно передать в пул процессов."""
+        return partial(self.build_documents, validate=self.validate_documents)
+
+    def denormalize_pipeline(self, locked: bool = True):
+        """Корутина, которая денормализует, трансформирует и загружает в ElasticSearch входящие id.
+
+        :param locked: Получать батчи под блокировкой индекса; False — если вызывающий этап уже держит блокировку.
+        """
+        target = batcher(self.es_batch_size,
+                         load_to_elastic(self.elastic, self.elastic_index, self.bulk_settings, self.index_aliases))
+        if self.fingerprints is not None:
+            target = skip_unchanged(self.fingerprints, self.elastic_index, target, self.bulk_settings.dead_letters)
+        if self.documents_in_postgres:
+            target = fetch_documents(self.postgres, self.documents_query, target, self.elastic_index)
+        else:
+            target = self.transform_pipeline(target)
+        return self.serialized(target) if locked else target
+
+    def serialized(self, target):
+        """Этап, который получает батчи под блокировкой индекса, если процессы индекса работают параллельно."""
+        lock = self.index_locks.get(self.elastic_index) if self.index_locks else None
+        return serialized(lock, target) if lock else target
+
+    def transform_pipeline(self, target):
+        """Корутина, которая денормализует входящие id и отправляет в target документы, собранные в Python."""
+        return denormalize_film_data(self.postgres, self.transform_stage(transform_movies_data, target))
+
+    @property
+    def tables(self) -> Set[str]:
+        """Таблицы, изменения в которых обрабатывает процесс."""
+        return {self.table}
+
+    @property
+    def fetch_size(self) -> int:
+        """Текущий размер батча чтения из PostgreSQL: pg_batch_size или размер, подстроенный под ElasticSearch."""
+        if self.bulk_settings.batch_size is not None:
+            return self.bulk_settings.batch_size.pg_batch_size
+        return self.pg_batch_size
+
+    def extract_ids(self, target):
+        """Корутина, которая получает из обновленных записей таблицы id документов индекса и отправляет их в target."""
+        if self.film_id_function is get_table_ids_by_join:
+            return get_table_ids_by_join(*self.get_film_id_args, target, batch_size=self.fetch_size,
+                                         itersize=self.itersize)
+        return self.film_id_function(*self.get_film_id_args, target)
+
+    def pipeline(self):
+        """Корутина, которая принимает обновленные записи таблицы."""
+        return self.extract_ids(self.denormalize_pipeline())
+
+    def fetch(self) -> List[dict]:
+        """Батч обновленных записей таблицы после сохраненного состояния."""
+        return fetch_updated_postgres_entries(self.table, self.postgres, self.state, self.elastic_index,
+                                              self.fetch_size, self.timestamp_field)
+
+    def checkpoint(self, rows: List[dict]) -> None:
+        """Сохраняет состояние после успешной загрузки rows в ElasticSearch."""
+        save_checkpoint(self.state, self.table, self.elastic_index, rows, self.timestamp_field)
+
+    def load(self, changes: Dict[str, List[dict]]) -> int:
+        """Загружает изменённые строки, полученные из внешнего источника изменений, без сохранения состояния.
+
+        :param changes: Изменённые строки по таблицам.
+        :return: Количество обработанных строк.
+        """
+        rows = changes.get(self.table)
+        if rows:
+            self.pipeline().send(rows)
+        return len(rows or [])
+
+    def run(self) -> int:
+        """Обрабатывает обновленные записи таблицы и возвращает их количество."""
+        logger.debug(f"Running process for table: {self.table}")
+        if self.catch_up:
+            return drain_updated_postgres_entries(
+                self.table, self.postgres, self.pipeline(), self.state, self.elastic_index, self.fetch_size,
+                self.timestamp_field, itersize=self.itersize
             )
-            logger.info("Updated {} documents in Elastic", count)
+        return get_updated_postgres_entries(
+            self.table, self.postgres, self.pipeline(), self.state, self.elastic_index, self.fetch_size,
+            self.timestamp_field
+        )
+
+
+@dataclass(frozen=True)
+class PersonsETLProcessConfig(ETLProcessConfig):
+    elastic_index: str = 'persons'
+
+    denormalize_query: ClassVar[PreparedQuery] = DENORMALIZE_PERSONS_QUERY
+    build_documents: ClassVar[Callable] = staticmethod(build_person_documents)
+    documents_query: ClassVar[PreparedQuery] = PERSON_DOCUMENTS_QUERY
+
+    def transform_pipeline(self, target):
+        return denormalize_person_data(self.postgres, self.transform_stage(transform_persons_data, target))
+
+
+@dataclass(frozen=True)
+class GenresETLProcessConfig(ETLProcessConfig):
+    elastic_index: str = 'genres'
+
+    denormalize_query: ClassVar[PreparedQuery] = DENORMALIZE_GENRES_QUERY
+    build_documents: ClassVar[Callable] = staticmethod(build_genre_documents)
+    documents_query: ClassVar[PreparedQuery] = GENRE_DOCUMENTS_QUERY
+
+    def transform_pipeline(self, target):
+        return denormalize_genres_data(self.postgres, self.transform_stage(transform_genres_data, target))
+
+
+@coroutine
+def forget_fingerprints(fingerprints: Optional[FingerprintStore], index: str, target=None):
+    """Забывает хеши входящих id документов, обновлённых в обход конвейера загрузки, и отправляет id в target."""
+    while ids := (yield):
+        if fingerprints is not None:
+            fingerprints.forget(index, ids)
+        if target is not None:
+            target.send(ids)
+
+
+@coroutine
+def rename_in_elastic(es: Elasticsearch, index: str, fields: Sequence[str], name_field: str,
+                      aliases: Optional[IndexAliases] = None, referencing_ids: Optional[Callable] = None,
+                      fingerprints: Optional[FingerprintStore] = None, redenormalize: Optional[Callable] = None):
+    """Переименовывает входящие записи справочника во всех документах индекса, которые на них ссылаются.
+
+    Хеши обновлённых документов забываются, а документы, изменённые во время обновления, денормализуются заново.
+
+    :param referencing_ids: Фабрика корутины, которая получает записи справочника и отправляет в target id
+        ссылающихся на них документов.
+    :param redenormalize: Фабрика конвейера, который заново денормализует и загружает входящие id.
+    """
+    while rows := (yield):
+        names = {str(row['id']): row[name_field] for row in rows}
+        updated, conflicts = rename_references(es, index, fields, names, aliases)
+        logger.info("Updated names of {} records in {} documents of {}", len(names), updated, index)
+        if referencing_ids is None:
+            continue
+        target = None
+        if conflicts and redenormalize is not None:
+            logger.warning("{} documents of {} changed during rename, re-denormalizing them", conflicts, index)
+            target = redenormalize()
+        if fingerprints is not None or target is not None:
+            referencing_ids(forget_fingerprints(fingerprints, index, target)).send(rows)
+
+
+@dataclass(frozen=True)
+class RenameETLProcessConfig(ETLProcessConfig):
+    """Producer справочника (person, genre) для индекса movies, который не денормализует фильмы заново.
+
+    Документы фильмов зависят от записи справочника только через её имя, поэтому вместо повторной денормализации
+    всех фильмов записи документы обновляются частично: update_by_query с сохранённым painless скриптом заменяет имя
+    во вложенных полях document_fields и пересобирает списки имён. Фильмы, изменённые во время обновления,
+    денормализуются заново.
+    """
+    name_field: str = 'full_name'
+    document_fields: Sequence[str] = ('actors', 'writers', 'directors')
+
+    coalescable: ClassVar[bool] = False
+
+    def pipeline(self):
+        return self.serialized(rename_in_elastic(
+            self.elastic, self.elastic_index, self.document_fields, self.name_field, self.index_aliases,
+            self.extract_ids, self.fingerprints, partial(self.denormalize_pipeline, locked=False),
+        ))
+
+
+@dataclass(frozen=True)
+class CoalescedETLProcess:
+    """Несколько producers одного индекса, которые за цикл загружают общий набор id документов.
+
+    Id из всех producers собираются в одно множество, поэтому документ, затронутый сразу несколькими таблицами,
+    денормализуется и индексируется один раз. Состояние каждого producer сохраняется только после успешной загрузки
+    общего набора.
+    """
+    processes: Sequence[ETLProcessConfig]
+
+    @property
+    def tables(self) -> Set[str]:
+        return {process.table for process in self.processes}
+
+    def _flush(self, ids: Set) -> None:
+        if not ids:
+            return
+        ids = list(ids)
+        flush_size = self.processes[0].fetch_size
+        target = self.processes[0].denormalize_pipeline()
+        for start in range(0, len(ids), flush_size):
+            target.send(ids[start:start + flush_size])
+
+    def run(self) -> int:
+        """Обрабатывает по батчу обновленных записей из каждой таблицы и возвращает их общее количество."""
+        ids = set()
+        fetched = []
+        for process in self.processes:
+            logger.debug(f"Collecting ids for table: {process.table}")
+            rows = process.fetch()
+            if rows:
+                process.extract_ids(collect_ids(ids)).send(rows)
+                fetched.append((process, rows))
+
+        logger.info("Coalesced {} unique ids from {} tables", len(ids), len(fetched))
+        self._flush(ids)
+
+        for process, rows in fetched:
+            process.checkpoint(rows)
+        return sum(len(rows) for _, rows in fetched)
+
+    def load(self, changes: Dict[str, List[dict]]) -> int:
+        """Загружает изменённые строки всех таблиц одним набором id без сохранения состояния."""
+        ids = set()
+        processed = 0
+        for process in self.processes:
+            rows = changes.get(process.table)
+            if rows:
+                process.extract_ids(collect_ids(ids)).send(rows)
+                processed += len(rows)
+        self._flush(ids)
+        return processed
+
+
+# Журнал удалений из tombstone_triggers.sql.
+TOMBSTONE_TABLE = 'public.etl_tombstone'
+# Индекс в ключах состояния producer журнала удалений.
+TOMBSTONE_STATE_INDEX = 'tombstones'
+# Таблицы, id удалённых строк которых являются id документов индексов.
+TOMBSTONE_DELETES = {
+    'public.film_work': 'movies',
+    'public.person': 'persons',
+    'public.genre': 'genres',
+}
+# Поля строк связующих таблиц в журнале и индексы, документы которых нужно денормализовать заново.
+TOMBSTONE_LINKS = {
+    'film_work_id': 'movies',
+    'person_id': 'persons',
+    'genre_id': 'genres',
+}
+
+PRUNE_TOMBSTONES_QUERY = PreparedQuery(
+    prefix='prune_tombstones',
+    template=f"""
+        WITH pruned AS (
+            DELETE FROM {TOMBSTONE_TABLE} WHERE deleted_at < $1 - $2 RETURNING 1
+        )
+        SELECT count(*) AS pruned FROM pruned
+    """,
+    params=(('processed_at', 'timestamptz'), ('retention', 'interval')),
+)
+
+
+@dataclass(frozen=True)
+class TombstoneETLProcess:
+    """Producer журнала удалений.
+
+    Удаление фильма, персоны или жанра удаляет документ из соответствующего индекса. Удаление строки связующей таблицы
+    заново денормализует затронутые фильм, персону или жанр. Журнал читается и сохраняет состояние так же, как таблицы
+    других producers; обработанные записи старше retention удаляются из журнала.
+
+    :param processes: ETL процессы индексов, через конвейеры которых загружаются и удаляются документы.
+    """
+    postgres: PostgresClient
+    state: State
+    processes: Sequence[ETLProcessConfig]
+    pg_batch_size: int = 1000
+    retention: timedelta = timedelta(days=7)
+
+    @property
+    def tables(self) -> Set[str]:
+        # Удаления приходят уведомлениями от исходных таблиц, а не от журнала.
+        return {TOMBSTONE_TABLE} | set(TOMBSTONE_DELETES) | {'public.person_film_work', 'public.genre_film_work'}
+
+    def _index_process(self, index: str) -> ETLProcessConfig:
+        return next(process for process in self.processes if process.elastic_index == index)
+
+    def _apply(self, rows: List[dict]) -> None:
+        deletes: Dict[str, Set] = {}
+        refreshes: Dict[str, Set] = {}
+        for row in rows:
+            index = TOMBSTONE_DELETES.get(row['table_name'])
+            if index:
+                deletes.setdefault(index, set()).add(str(row['row_id']))
+                continue
+            for field, linked_index in TOMBSTONE_LINKS.items():
+                if row[field]:
+                    refreshes.setdefault(linked_index, set()).add(str(row[field]))
+
+        # Записи, удалённые в предыдущих батчах, денормализация не найдёт, и их документы просто пропускаются.
+        for index, ids in refreshes.items():
+            ids -= deletes.get(index, set())
+            if ids:
+                logger.info("Re-denormalizing {} documents of {} after deleted links", len(ids), index)
+                self._index_process(index).denormalize_pipeline().send(list(ids))
+
+        for index, ids in deletes.items():
+            process = self._index_process(index)
+            ids = list(ids)
+            # Под блокировкой индекса, чтобы параллельный producer не загрузил удалённый документ, прочитанный раньше.
+            lock = process.index_locks.get(index) if process.index_locks else None
+            with lock or nullcontext():
+                deleted = bulk_delete(process.elastic, process.elastic_index, ids, process.bulk_settings,
+                                      process.index_aliases)
+                if process.fingerprints is not None:
+                    process.fingerprints.forget(process.elastic_index, ids)
+            logger.info("Deleted {} documents from {}", deleted, index)
+
+    def run(self) -> int:
+        """Обрабатывает батч записей журнала после сохраненного состояния и возвращает их количество."""
+        rows = fetch_updated_postgres_entries(TOMBSTONE_TABLE, self.postgres, self.state, TOMBSTONE_STATE_INDEX,
+                                              self.pg_batch_size, 'deleted_at')
+        if not rows:
+            return 0
+        self._apply(rows)
+        save_checkpoint(self.state, TOMBSTONE_TABLE, TOMBSTONE_STATE_INDEX, rows, 'deleted_at')
+        self._prune(rows[-1]['deleted_at'])
+        return len(rows)
+
+    def _prune(self, processed_at) -> None:
+        pruned = self.postgres.query(PRUNE_TOMBSTONES_QUERY,
+                                     {'processed_at': processed_at, 'retention': self.retention})
+        logger.debug("Pruned {} old tombstones", pruned[0]['pruned'])
+
+    def load(self, changes: Dict[str, List[dict]]) -> int:
+        """Обрабатывает записи журнала, полученные из слота логической репликации."""
+        rows = changes.get(TOMBSTONE_TABLE)
+        if not rows:
+            return 0
+        self._apply(rows)
+        self._prune(rows[-1]['deleted_at'])
+        return len(rows)
+
+
+ETLProcess = Union[ETLProcessConfig, CoalescedETLProcess, TombstoneETLProcess]
+
+
+def coalesce_etl_processes(etl_processes: Sequence[ETLProcessConfig]) -> List[ETLProcess]:
+    """Объединяет процессы с одинаковым конвейером загрузки (тип конфига и индекс) в CoalescedETLProcess."""
+    groups: Dict[Tuple[type, str], List[ETLProcessConfig]] = {}
+    separate = []
+    for process in etl_processes:
+        if process.coalescable:
+            groups.setdefault((type(process), process.elastic_index), []).append(process)
+        else:
+            separate.append(process)
+    return [CoalescedETLProcess(processes) if len(processes) > 1 else processes[0]
+            for processes in groups.values()] + separate
+
+
+def build_etl_processes(postgres: PostgresClient, elastic: Elasticsearch, state: State, partial_renames: bool = False,
+                        **options) -> List[ETLProcessConfig]:
+    """Создаёт ETL процессы для всех таблиц и индексов.
+
+    :param partial_renames: Обновлять имена персон и жанров в индексе movies частично (RenameETLProcessConfig).
+    :param options: Общие для всех процессов параметры ETLProcessConfig (размеры батчей, режимы работы).
+    """
+    common = dict(postgres=postgres, elastic=elastic, state=state, **options)
+    if partial_renames:
+        person_movies = RenameETLProcessConfig(
+            table="public.person", film_id_function=get_table_ids_by_join,
+            get_film_id_args=(postgres, "film_work_id", "public.person_film_work", "person_id"),
+            name_field='full_name', document_fields=('actors', 'writers', 'directors'), **common)
+        genre_movies = RenameETLProcessConfig(
+            table="public.genre", film_id_function=get_table_ids_by_join,
+            get_film_id_args=(postgres, "film_work_id", "public.genre_film_work", "genre_id"),
+            name_field='name', document_fields=('genres',), **common)
+    else:
+        person_movies = ETLProcessConfig(
+            table="public.person", film_id_function=get_table_ids_by_join,
+            get_film_id_args=(postgres, "film_work_id", "public.person_film_work", "person_id"), **common)
+        genre_movies = ETLProcessConfig(
+            table="public.genre", film_id_function=get_table_ids_by_join,
+            get_film_id_args=(postgres, "film_work_id", "public.genre_film_work", "genre_id"), **common)
+
+    return [
+        ETLProcessConfig(table="public.film_work", film_id_function=table_with_fwkey_get_film_ids,
+                         get_film_id_args=('id',), **common),
+
+        person_movies,
+
+        genre_movies,
+
+        ETLProcessConfig(table="public.person_film_work", film_id_function=table_with_fwkey_get_film_ids,
+                         get_film_id_args=("film_work_id",), timestamp_field='created_at', **common),
+
+        ETLProcessConfig(table="public.genre_film_work", film_id_function=table_with_fwkey_get_film_ids,
+                         get_film_id_args=("film_work_id",), timestamp_field='created_at', **common),
+
+        PersonsETLProcessConfig(table="public.person", film_id_function=get_table_ids_by_join,
+                                get_film_id_args=(postgres, "person_id", "public.person_film_work", "person_id"),
+                                timestamp_field='created_at', **common),
+
+        GenresETLProcessConfig(table="public.genre", film_id_function=get_table_ids_by_join,
+                               get_film_id_args=(postgres, "genre_id", "public.genre_film_work", "genre_id"),
+                               timestamp_field='created_at', **common),
+    ]
+
+
+def run_polling(etl_processes: Sequence[ETLProcess], listener: Optional[ChangeListener], poll_period: float,
+                fallback_poll_period: float) -> None:
+    """Бесконечный цикл опроса таблиц.
+
+    Пока producers находят изменения, следующий цикл начинается сразу. Когда изменений нет, ждём poll_period секунд
+    или, если задан listener, уведомления об изменениях (но не дольше fallback_poll_period).
+    """
+    if listener:
+        # Подписываемся до первого прохода, чтобы не потерять изменения, сделанные во время него.
+        listener.connect()
+
+    # None означает, что нужно проверить все таблицы.
+    changed_tables = None
+    while True:
+        logger.debug("Checking if any updated entries.")
+        processed = 0
+        failed = False
+        for etl_process in etl_processes:
+            if changed_tables is None or etl_process.tables & changed_tables:
+                try:
+                    processed += etl_process.run()
+                except Exception:
+                    # Бюджет повторов исчерпан; состояние не сдвинуто, процесс повторится в следующем цикле.
+                    logger.opt(exception=True).error("ETL process for tables {} failed.", etl_process.tables)
+                    failed = True
+
+        if processed and not failed:
+            continue
+        if failed:
+            changed_tables = None
+            time.sleep(poll_period)
+            continue
+        if listener:
+            changed_tables = listener.wait(fallback_poll_period)
+            logger.debug("Woken up by changes in tables: {}", changed_tables or 'all')
+        else:
+            time.sleep(poll_period)
+
+
+def create_state(args: argparse.Namespace, group_commit: bool = True) -> State:
+    """Создаёт хранилище состояния по аргументам командной строки.
+
+    :param group_commit: Использовать --state-group-commit. Процессы параллельной загрузки коммитят каждую запись,
+        чтобы не держать блокировку записи общего файла SQLite.
+    """
+    if args.state_backend == 'sqlite':
+        return SQLiteState(args.state_path, durability=args.state_durability,
+                           group_commit_interval=args.state_group_commit if group_commit else 0)
+    return RedisState(redis_adapter=Redis(host=args.redis_host))
+
+
+def create_elastic(args: argparse.Namespace) -> Tuple[Elasticsearch, BulkSettings]:
+    """Создаёт клиент ElasticSearch и настройки загрузки по аргументам командной строки."""
+    batch_size = None
+    if args.adaptive_batch:
+        batch_size = AdaptiveBatchSize(args.es_bulk_chunk_size, args.pg_batch_size, args.es_bulk_target_latency,
+                                       max_chunk_docs=args.es_batch_size, max_chunk_bytes=args.es_bulk_max_bytes)
+    elastic = create_elastic_client(args.elastic_host, max_connections=max(10, args.es_bulk_threads),
+                                    batch_size=batch_size)
+    # Хеши документов из файла отклонённых не сохраняются, поэтому с --skip-unchanged их id нужно запоминать.
+    dead_letters = (DeadLetterFile(args.dead_letter_file, track_failed=args.skip_unchanged)
+                    if args.dead_letter_file else None)
+    bulk_settings = BulkSettings(mode=args.es_bulk_mode, chunk_size=args.es_bulk_chunk_size,
+                                 thread_count=args.es_bulk_threads, queue_size=args.es_bulk_queue_size,
+                                 batch_size=batch_size, dead_letters=dead_letters)
+    return elastic, bulk_settings
+
+
+def backfill_key_range(args: argparse.Namespace, alias: str, index: str, key_range: KeyRange) -> int:
+    """Загружает диапазон ключей исходной таблицы алиаса в версию индекса index (--backfill-workers).
+
+    Выполняется в отдельном процессе, поэтому создаёт свои соединения. Загрузка одного диапазона занимает не больше
+    двух соединений PostgreSQL одновременно: чтение id и денормализацию.
+    """
+    configure_retries(RetryPolicy(max_elapsed=args.retry_max_elapsed), args.breaker_threshold,
+                      args.breaker_reset_timeout)
+    state = create_state(args, group_commit=False)
+    psycopg2.extras.register_uuid()
+    postgres = PostgresClient(args.postgres_url, max_connections=2, health_check_period=args.pg_health_check_period)
+    elastic, bulk_settings = create_elastic(args)
+    etl_processes = build_etl_processes(
+        postgres, elastic, state,
+        pg_batch_size=args.pg_batch_size, es_batch_size=args.es_batch_size, bulk_settings=bulk_settings,
+        validate_documents=args.validate_documents, documents_in_postgres=args.documents_in_postgres,
+        fingerprints=FingerprintStore(state) if args.skip_unchanged else None,
+    )
+    try:
+        return fill_key_range(index, [process for process in etl_processes if process.elastic_index == alias],
+                              postgres, state, args.pg_batch_size, key_range)
+    finally:
+        postgres.close()
+        elastic.close()
+        if isinstance(state, SQLiteState):
+            state.close()
 
 
 if __name__ == '__main__':
@@ -392,151 +1227,257 @@ if __name__ == '__main__':
                         help="URL ElasticSearch.", required=False)
     parser.add_argument("--redis-host", dest="redis_host", default='localhost',
                         help="Хост Redis.", required=False)
-    parser.add_argument("--poll-period", dest="poll_period", default=2,
+    parser.add_argument("--state-backend", dest="state_backend", default='redis', choices=('redis', 'sqlite'),
+                        help="Хранилище состояния: redis или локальный файл SQLite.", required=False)
+    parser.add_argument("--state-path", dest="state_path", default='state.sqlite3',
+                        help="Файл состояния для --state-backend sqlite.", required=False)
+    parser.add_argument("--state-durability", dest="state_durability", default='full',
+                        choices=tuple(SQLITE_DURABILITY),
+                        help="Надёжность записи состояния SQLite: full — fsync при каждом коммите, normal — только при "
+                             "checkpoint WAL, off — без fsync.", required=False)
+    parser.add_argument("--state-group-commit", dest="state_group_commit", default=0, type=float,
+                        help="Коммитить записи состояния SQLite не чаще раза в столько секунд (0 — каждую запись).",
+                        required=False)
+    parser.add_argument("--poll-period", dest="poll_period", default=2, type=float,
                         help="Пауза между обновлением данных в секундах.", required=False)
-    parser.add_argument("--pg-batch", dest="pg_batch_size", default=1000,
+    parser.add_argument("--pg-batch", dest="pg_batch_size", default=1000, type=int,
                         help="Размер батча для загрузки из PosgreSQL.", required=False)
-    parser.add_argument("--es-batch", dest="es_batch_size", default=1000,
+    parser.add_argument("--es-batch", dest="es_batch_size", default=1000, type=int,
                         help="Размер батча для загрузки в ElasticSearch.", required=False)
+    parser.add_argument("--pg-pool-size", dest="pg_pool_size", default=4, type=int,
+                        help="Максимальное число соединений в пуле PostgreSQL.", required=False)
+    parser.add_argument("--pg-health-check-period", dest="pg_health_check_period", default=30, type=float,
+                        help="Время простоя соединения в секундах, после которого оно проверяется перед запросом.",
+                        required=False)
+    parser.add_argument("--es-bulk-mode", dest="es_bulk_mode", default='bulk', choices=BULK_MODES,
+                        help="Способ загрузки в ElasticSearch: bulk, streaming или parallel.", required=False)
+    parser.add_argument("--es-bulk-chunk", dest="es_bulk_chunk_size", default=500, type=int,
+                        help="Количество документов в одном bulk запросе.", required=False)
+    parser.add_argument("--adaptive-batch", dest="adaptive_batch", action='store_true',
+                        help="Подстраивать размер bulk запросов (в документах и байтах) и батча PostgreSQL под время "
+                             "ответа ElasticSearch и отказы 429. --es-bulk-chunk и --pg-batch задают начальные "
+                             "размеры, --es-batch — наибольший размер bulk запроса. Только для --engine sync.",
+                        required=False)
+    parser.add_argument("--es-bulk-target-latency", dest="es_bulk_target_latency", default=1.0, type=float,
+                        help="Целевое время ответа на bulk запрос в секундах для --adaptive-batch.", required=False)
+    parser.add_argument("--es-bulk-max-bytes", dest="es_bulk_max_bytes", default=10 * 1024 * 1024, type=int,
+                        help="Наибольший размер bulk запроса в байтах для --adaptive-batch.", required=False)
+    parser.add_argument("--es-bulk-threads", dest="es_bulk_threads", default=4, type=int,
+                        help="Количество потоков загрузки в режиме parallel.", required=False)
+    parser.add_argument("--es-bulk-queue", dest="es_bulk_queue_size", default=4, type=int,
+                        help="Максимальное количество чанков в очереди на отправку в режиме parallel.",
+                        required=False)
+    parser.add_argument("--catch-up", dest="catch_up", action='store_true',
+                        help="Догоняющий режим: за цикл вычитывать все изменения серверным курсором.", required=False)
+    parser.add_argument("--pg-itersize", dest="pg_itersize", default=2000, type=int,
+                        help="Количество строк, забираемых серверным курсором за раз в догоняющем режиме.",
+                        required=False)
+    parser.add_argument("--coalesce", dest="coalesce", action='store_true',
+                        help="Собирать id фильмов от всех producers индекса в один набор за цикл и загружать его "
+                             "один раз. Батчи читаются постранично, --catch-up в этом режиме не используется.",
+                        required=False)
+    parser.add_argument("--listen", dest="listen", action='store_true',
+                        help="Запускать producers по уведомлениям PostgreSQL (LISTEN/NOTIFY) вместо опроса. "
+                             "Требует триггеров из notify_triggers.sql.", required=False)
+    parser.add_argument("--fallback-poll-period", dest="fallback_poll_period", default=60, type=float,
+                        help="Страховочный период опроса всех таблиц в секундах в режиме --listen.", required=False)
+    parser.add_argument("--scheduler", dest="scheduler", action='store_true',
+                        help="Запускать producers параллельно, каждый со своей частотой опроса и приоритетом. "
+                             "Только для --change-source scan.", required=False)
+    parser.add_argument("--producer-schedule", dest="producer_schedules", action='append', default=[],
+                        metavar='TABLE=SECONDS[:PRIORITY]',
+                        help="Период опроса и приоритет producers таблицы для --scheduler, например "
+                             "public.genre=30:0. По умолчанию --poll-period.", required=False)
+    parser.add_argument("--max-poll-period", dest="max_poll_period", default=30, type=float,
+                        help="Наибольшая пауза между опросами producer без изменений для --scheduler.",
+                        required=False)
+    parser.add_argument("--scheduler-workers", dest="scheduler_workers", default=0, type=int,
+                        help="Сколько producers могут работать одновременно (0 — все, сколько позволяет "
+                             "--pg-pool-size).", required=False)
+    parser.add_argument("--change-source", dest="change_source", default='scan', choices=('scan', 'replication'),
+                        help="Источник изменений: scan — опрос таблиц по updated_at, replication — слот логической "
+                             "репликации (pgoutput, требует wal_level=logical и публикации из replication.sql).",
+                        required=False)
+    parser.add_argument("--replication-slot", dest="replication_slot", default='etl_slot',
+                        help="Имя слота логической репликации.", required=False)
+    parser.add_argument("--engine", dest="engine", default='sync', choices=('sync', 'async'),
+                        help="sync — конвейер на корутинах-генераторах, async — asyncio конвейер, в котором чтение "
+                             "из PostgreSQL и загрузка в ElasticSearch идут одновременно.", required=False)
+    parser.add_argument("--async-queue-size", dest="async_queue_size", default=2, type=int,
+                        help="Количество батчей, ожидающих следующего этапа асинхронного конвейера.", required=False)
+    parser.add_argument("--transform-workers", dest="transform_workers", default=1, type=int,
+                        help="Количество процессов для преобразования записей в документы ElasticSearch. "
+                             "При значении 1 преобразование идёт в основном процессе.", required=False)
+    parser.add_argument("--validate-documents", dest="validate_documents", action='store_true',
+                        help="Проверять каждый документ pydantic схемой индекса перед загрузкой (медленно, для отладки).",
+                        required=False)
+    parser.add_argument("--documents-in-postgres", dest="documents_in_postgres", action='store_true',
+                        help="Собирать документы индексов в JSON запросом в PostgreSQL и передавать их в bulk запрос "
+                             "без преобразования в Python.", required=False)
+    parser.add_argument("--skip-unchanged", dest="skip_unchanged", action='store_true',
+                        help="Хранить в состоянии хеши загруженных документов и не индексировать повторно документы, "
+                             "которые не изменились. При пересоздании индекса в обход демона словарь "
+                             "fingerprint.<index> нужно удалить.", required=False)
+    parser.add_argument("--tombstones", dest="tombstones", action='store_true',
+                        help="Удалять из индексов удалённые в PostgreSQL записи по журналу удалений. Требует триггеров "
+                             "из tombstone_triggers.sql. Только для --engine sync.", required=False)
+    parser.add_argument("--partial-renames", dest="partial_renames", action='store_true',
+                        help="При изменении персон и жанров обновлять их имена в документах movies частично "
+                             "(update_by_query), не денормализуя фильмы заново. Только для --engine sync.",
+                        required=False)
+    parser.add_argument("--retry-max-elapsed", dest="retry_max_elapsed", default=None, type=float,
+                        help="Максимальное время повторов одного вызова PostgreSQL, ElasticSearch или Redis в секундах. "
+                             "По умолчанию вызов повторяется, пока не пройдёт.", required=False)
+    parser.add_argument("--breaker-threshold", dest="breaker_threshold", default=3, type=int,
+                        help="Количество ошибок подряд, после которого вызовы зависимости приостанавливаются.",
+                        required=False)
+    parser.add_argument("--breaker-reset-timeout", dest="breaker_reset_timeout", default=5, type=float,
+                        help="Пауза в секундах перед пробным вызовом недоступной зависимости.", required=False)
+    parser.add_argument("--full-reindex", dest="full_reindex", nargs='*', choices=tuple(BACKFILL_SOURCES),
+                        help="Перед инкрементальной работой построить заново указанные индексы (по умолчанию все): "
+                             "новая версия индекса заполняется с настройками для быстрой загрузки, затем на неё "
+                             "переключается алиас.", required=False)
+    parser.add_argument("--blue-green-reindex", dest="blue_green_reindex", nargs='*', choices=tuple(BACKFILL_SOURCES),
+                        help="Построить новые версии указанных индексов (по умолчанию всех) в фоне, не останавливая "
+                             "инкрементальную загрузку, и переключить на них алиасы. Только для --engine sync.",
+                        required=False)
+    parser.add_argument("--backfill-workers", dest="backfill_workers", default=1, type=int,
+                        help="Количество процессов для --full-reindex и --blue-green-reindex: пространство UUID "
+                             "исходной таблицы делится на столько диапазонов, и каждый процесс загружает свой со "
+                             "своими соединениями (до двух соединений PostgreSQL на процесс).", required=False)
+    parser.add_argument("--schemas-dir", dest="schemas_dir", default='.',
+                        help="Каталог со схемами индексов <index>.es.schema.json.", required=False)
+    parser.add_argument("--dead-letter-file", dest="dead_letter_file", default='dead_letters.ndjson',
+                        help="NDJSON файл для документов, которые ElasticSearch отклонил с ошибкой маппинга (400); "
+                             "такие документы пропускаются. Пустая строка — ошибка маппинга прерывает загрузку.",
+                        required=False)
+    parser.add_argument("--metrics-port", dest="metrics_port", default=0, type=int,
+                        help="Порт HTTP endpoint с метриками в формате Prometheus; 0 — не запускать.", required=False)
     args = parser.parse_args()
 
+    # Producers и фоновое перестроение индексов (--blue-green-reindex, которое заканчивается догоняющей загрузкой)
+    # занимают соединения общего пула. Если пул меньше, чем нужно producer и перестроению одновременно, они ждут
+    # соединений друг друга бесконечно.
+    producer_connections = connections_per_producer(args.catch_up)
+    reserved_connections = CONNECTIONS_PER_PRODUCER if args.blue_green_reindex is not None else 0
+    if args.engine == 'sync' and args.pg_pool_size < producer_connections + reserved_connections:
+        parser.error(f"--pg-pool-size must be at least {producer_connections + reserved_connections}: a producer "
+                     f"holds up to {producer_connections} connections"
+                     + (f" and --blue-green-reindex up to {reserved_connections}" if reserved_connections else ''))
+
     logger.info("Starting ETL runner.")
+    configure_retries(RetryPolicy(max_elapsed=args.retry_max_elapsed), args.breaker_threshold,
+                      args.breaker_reset_timeout)
+    if args.metrics_port:
+        serve_metrics(args.metrics_port)
+        logger.info("Serving Prometheus metrics on port {}", args.metrics_port)
 
-    redis = Redis(host=args.redis_host)
-    state = RedisState(redis_adapter=redis)
+    state = create_state(args)
 
     psycopg2.extras.register_uuid()
-
-
-    @dataclass(frozen=True)
-    class ETLProcessConfig:
-        table: str
-        postgres_url: str
-        elastic_host: str
-
-        state: State
-        film_id_function: Callable
-        get_film_id_args: Sequence
-        elastic_index: str = 'movies'
-
-        timestamp_field: str = 'updated_at'
-        pg_batch_size: int = 10000
-        es_batch_size: int = 10000
-
-        def run(self):
-            logger.debug(f"Running process for table: {self.table}")
-            get_updated_postgres_entries(
-                self.table,
-                self.postgres_url,
-                self.film_id_function(
-                    *self.get_film_id_args,
-                    denormalize_film_data(
-                        self.postgres_url,
-                        transform_movies_data(
-                            batcher(self.es_batch_size, load_to_elastic(self.elastic_host, self.elastic_index)))
-                    )
-                ),
-                self.state, self.elastic_index, self.pg_batch_size, self.timestamp_field
-            )
-
-
-    @dataclass(frozen=True)
-    class PersonsETLProcessConfig(ETLProcessConfig):
-        elastic_index: str = 'persons'
-
-        def run(self):
-            logger.debug(f"Running process for table: {self.table}")
-            get_updated_postgres_entries(
-                self.table,
-                self.postgres_url,
-                self.film_id_function(
-                    *self.get_film_id_args,
-                    denormalize_person_data(
-                        self.postgres_url,
-                        transform_persons_data(
-                            batcher(self.es_batch_size,
-                                    load_to_elastic(self.elastic_host,
-                                                    self.elastic_index))
-                        )
-                    )
-                ),
-                self.state,
-                self.elastic_index,
-                self.pg_batch_size,
-                self.timestamp_field
-            )
-
-
-    @dataclass(frozen=True)
-    class GenresETLProcessConfig(ETLProcessConfig):
-        elastic_index: str = 'genres'
-
-        def run(self):
-            logger.debug(f"Running process for table: {self.table}")
-            get_updated_postgres_entries(
-                self.table,
-                self.postgres_url,
-                self.film_id_function(
-                    *self.get_film_id_args,
-                    denormalize_genres_data(
-                        self.postgres_url,
-                        transform_genres_data(
-                            batcher(self.es_batch_size,
-                                    load_to_elastic(self.elastic_host,
-                                                    self.elastic_index))
-                        )
-                    )
-                ),
-                self.state,
-                self.elastic_index,
-                self.pg_batch_size,
-                self.timestamp_field
-            )
-
-
-    etl_processes = [
-        ETLProcessConfig(table="public.film_work", postgres_url=args.postgres_url, elastic_host=args.elastic_host,
-                         film_id_function=table_with_fwkey_get_film_ids, get_film_id_args=('id',), state=state,
-                         pg_batch_size=args.pg_batch_size, es_batch_size=args.es_batch_size),
-
-        ETLProcessConfig(table="public.person", postgres_url=args.postgres_url, elastic_host=args.elastic_host,
-                         film_id_function=get_table_ids_by_join,
-                         get_film_id_args=(args.postgres_url, "film_work_id", "public.person_film_work", "person_id"),
-                         state=state, pg_batch_size=args.pg_batch_size, es_batch_size=args.es_batch_size),
-
-        ETLProcessConfig(table="public.genre", postgres_url=args.postgres_url, elastic_host=args.elastic_host,
-                         film_id_function=get_table_ids_by_join,
-                         get_film_id_args=(args.postgres_url, "film_work_id", "public.genre_film_work", "genre_id"),
-                         state=state, pg_batch_size=args.pg_batch_size, es_batch_size=args.es_batch_size),
-
-        ETLProcessConfig(table="public.person_film_work", postgres_url=args.postgres_url,
-                         elastic_host=args.elastic_host, film_id_function=table_with_fwkey_get_film_ids,
-                         get_film_id_args=("film_work_id",), timestamp_field='created_at',
-                         state=state, pg_batch_size=args.pg_batch_size, es_batch_size=args.es_batch_size),
-
-        ETLProcessConfig(table="public.genre_film_work", postgres_url=args.postgres_url,
-                         elastic_host=args.elastic_host, film_id_function=table_with_fwkey_get_film_ids,
-                         get_film_id_args=("film_work_id",), timestamp_field='created_at',
-                         state=state, pg_batch_size=args.pg_batch_size, es_batch_size=args.es_batch_size),
-
-        PersonsETLProcessConfig(table="public.person", postgres_url=args.postgres_url, elastic_host=args.elastic_host,
-                                film_id_function=get_table_ids_by_join,
-                                get_film_id_args=(
-                                    args.postgres_url, "person_id", "public.person_film_work", "person_id"),
-                                timestamp_field='created_at', state=state, pg_batch_size=args.pg_batch_size,
-                                es_batch_size=args.es_batch_size),
-
-        GenresETLProcessConfig(table="public.genre", postgres_url=args.postgres_url, elastic_host=args.elastic_host,
-                               film_id_function=get_table_ids_by_join,
-                               get_film_id_args=(
-                                   args.postgres_url, "genre_id", "public.genre_film_work", "genre_id"),
-                               timestamp_field='created_at', state=state, pg_batch_size=args.pg_batch_size,
-                               es_batch_size=args.es_batch_size),
-    ]
-
-    while True:
-        logger.debug("Checking if any updated entries.")
-        for etl_process in etl_processes:
-            etl_process.run()
-
-        time.sleep(args.poll_period)
+    postgres = PostgresClient(args.postgres_url, max_connections=args.pg_pool_size,
+                              health_check_period=args.pg_health_check_period)
+    elastic, bulk_settings = create_elastic(args)
+
+
+    transform_executor = ProcessPoolExecutor(args.transform_workers) if args.transform_workers > 1 else None
+    index_aliases = IndexAliases(elastic)
+
+    etl_processes = build_etl_processes(
+        postgres, elastic, state,
+        pg_batch_size=args.pg_batch_size, es_batch_size=args.es_batch_size, bulk_settings=bulk_settings,
+        catch_up=args.catch_up, itersize=args.pg_itersize,
+        transform_executor=transform_executor, transform_workers=args.transform_workers,
+        validate_documents=args.validate_documents, documents_in_postgres=args.documents_in_postgres,
+        index_aliases=index_aliases, fingerprints=FingerprintStore(state) if args.skip_unchanged else None,
+        index_locks={index: threading.Lock() for index in BACKFILL_SOURCES} if args.scheduler else None,
+        partial_renames=args.partial_renames,
+    )
+    if args.partial_renames:
+        put_rename_script(elastic)
+    if isinstance(state, RedisState):
+        # Состояние всех producers читается одной командой, дальше — из локальной копии.
+        state.preload(key for process in etl_processes
+                      for key in checkpoint_keys(process.table, process.elastic_index))
+
+    range_worker = partial(backfill_key_range, args)
+    if args.full_reindex is not None:
+        for index in args.full_reindex or BACKFILL_SOURCES:
+            full_reindex(index, [process for process in etl_processes if process.elastic_index == index],
+                         postgres, elastic, state, index_aliases, args.schemas_dir, args.pg_batch_size,
+                         workers=args.backfill_workers, range_worker=range_worker)
+
+    if args.blue_green_reindex is not None:
+        # Индексы перестраиваются по очереди в фоновом потоке, пока основной цикл продолжает загрузку изменений.
+        @logger.catch
+        def rebuild_indices():
+            for index in args.blue_green_reindex or BACKFILL_SOURCES:
+                blue_green_reindex(index, [process for process in etl_processes if process.elastic_index == index],
+                                   postgres, elastic, state, index_aliases, args.schemas_dir,
+                                   args.pg_batch_size, workers=args.backfill_workers, range_worker=range_worker)
+
+        threading.Thread(target=rebuild_indices, name='blue-green-reindex', daemon=True).start()
+
+    if args.engine == 'async':
+        from postgres_to_es.async_engine import run_async
+
+        try:
+            asyncio.run(run_async(etl_processes, args.postgres_url, args.elastic_host, args.poll_period,
+                                  pg_pool_size=args.pg_pool_size, queue_size=args.async_queue_size))
+        finally:
+            if transform_executor:
+                transform_executor.shutdown()
+            postgres.close()
+            elastic.close()
+            if isinstance(state, SQLiteState):
+                state.close()
+        sys.exit()
+
+    index_processes = etl_processes
+    if args.coalesce:
+        etl_processes = coalesce_etl_processes(etl_processes)
+    if args.tombstones:
+        etl_processes = [*etl_processes, TombstoneETLProcess(postgres, state, index_processes,
+                                                             pg_batch_size=args.pg_batch_size)]
+
+    if args.change_source == 'replication':
+        source = ReplicationSource(args.postgres_url, state, slot_name=args.replication_slot)
+        listener = None
+    else:
+        source = None
+        listener = ChangeListener(args.postgres_url) if args.listen else None
+
+    try:
+        if source:
+            while True:
+                try:
+                    run_replication(source, etl_processes, args.pg_batch_size, args.poll_period)
+                except Exception:
+                    # LSN не подтверждён, батч будет прочитан заново после переподключения.
+                    logger.opt(exception=True).error("Replication batch failed.")
+                    source.close()
+                    time.sleep(args.poll_period)
+        elif args.scheduler:
+            requested = args.scheduler_workers or len(etl_processes)
+            workers = min(requested, (args.pg_pool_size - reserved_connections) // producer_connections)
+            if workers < requested:
+                logger.warning("PostgreSQL pool of {} connections lets only {} of {} producers run at once, "
+                               "use --pg-pool-size {} to run all of them.", args.pg_pool_size, workers, requested,
+                               requested * producer_connections + reserved_connections)
+            default_schedule = ProducerSchedule(args.poll_period, args.max_poll_period)
+            scheduler = ProducerScheduler(etl_processes, parse_schedules(args.producer_schedules, default_schedule),
+                                          default_schedule, listener, args.fallback_poll_period, workers)
+            scheduler.run()
+        else:
+            run_polling(etl_processes, listener, args.poll_period, args.fallback_poll_period)
+    finally:
+        if source:
+            source.close()
+        if listener:
+            listener.close()
+        if transform_executor:
+            transform_executor.shutdown()
+        postgres.close()
+        elastic.close()
+        if isinstance(state, SQLiteState):
+            state.close()
@@ -0,0 +1,68 @@
+"""Документы, которые ElasticSearch отклонил без возможности успешного повтора.
+
+Например, документ с полем, которого нет в схеме индекса (dynamic: strict), будет отклонён с ошибкой маппинга при
+каждой попытке. Такие документы записываются в NDJSON файл вместе с id исходной записи и ошибкой, а загрузка
+продолжается, и producer сдвигает состояние дальше. После исправления схемы или данных документы можно загрузить
+заново, обновив исходные записи в PostgreSQL.
+"""
+import json
+import threading
+from collections import defaultdict
+from datetime import datetime, timezone
+from typing import Dict, Iterable, Set, Union
+
+from loguru import logger
+
+from postgres_to_es.metrics import DEAD_LETTERS
+
+
+class DeadLetterFile:
+    """Дописывает отклонённые документы в NDJSON файл: одна строка на документ. Потокобезопасен.
+
+    :param path: Путь к файлу.
+    :param track_failed: Запоминать id отклонённых документов, пока их не заберёт take_failed. Нужно, чтобы
+        FingerprintStore не сохранял хеши документов, которых нет в индексе.
+    """
+
+    def __init__(self, path: str, track_failed: bool = False):
+        self.path = path
+        self.track_failed = track_failed
+        self._failed: Dict[str, Set[str]] = defaultdict(set)
+        self._lock = threading.Lock()
+
+    def write(self, index: str, target: str, doc_id: str, source: Union[str, dict], status: int, error) -> None:
+        """Записывает отклонённый документ.
+
+        :param index: Индекс или алиас, в который загружался документ.
+        :param target: Индекс, который отклонил документ.
+        :param source: Документ: JSON строка или словарь.
+        :param error: Ошибка из ответа bulk запроса.
+        """
+        record = {
+            'failed_at': datetime.now(timezone.utc).isoformat(),
+            'index': index,
+            'target': target,
+            'id': doc_id,
+            'status': status,
+            'error': error,
+            'document': json.loads(source) if isinstance(source, str) else source,
+        }
+        line = json.dumps(record, ensure_ascii=False, default=str)
+        with self._lock:
+            with open(self.path, 'a', encoding='utf-8') as file:
+                file.write(line + '\n')
+            if self.track_failed:
+                self._failed[index].add(doc_id)
+        DEAD_LETTERS.labels(index).inc()
+        logger.error("Document {} was rejected by {} with status {} and written to {}: {}",
+                     doc_id, target, status, self.path, error)
+
+    def take_failed(self, index: str, doc_ids: Iterable[str]) -> Set[str]:
+        """Возвращает id из doc_ids, которые были отклонены при загрузке в index, и забывает их."""
+        with self._lock:
+            failed = self._failed.get(index)
+            if not failed:
+                return set()
+            taken = failed.intersection(doc_ids)
+            failed -= taken
+            return taken
@@ -0,0 +1,457 @@
+import re
+import threading
+import time
+from dataclasses import dataclass
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Sequence, Tuple, Union
+
+from elasticsearch import ConnectionError as ElasticConnectionError, Elasticsearch, TransportError, helpers
+from loguru import logger
+
+from postgres_to_es.adaptive import AdaptiveBatchSize
+from postgres_to_es.deadletter import DeadLetterFile
+from postgres_to_es.metrics import (BULK_BYTES, BULK_DOCUMENTS, BULK_ITEM_RETRIES, BULK_REJECTIONS, BULK_REQUESTS,
+                                    BULK_SECONDS)
+from postgres_to_es.retry import RetryPolicy, retry
+
+BULK_MODES = ('bulk', 'streaming', 'parallel')
+
+# Повторы документов, которые кластер отклонил временно (429 — переполнена очередь записи, 5xx — шард недоступен).
+# Повторно отправляются только отклонённые документы, а не весь батч.
+ITEM_RETRY_POLICY = RetryPolicy(start_sleep_time=0.5, max_attempts=5)
+# Наибольшее количество документов в очереди повторов одного вызова bulk_index. Если отклонено больше, кластер
+# перегружен целиком, и вызов повторяется как обычно, с паузами и breaker.
+MAX_RETRY_QUEUE_SIZE = 10000
+
+
+@dataclass(frozen=True)
+class BulkSettings:
+    """Настройки загрузки документов в ElasticSearch.
+
+    :param mode: bulk — последовательные запросы helpers.bulk, streaming — helpers.streaming_bulk,
+        parallel — helpers.parallel_bulk с thread_count потоками.
+    :param chunk_size: Количество документов в одном bulk запросе.
+    :param thread_count: Количество потоков для режима parallel.
+    :param queue_size: Максимальное количество чанков, ожидающих отправки в режиме parallel.
+    :param batch_size: Если задан, размер чанка в документах и байтах берётся из него, а не из chunk_size.
+    :param dead_letters: Файл для документов, отклонённых с ошибкой маппинга; None — такая ошибка прерывает загрузку.
+    """
+    mode: str = 'bulk'
+    chunk_size: int = 500
+    thread_count: int = 4
+    queue_size: int = 4
+    batch_size: Optional[AdaptiveBatchSize] = None
+    dead_letters: Optional[DeadLetterFile] = None
+
+    def chunk_args(self) -> dict:
+        """Параметры размера чанка для helpers."""
+        if self.batch_size is None:
+            return {'chunk_size': self.chunk_size}
+        return {'chunk_size': self.batch_size.chunk_docs, 'max_chunk_bytes': self.batch_size.chunk_bytes}
+
+
+class MeteredElasticsearch(Elasticsearch):
+    """Клиент ElasticSearch, который учитывает в метриках размер, время и результаты bulk запросов.
+
+    Все helpers (bulk, streaming_bulk, parallel_bulk) отправляют чанки через метод bulk клиента. Если задан
+    batch_size, результат каждого запроса передаётся ему для подстройки размера чанков.
+    """
+    batch_size: Optional[AdaptiveBatchSize] = None
+
+    def bulk(self, body, *args, **kwargs):
+        size = len(body) if isinstance(body, bytes) else len(str(body).encode())
+        BULK_REQUESTS.inc()
+        BULK_BYTES.inc(size)
+        started = time.perf_counter()
+        try:
+            response = super().bulk(body, *args, **kwargs)
+        except TransportError as error:
+            if error.status_code == 429:
+                BULK_REJECTIONS.inc()
+                if self.batch_size is not None:
+                    self.batch_size.observe(time.perf_counter() - started, 0, size, rejected=True)
+            raise
+        seconds = time.perf_counter() - started
+        BULK_SECONDS.observe(seconds)
+
+        items = response.get('items', ())
+        rejected = False
+        for item in items:
+            op_type, result = next(iter(item.items()))
+            BULK_DOCUMENTS.labels(result.get('_index', ''), 'error' if 'error' in result else op_type).inc()
+            rejected = rejected or result.get('status') == 429
+        if rejected:
+            BULK_REJECTIONS.inc()
+        if self.batch_size is not None:
+            self.batch_size.observe(seconds, len(items), size, rejected)
+        return response
+
+
+def create_elastic_client(hosts, max_connections: int = 10,
+                          batch_size: Optional[AdaptiveBatchSize] = None) -> Elasticsearch:
+    """Создаёт клиент ElasticSearch, который переиспользуется всё время работы демона.
+
+    Клиент держит пул keep-alive соединений размером max_connections к каждому узлу, поэтому он должен быть не меньше
+    количества потоков параллельной загрузки.
+
+    :param batch_size: Размеры чанков, которые подстраиваются под результаты bulk запросов этого клиента.
+    """
+    client = MeteredElasticsearch(hosts=hosts, maxsize=max_connections, retry_on_timeout=True)
+    client.batch_size = batch_size
+    return client
+
+
+class RawDocument(NamedTuple):
+    """Документ, уже сериализованный в JSON (например, собранный в PostgreSQL).
+
+    Текст source передаётся в тело bulk запроса без разбора и повторной сериализации.
+    """
+    id: str
+    source: str
+
+
+Document = Union[dict, RawDocument]
+
+
+def document_id(doc: Document) -> str:
+    return doc.id if isinstance(doc, RawDocument) else str(doc['id'])
+
+
+def index_action(index: str, doc: Document) -> dict:
+    if isinstance(doc, RawDocument):
+        # Строковый _source сериализатор клиента пишет в NDJSON как есть.
+        return {'_index': index, '_id': doc.id, '_source': doc.source}
+    return {
+        '_index': index,
+        '_id': doc['id'],
+        '_source': doc
+    }
+
+
+def generate_index_actions(index: str, docs: Iterable[Document]) -> Iterator[dict]:
+    for doc in docs:
+        yield index_action(index, doc)
+
+
+def generate_multi_index_actions(indices: Sequence[str], docs: List[Document]) -> Iterator[dict]:
+    for index in indices:
+        yield from generate_index_actions(index, docs)
+
+
+def send_actions(es: Elasticsearch, actions: Iterable[dict], settings: BulkSettings) -> Tuple[int, List[dict]]:
+    """Отправляет операции выбранным в settings способом.
+
+    :return: Количество успешных операций и ответы на операции, которые кластер отклонил.
+    """
+    if settings.mode == 'bulk':
+        return helpers.bulk(es, actions, raise_on_error=False, **settings.chunk_args())
+    if settings.mode == 'parallel':
+        results = helpers.parallel_bulk(es, actions, thread_count=settings.thread_count,
+                                        queue_size=settings.queue_size, raise_on_error=False,
+                                        **settings.chunk_args())
+    else:
+        results = helpers.streaming_bulk(es, actions, raise_on_error=False, **settings.chunk_args())
+
+    count = 0
+    errors = []
+    for ok, item in results:
+        if ok:
+            count += 1
+        else:
+            errors.append(item)
+    return count, errors
+
+
+def is_retryable(status: int) -> bool:
+    """Отклонён ли документ временно: кластер перегружен или шард недоступен."""
+    return status == 429 or status >= 500
+
+
+class BulkRejectedError(helpers.BulkIndexError):
+    """Кластер всё ещё временно отклоняет документы (429, 5xx) после всех повторов отдельных документов."""
+
+
+def is_request_error(error: BaseException) -> bool:
+    """Ошибка в самом запросе (4xx, кроме 429): повтор вернёт ту же ошибку."""
+    return (isinstance(error, TransportError) and not isinstance(error, ElasticConnectionError)
+            and isinstance(error.status_code, int) and not is_retryable(error.status_code))
+
+
+# Ошибки ElasticSearch, после которых запрос повторяется (кроме is_request_error).
+ELASTIC_ERRORS = (TransportError, BulkRejectedError)
+
+
+def is_dead_letter(result: dict, settings: BulkSettings) -> bool:
+    """Нужно ли записать документ в файл отклонённых: ошибка 400 повторится при каждой попытке загрузки."""
+    return result.get('status') == 400 and settings.dead_letters is not None
+
+
+def rejected_for_retry(index: str, failed: List[dict], docs_by_id: Dict[str, Document],
+                       settings: BulkSettings) -> List[Tuple[str, str]]:
+    """Разбирает операции bulk запроса, которые кластер отклонил.
+
+    Документы, отклонённые с кодом 400, записываются в settings.dead_letters. Если среди отклонённых есть операции
+    с другой ошибкой, которая не исправится повтором, бросается BulkIndexError.
+
+    :return: Индексы и id документов, отклонённых временно (429, 5xx), которые нужно отправить повторно.
+    """
+    results = [next(iter(item.values())) for item in failed]
+    if any(not is_retryable(result.get('status', 0)) and not is_dead_letter(result, settings)
+           for result in results):
+        raise helpers.BulkIndexError(f"{len(failed)} document(s) failed to index.", failed)
+
+    retry_queue: List[Tuple[str, str]] = []
+    for result in results:
+        if is_retryable(result['status']):
+            retry_queue.append((result['_index'], result['_id']))
+            continue
+        doc = docs_by_id[result['_id']]
+        settings.dead_letters.write(index, result['_index'], result['_id'],
+                                    doc.source if isinstance(doc, RawDocument) else doc,
+                                    result['status'], result.get('error'))
+    return retry_queue
+
+
+def item_retry_delay(index: str, retry_queue: List[Tuple[str, str]], attempts: int, failed: List[dict]) -> float:
+    """Пауза перед attempts-м повтором отклонённых документов; BulkRejectedError, если повторы исчерпаны."""
+    if ITEM_RETRY_POLICY.exhausted(attempts, 0) or len(retry_queue) > MAX_RETRY_QUEUE_SIZE:
+        raise BulkRejectedError(
+            f"{len(retry_queue)} document(s) were still rejected after {attempts} attempt(s).", failed)
+    BULK_ITEM_RETRIES.labels(index).inc(len(retry_queue))
+    delay = ITEM_RETRY_POLICY.delay(attempts)
+    logger.warning("{} document(s) of {} were rejected, retrying them in {:.2f} seconds",
+                   len(retry_queue), index, delay)
+    return delay
+
+
+@retry('elastic', exceptions=ELASTIC_ERRORS, giveup=is_request_error)
+def bulk_index(es: Elasticsearch, index: str, docs: List[Document], settings: BulkSettings,
+               aliases: 'IndexAliases' = None) -> int:
+    """Индексирует документы в ElasticSearch выбранным в settings способом и возвращает количество записанных.
+
+    Если передан aliases, документы пишутся во все индексы, в которые сейчас идёт запись алиаса index.
+
+    Результат проверяется для каждого документа. Документы, отклонённые с кодом 429 или 5xx, отправляются повторно
+    из очереди повторов размером до MAX_RETRY_QUEUE_SIZE. Документы, отклонённые с кодом 400 (не подходят под
+    схему индекса), записываются в settings.dead_letters и пропускаются. Остальные ошибки (индекс не найден или
+    закрыт для записи) не исправятся повтором и прерывают вызов с BulkIndexError. Переполнение очереди или
+    исчерпание повторов прерывает вызов с BulkRejectedError; тогда вызов повторяется целиком.
+    """
+    indices = aliases.write_targets(index) if aliases else [index]
+    actions: Iterable[dict] = generate_multi_index_actions(indices, docs)
+    docs_by_id: Dict[str, Document] = {}
+    count = 0
+    attempts = 0
+    while True:
+        indexed, failed = send_actions(es, actions, settings)
+        count += indexed
+        if not failed:
+            break
+
+        if not docs_by_id:
+            docs_by_id = {document_id(doc): doc for doc in docs}
+        retry_queue = rejected_for_retry(index, failed, docs_by_id, settings)
+        if not retry_queue:
+            break
+
+        attempts += 1
+        time.sleep(item_retry_delay(index, retry_queue, attempts, failed))
+        actions = [index_action(target, docs_by_id[doc_id]) for target, doc_id in retry_queue]
+
+    logger.debug("Indexed {} documents into {} in {} mode", count, index, settings.mode)
+    return count
+
+
+@retry('elastic', exceptions=ELASTIC_ERRORS, giveup=is_request_error)
+def bulk_delete(es: Elasticsearch, index: str, ids: List[str], settings: BulkSettings,
+                aliases: 'IndexAliases' = None) -> int:
+    """Удаляет документы по id и возвращает количество удалённых. Отсутствующие в индексе документы пропускаются."""
+    indices = aliases.write_targets(index) if aliases else [index]
+    actions = ({'_op_type': 'delete', '_index': target, '_id': doc_id} for target in indices for doc_id in ids)
+    deleted = 0
+    errors = []
+    for ok, item in helpers.streaming_bulk(es, actions, raise_on_error=False, **settings.chunk_args()):
+        if ok:
+            deleted += 1
+        elif item['delete'].get('status') != 404:
+            errors.append(item)
+    if errors:
+        error = (BulkRejectedError if all(is_retryable(item['delete'].get('status', 0)) for item in errors)
+                 else helpers.BulkIndexError)
+        raise error(f"{len(errors)} document(s) failed to delete.", errors)
+    logger.debug("Deleted {} documents from {}", deleted, index)
+    return deleted
+
+
+# Сохранённый painless скрипт, который переименовывает персоны или жанры во вложенных списках документов фильмов
+# и заново собирает соответствующие списки имён (<field>_names).
+RENAME_SCRIPT_ID = 'etl_rename_references'
+RENAME_SCRIPT = """
+    boolean changed = false;
+    for (String field : params.fields) {
+        List objects = ctx._source[field];
+        if (objects == null) {
+            continue;
+        }
+        List names = new ArrayList();
+        for (Map object : objects) {
+            String name = params.names[object.id];
+            if (name != null && name != object.name) {
+                object.name = name;
+                changed = true;
+            }
+            names.add(object.name);
+        }
+        ctx._source[field + '_names'] = names;
+    }
+    if (!changed) {
+        ctx.op = 'noop';
+    }
+"""
+
+
+def put_rename_script(es: Elasticsearch) -> None:
+    es.put_script(id=RENAME_SCRIPT_ID, body={'script': {'lang': 'painless', 'source': RENAME_SCRIPT}})
+
+
+@retry('elastic', exceptions=ELASTIC_ERRORS, giveup=is_request_error)
+def rename_references(es: Elasticsearch, index: str, fields: Sequence[str], names: Dict[str, str],
+                      aliases: 'IndexAliases' = None) -> Tuple[int, int]:
+    """Частично обновляет документы, которые ссылаются на переименованные объекты.
+
+    Перед обновлением индексы обновляются (refresh), чтобы запрос нашёл и недавно загруженные документы, в том числе
+    в версии индекса, которая строится с выключенным refresh_interval. Документы, изменённые во время обновления,
+    пропускаются (conflicts=proceed), и их количество возвращается вызывающему.
+
+    :param fields: Вложенные поля документа со списками {id, name}, например actors, writers, directors.
+    :param names: Новые имена по id объектов.
+    :return: Количество обновлённых документов и документов, пропущенных из-за конфликта версий.
+    """
+    indices = ','.join(aliases.write_targets(index) if aliases else [index])
+    ids = list(names)
+    query = {'bool': {
+        'should': [{'nested': {'path': field, 'query': {'terms': {f'{field}.id': ids}}}} for field in fields],
+        'minimum_should_match': 1,
+    }}
+    script = {'id': RENAME_SCRIPT_ID, 'params': {'fields': list(fields), 'names': names}}
+    es.indices.refresh(index=indices)
+    response = es.update_by_query(index=indices, body={'query': query, 'script': script}, conflicts='proceed',
+                                  request_timeout=600)
+    logger.debug("Renamed {} references in {} documents of {}", len(ids), response['updated'], index)
+    return response['updated'], response['version_conflicts']
+
+
+# Настройки индекса на время первичной загрузки: без обновления поиска, реплик и fsync транслога на каждый запрос.
+BULK_LOAD_SETTINGS = {
+    'refresh_interval': '-1',
+    'number_of_replicas': 0,
+    'translog.durability': 'async',
+}
+
+
+def _restore_settings(schema: dict) -> dict:
+    """Рабочие настройки индекса из схемы, которые меняются на время быстрой загрузки."""
+    settings = schema.get('settings', {})
+    return {
+        'refresh_interval': settings.get('refresh_interval', '1s'),
+        'number_of_replicas': settings.get('number_of_replicas', 1),
+        'translog.durability': settings.get('translog.durability', 'request'),
+    }
+
+
+def create_index_for_bulk_load(es: Elasticsearch, index: str, schema: dict) -> dict:
+    """Пересоздаёт индекс по схеме с настройками для быстрой загрузки.
+
+    :return: Настройки индекса, которые нужно вернуть после загрузки.
+    """
+    body = {**schema, 'settings': {**schema.get('settings', {}), **BULK_LOAD_SETTINGS}}
+
+    es.indices.delete(index=index, ignore=[404])
+    es.indices.create(index=index, body=body)
+    logger.info("Created index {} for bulk load", index)
+    return _restore_settings(schema)
+
+
+def resume_bulk_load(es: Elasticsearch, index: str, schema: dict) -> dict:
+    """Возвращает настройки для быстрой загрузки индексу, загрузка в который была прервана.
+
+    :return: Настройки индекса, которые нужно вернуть после загрузки.
+    """
+    es.indices.put_settings(index=index, body={'index': BULK_LOAD_SETTINGS})
+    logger.info("Resumed bulk load into index {}", index)
+    return _restore_settings(schema)
+
+
+def finish_bulk_load(es: Elasticsearch, index: str, restore_settings: dict) -> None:
+    """Возвращает индексу рабочие настройки и объединяет сегменты после загрузки."""
+    es.indices.put_settings(index=index, body={'index': restore_settings})
+    es.indices.refresh(index=index)
+    es.indices.forcemerge(index=index, max_num_segments=1, request_timeout=3600)
+    logger.info("Restored settings and force merged index {}", index)
+
+
+class IndexAliases:
+    """Версионированные индексы (movies_v7) за алиасами (movies).
+
+    Демон пишет и search_api читает по имени алиаса. Пока строится новая версия индекса, запись идёт и в алиас, и
+    в новую версию (dual write), после чего алиас атомарно переключается на новую версию.
+    """
+
+    def __init__(self, es: Elasticsearch):
+        self.es = es
+        self._building: Dict[str, str] = {}
+        self._lock = threading.Lock()
+
+    def write_targets(self, alias: str) -> List[str]:
+        """Индексы, в которые нужно записать документы алиаса."""
+        with self._lock:
+            building = self._building.get(alias)
+        return [alias, building] if building else [alias]
+
+    def begin_dual_write(self, alias: str, index: str) -> None:
+        with self._lock:
+            self._building[alias] = index
+        logger.info("Dual writing {} to {}", alias, index)
+
+    def end_dual_write(self, alias: str) -> None:
+        with self._lock:
+            self._building.pop(alias, None)
+
+    def _versions(self, alias: str) -> Dict[int, Tuple[str, bool]]:
+        """Версии индекса алиаса: имя версии и указывает ли на неё алиас по номеру версии."""
+        versions = {}
+        for name, info in self.es.indices.get(index=f'{alias}_v*').items():
+            if match := re.fullmatch(rf'{re.escape(alias)}_v(\d+)', name):
+                versions[int(match.group(1))] = (name, alias in info.get('aliases', {}))
+        return versions
+
+    def next_version(self, alias: str) -> str:
+        """Имя следующей версии индекса алиаса: <alias>_v<n+1>."""
+        return f'{alias}_v{max(self._versions(alias), default=0) + 1}'
+
+    def unfinished_version(self, alias: str) -> Optional[str]:
+        """Самая новая версия индекса, если она новее версий за алиасом: её построение не дошло до переключения."""
+        versions = self._versions(alias)
+        current = max((number for number, (_, aliased) in versions.items() if aliased), default=0)
+        newest = max(versions, default=0)
+        return versions[newest][0] if newest > current else None
+
+    def swap(self, alias: str, index: str) -> None:
+        """Атомарно переключает алиас на index.
+
+        Если раньше индекс с именем алиаса был обычным индексом, он удаляется в том же запросе.
+        """
+        actions = [{'add': {'index': index, 'alias': alias}}]
+        if self.es.indices.exists_alias(name=alias):
+            actions += [{'remove': {'index': old_index, 'alias': alias}}
+                        for old_index in self.es.indices.get_alias(name=alias) if old_index != index]
+        elif self.es.indices.exists(index=alias):
+            actions.append({'remove_index': {'index': alias}})
+        self.es.indices.update_aliases(body={'actions': actions})
+        logger.info("Alias {} now points to {}", alias, index)
+
+
+def warm_up_index(es: Elasticsearch, index: str, queries: Sequence[dict]) -> None:
+    """Выполняет на индексе несколько запросов, чтобы прогреть кэши до переключения на него алиаса."""
+    for query in queries:
+        es.search(index=index, body=query, request_cache=True)
+    logger.info("Warmed up index {} with {} queries", index, len(queries))
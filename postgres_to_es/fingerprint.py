@@ -0,0 +1,64 @@
+import hashlib
+import json
+from typing import Dict, List, Tuple
+
+from loguru import logger
+
+from postgres_to_es.elastic import Document, RawDocument, document_id
+from postgres_to_es.metrics import DOCUMENTS_SKIPPED, DOCUMENTS_WRITTEN
+from postgres_to_es.state import State
+
+
+def document_fingerprint(doc: Document) -> str:
+    """Короткий хеш сериализованного документа."""
+    if isinstance(doc, RawDocument):
+        data = doc.source.encode()
+    else:
+        data = json.dumps(doc, sort_keys=True, ensure_ascii=False, default=str).encode()
+    return hashlib.blake2b(data, digest_size=12).hexdigest()
+
+
+class FingerprintStore:
+    """Хеши последних загруженных в индекс версий документов.
+
+    Хранятся в State словарём fingerprint.<index> с полем на каждый id документа: в Redis — одним hash на индекс,
+    в SQLite — строками одной таблицы. Документ, хеш которого совпадает с сохраненным, уже лежит в индексе в том же
+    виде, и его повторная индексация ничего не меняет. Хеш сохраняется только после успешной загрузки документа.
+    Если индекс пересоздаётся в обход демона, словарь его хешей нужно удалить из State.
+    """
+
+    def __init__(self, state: State):
+        self.state = state
+
+    @staticmethod
+    def name(index: str) -> str:
+        return f'fingerprint.{index}'
+
+    def changed(self, index: str, docs: List[Document]) -> Tuple[List[Document], Dict[str, str]]:
+        """Отбирает документы, которые отличаются от загруженных ранее.
+
+        :return: Изменившиеся документы и их хеши по id, которые нужно сохранить после загрузки.
+        """
+        doc_ids = [document_id(doc) for doc in docs]
+        stored = self.state.state_get_fields(self.name(index), doc_ids)
+        changed_docs = []
+        fingerprints = {}
+        for doc, doc_id in zip(docs, doc_ids):
+            fingerprint = document_fingerprint(doc)
+            if stored[doc_id] != fingerprint:
+                changed_docs.append(doc)
+                fingerprints[doc_id] = fingerprint
+
+        DOCUMENTS_WRITTEN.labels(index).inc(len(changed_docs))
+        DOCUMENTS_SKIPPED.labels(index).inc(len(docs) - len(changed_docs))
+        if len(changed_docs) < len(docs):
+            logger.info("Skipped {} unchanged documents of {} for index {}",
+                        len(docs) - len(changed_docs), len(docs), index)
+        return changed_docs, fingerprints
+
+    def save(self, index: str, fingerprints: Dict[str, str]) -> None:
+        self.state.state_set_fields(self.name(index), fingerprints)
+
+    def forget(self, index: str, doc_ids: List[str]) -> None:
+        """Удаляет хеши документов, удалённых из индекса или изменённых в обход конвейера загрузки."""
+        self.state.state_delete_fields(self.name(index), [str(doc_id) for doc_id in doc_ids])
@@ -0,0 +1,72 @@
+"""Метрики ETL демона в формате Prometheus.
+
+Метрики собираются всегда, HTTP endpoint для их чтения запускается флагом --metrics-port.
+"""
+import time
+from datetime import datetime
+from typing import Dict, Tuple
+
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+
+ROWS_FETCHED = Counter('etl_rows_fetched_total', "Строки, прочитанные producers из таблиц.", ['table', 'index'])
+
+# source — таблица для этапов fetch и extract_ids, индекс для остальных этапов.
+STAGE_SECONDS = Histogram('etl_stage_seconds', "Время выполнения этапа конвейера для одного батча.",
+                          ['stage', 'source'],
+                          buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60))
+
+POSTGRES_QUERIES = Counter('etl_postgres_queries_total', "Запросы к PostgreSQL по имени запроса.", ['query'])
+
+BULK_REQUESTS = Counter('etl_bulk_requests_total', "Bulk запросы к ElasticSearch.")
+BULK_BYTES = Counter('etl_bulk_bytes_total', "Размер тел bulk запросов к ElasticSearch.")
+BULK_DOCUMENTS = Counter('etl_bulk_documents_total', "Операции bulk запросов по индексам и результату.",
+                         ['index', 'result'])
+
+BULK_SECONDS = Histogram('etl_bulk_request_seconds', "Время ответа на bulk запрос к ElasticSearch.",
+                         buckets=(0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30, 60))
+BULK_REJECTIONS = Counter('etl_bulk_rejections_total', "Bulk запросы, которые ElasticSearch целиком или частично "
+                                                       "отклонил с кодом 429.")
+BATCH_SIZE = Gauge('etl_batch_size', "Текущие размеры батчей: документов и байт в bulk запросе, строк в батче "
+                                     "PostgreSQL, средний размер документа.", ['kind'])
+BULK_ITEM_RETRIES = Counter('etl_bulk_item_retries_total', "Документы, повторно отправленные после временной ошибки "
+                                                           "(429, 5xx) в ответе bulk запроса.", ['index'])
+DEAD_LETTERS = Counter('etl_dead_letters_total', "Документы, которые ElasticSearch отклонил без возможности "
+                                                 "повтора и которые записаны в файл отклонённых документов.",
+                       ['index'])
+
+DOCUMENTS_SKIPPED = Counter('etl_documents_skipped_total', "Документы, не загруженные повторно, так как они не "
+                                                           "изменились.", ['index'])
+DOCUMENTS_WRITTEN = Counter('etl_documents_written_total', "Документы, отправленные на загрузку после проверки хеша, "
+                                                           "так как они изменились или ещё не загружались.", ['index'])
+
+RETRIES = Counter('etl_retries_total', "Неудачные попытки вызовов, после которых вызов повторяется.",
+                  ['call', 'dependency'])
+BREAKER_OPEN = Gauge('etl_circuit_breaker_open', "1, если breaker зависимости открыт или ждёт пробного вызова.",
+                     ['dependency'])
+
+BACKFILL_PROGRESS = Gauge('etl_backfill_progress_ratio', "Доля пространства ключей исходной таблицы, загруженная "
+                                                         "параллельной загрузкой новой версии индекса.", ['index'])
+
+CHECKPOINT_TIMESTAMP = Gauge('etl_checkpoint_timestamp_seconds', "Время (updated_at) последней обработанной записи.",
+                             ['table', 'index'])
+CHECKPOINT_LAG = Gauge('etl_checkpoint_lag_seconds', "Текущее время минус время последней обработанной записи.",
+                       ['table', 'index'])
+
+# Время последней обработанной записи по (таблица, индекс), из которого считается отставание.
+_checkpoint_timestamps: Dict[Tuple[str, str], float] = {}
+
+
+def record_checkpoint(table: str, index: str, updated_at: datetime) -> None:
+    """Запоминает время последней обработанной записи producer; отставание считается в момент чтения метрик."""
+    timestamp = updated_at.timestamp()
+    CHECKPOINT_TIMESTAMP.labels(table, index).set(timestamp)
+    key = (table, index)
+    tracked = key in _checkpoint_timestamps
+    _checkpoint_timestamps[key] = timestamp
+    if not tracked:
+        CHECKPOINT_LAG.labels(table, index).set_function(lambda: time.time() - _checkpoint_timestamps[key])
+
+
+def serve_metrics(port: int) -> None:
+    """Запускает HTTP endpoint /metrics в фоновом потоке."""
+    start_http_server(port)
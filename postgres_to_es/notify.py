@@ -0,0 +1,71 @@
+import select
+from typing import Optional, Set
+
+import psycopg2
+import psycopg2.extensions
+from loguru import logger
+
+from postgres_to_es.postgres import CONNECTION_ERRORS
+from postgres_to_es.retry import retry
+
+# Канал, в который пишут триггеры из notify_triggers.sql.
+NOTIFY_CHANNEL = 'etl_changes'
+
+
+class ChangeListener:
+    """Слушает уведомления PostgreSQL об изменениях в таблицах (LISTEN/NOTIFY).
+
+    Держит отдельное соединение в autocommit режиме и блокируется на его сокете, пока не придёт уведомление или не
+    истечёт таймаут.
+    """
+
+    def __init__(self, dsn: str, channel: str = NOTIFY_CHANNEL):
+        self.dsn = dsn
+        self.channel = channel
+        self._connection = None
+
+    @retry('postgres', exceptions=CONNECTION_ERRORS)
+    def connect(self) -> None:
+        """Открывает соединение и подписывается на канал."""
+        connection = psycopg2.connect(self.dsn)
+        connection.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        with connection.cursor() as cursor:
+            cursor.execute(f"LISTEN {self.channel}")
+        self._connection = connection
+        logger.info("Listening for changes on channel {}", self.channel)
+
+    def _drain_notifies(self) -> Set[str]:
+        self._connection.poll()
+        tables = {notify.payload for notify in self._connection.notifies}
+        self._connection.notifies.clear()
+        return tables
+
+    def wait(self, timeout: float) -> Optional[Set[str]]:
+        """Ждёт изменений не дольше timeout секунд.
+
+        :return: Множество изменившихся таблиц в формате schema.table или None, если нужно проверить все таблицы:
+            истёк таймаут (страховочный опрос) или соединение было переустановлено и уведомления могли потеряться.
+        """
+        if self._connection is None or self._connection.closed:
+            self.connect()
+            return None
+        try:
+            tables = self._drain_notifies()
+            if tables:
+                return tables
+            if select.select([self._connection], [], [], timeout) == ([], [], []):
+                logger.debug("No notifications in {} seconds, running fallback poll.", timeout)
+                return None
+            return self._drain_notifies()
+        except CONNECTION_ERRORS:
+            logger.opt(exception=True).warning("Lost LISTEN connection, reconnecting.")
+            self.close()
+            return None
+
+    def close(self) -> None:
+        if self._connection is not None:
+            try:
+                self._connection.close()
+            except CONNECTION_ERRORS:
+                pass
+            self._connection = None
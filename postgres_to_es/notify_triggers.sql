@@ -0,0 +1,28 @@
+-- Триггеры, которые уведомляют ETL демона (LISTEN etl_changes) об изменениях в таблицах.
+-- В payload передаётся имя таблицы вида schema.table, одинаковые уведомления в одной транзакции схлопываются.
+CREATE OR REPLACE FUNCTION etl_notify_change() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('etl_changes', TG_TABLE_SCHEMA || '.' || TG_TABLE_NAME);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS etl_notify_change ON film_work;
+CREATE TRIGGER etl_notify_change AFTER INSERT OR UPDATE OR DELETE ON film_work
+    FOR EACH STATEMENT EXECUTE FUNCTION etl_notify_change();
+
+DROP TRIGGER IF EXISTS etl_notify_change ON person;
+CREATE TRIGGER etl_notify_change AFTER INSERT OR UPDATE OR DELETE ON person
+    FOR EACH STATEMENT EXECUTE FUNCTION etl_notify_change();
+
+DROP TRIGGER IF EXISTS etl_notify_change ON genre;
+CREATE TRIGGER etl_notify_change AFTER INSERT OR UPDATE OR DELETE ON genre
+    FOR EACH STATEMENT EXECUTE FUNCTION etl_notify_change();
+
+DROP TRIGGER IF EXISTS etl_notify_change ON person_film_work;
+CREATE TRIGGER etl_notify_change AFTER INSERT OR UPDATE OR DELETE ON person_film_work
+    FOR EACH STATEMENT EXECUTE FUNCTION etl_notify_change();
+
+DROP TRIGGER IF EXISTS etl_notify_change ON genre_film_work;
+CREATE TRIGGER etl_notify_change AFTER INSERT OR UPDATE OR DELETE ON genre_film_work
+    FOR EACH STATEMENT EXECUTE FUNCTION etl_notify_change();
@@ -0,0 +1,222 @@
+import hashlib
+import re
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Any, Dict, Iterator, List, Sequence, Set, Tuple, Union
+
+import psycopg2
+import psycopg2.extras
+from psycopg2 import pool, sql
+from loguru import logger
+
+from postgres_to_es.metrics import POSTGRES_QUERIES
+from postgres_to_es.retry import retry
+
+# Ошибки, после которых соединение считается сломанным и не возвращается в пул.
+CONNECTION_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError)
+
+ParamName = str
+ParamType = str
+
+
+@dataclass(frozen=True)
+class PreparedQuery:
+    """Запрос, который один раз подготавливается (PREPARE) на каждом соединении пула.
+
+    Текст запроса использует позиционные параметры $1, $2, ... в порядке, заданном в params.
+    """
+    prefix: str
+    template: str
+    params: Sequence[Tuple[ParamName, ParamType]]
+
+    @property
+    def name(self) -> str:
+        """Имя подготовленного запроса, уникальное для текста запроса."""
+        digest = hashlib.md5(self.template.encode()).hexdigest()[:12]
+        return f"{self.prefix}_{digest}"
+
+    def prepare_statement(self) -> str:
+        if not self.params:
+            return f"PREPARE {self.name} AS {self.template}"
+        types = ', '.join(param_type for _, param_type in self.params)
+        return f"PREPARE {self.name} ({types}) AS {self.template}"
+
+    def execute_statement(self) -> str:
+        if not self.params:
+            return f"EXECUTE {self.name}"
+        placeholders = ', '.join(f"%s::{param_type}" for _, param_type in self.params)
+        return f"EXECUTE {self.name} ({placeholders})"
+
+    def execute_args(self, params: Dict[str, Any]) -> List[Any]:
+        return [params[param_name] for param_name, _ in self.params]
+
+    def pyformat_template(self) -> str:
+        """Текст запроса с именованными параметрами psycopg2 вместо $1, $2, ... для серверных курсоров."""
+
+        def placeholder(match: re.Match) -> str:
+            param_name, param_type = self.params[int(match.group(1)) - 1]
+            return f"%({param_name})s::{param_type}"
+
+        return re.sub(r'\$(\d+)', placeholder, self.template.replace('%', '%%'))
+
+
+Query = Union[str, sql.Composable, PreparedQuery]
+
+
+class PostgresClient:
+    """Пул соединений с PostgreSQL, живущий всё время работы демона.
+
+    Соединения создаются лениво и переиспользуются между циклами опроса. Перед выдачей соединения, простаивавшего
+    дольше health_check_period, выполняется проверка `SELECT 1`; сломанные соединения закрываются и не возвращаются
+    в пул, а ошибка пробрасывается наружу, чтобы retry повторил запрос уже на новом соединении. Ошибки самого
+    запроса (синтаксис, данные) не повторяются.
+    """
+
+    def __init__(self, dsn: str, min_connections: int = 1, max_connections: int = 4,
+                 health_check_period: float = 30.0):
+        self.dsn = dsn
+        self.min_connections = min_connections
+        self.max_connections = max_connections
+        self.health_check_period = health_check_period
+
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        # ThreadedConnectionPool не ждёт освобождения соединений, а бросает PoolError, поэтому ограничиваем число
+        # одновременно выданных соединений семафором.
+        self._slots = threading.BoundedSemaphore(max_connections)
+        self._prepared: Dict[int, Set[str]] = {}
+        self._last_used: Dict[int, float] = {}
+
+    def _get_pool(self) -> pool.ThreadedConnectionPool:
+        with self._pool_lock:
+            if self._pool is None:
+                logger.info("Opening PostgreSQL connection pool (max {} connections)", self.max_connections)
+                self._pool = pool.ThreadedConnectionPool(self.min_connections, self.max_connections, self.dsn)
+            return self._pool
+
+    def _is_healthy(self, connection) -> bool:
+        if connection.closed:
+            return False
+        idle_time = time.monotonic() - self._last_used.get(id(connection), 0)
+        if idle_time < self.health_check_period:
+            return True
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT 1')
+            connection.rollback()
+        except CONNECTION_ERRORS:
+            logger.warning("PostgreSQL connection failed health check, reconnecting.")
+            return False
+        return True
+
+    def _discard(self, connection) -> None:
+        self._prepared.pop(id(connection), None)
+        self._last_used.pop(id(connection), None)
+        try:
+            self._get_pool().putconn(connection, close=True)
+        except pool.PoolError:
+            pass
+
+    def _acquire(self):
+        connection_pool = self._get_pool()
+        while True:
+            connection = connection_pool.getconn()
+            if self._is_healthy(connection):
+                return connection
+            self._discard(connection)
+
+    @contextmanager
+    def connection(self):
+        """Выдаёт соединение из пула на время одной транзакции."""
+        self._slots.acquire()
+        try:
+            connection = self._acquire()
+            try:
+                with connection:
+                    yield connection
+            except CONNECTION_ERRORS:
+                self._discard(connection)
+                raise
+            except BaseException:
+                try:
+                    self._reset_prepared(connection)
+                except CONNECTION_ERRORS:
+                    self._discard(connection)
+                else:
+                    self._release(connection)
+                raise
+            else:
+                self._release(connection)
+        finally:
+            self._slots.release()
+
+    def _release(self, connection) -> None:
+        self._last_used[id(connection)] = time.monotonic()
+        self._get_pool().putconn(connection)
+
+    def _reset_prepared(self, connection) -> None:
+        """Сбрасывает подготовленные запросы соединения после ошибки, чтобы кэш не расходился с сервером."""
+        if id(connection) not in self._prepared:
+            return
+        with connection:
+            with connection.cursor() as cursor:
+                cursor.execute('DEALLOCATE ALL')
+        self._prepared.pop(id(connection), None)
+
+    def _ensure_prepared(self, connection, cursor, query: PreparedQuery) -> None:
+        prepared = self._prepared.setdefault(id(connection), set())
+        if query.name not in prepared:
+            logger.debug("Preparing statement {}", query.name)
+            cursor.execute(query.prepare_statement())
+            prepared.add(query.name)
+
+    def execute(self, cursor, query: Query, params: Dict[str, Any]) -> None:
+        """Выполняет запрос на курсоре, подготавливая его на соединении при первом использовании."""
+        if isinstance(query, PreparedQuery):
+            POSTGRES_QUERIES.labels(query.prefix).inc()
+            self._ensure_prepared(cursor.connection, cursor, query)
+            cursor.execute(query.execute_statement(), query.execute_args(params))
+        else:
+            POSTGRES_QUERIES.labels('sql').inc()
+            cursor.execute(query, params)
+
+    @retry('postgres', exceptions=CONNECTION_ERRORS)
+    def query(self, query: Query, params: Dict[str, Any]) -> List[dict]:
+        """Выполняет запрос и возвращает все строки результата в виде словарей."""
+        with self.connection() as connection:
+            with connection.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cursor:
+                self.execute(cursor, query, params)
+                return [dict(r) for r in cursor.fetchall()]
+
+    def stream(self, query: PreparedQuery, params: Dict[str, Any], batch_size: int,
+               itersize: int = 2000) -> Iterator[List[dict]]:
+        """Построчно читает результат запроса через серверный (именованный) курсор и отдаёт его батчами.
+
+        Курсор забирает строки с сервера порциями по itersize, поэтому память не зависит от размера результата.
+        Соединение занято, пока генератор не будет исчерпан или закрыт.
+        """
+        with self.connection() as connection:
+            cursor_name = f"{query.prefix}_{uuid.uuid4().hex[:8]}"
+            with connection.cursor(name=cursor_name, cursor_factory=psycopg2.extras.RealDictCursor) as cursor:
+                cursor.itersize = itersize
+                POSTGRES_QUERIES.labels(query.prefix).inc()
+                cursor.execute(query.pyformat_template(), params)
+                batch = []
+                for row in cursor:
+                    batch.append(dict(row))
+                    if len(batch) >= batch_size:
+                        yield batch
+                        batch = []
+                if batch:
+                    yield batch
+
+    def close(self) -> None:
+        with self._pool_lock:
+            if self._pool is not None:
+                self._pool.closeall()
+                self._pool = None
+            self._prepared.clear()
+            self._last_used.clear()
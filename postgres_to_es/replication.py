@@ -0,0 +1,239 @@
+import select
+import struct
+import time
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import psycopg2
+import psycopg2.errors
+import psycopg2.extras
+from loguru import logger
+
+from postgres_to_es.postgres import CONNECTION_ERRORS
+from postgres_to_es.state import State
+from postgres_to_es.retry import retry
+
+# Публикация из replication.sql, изменения таблиц которой читает демон.
+PUBLICATION_NAME = 'etl_publication'
+
+Changes = Dict[str, List[dict]]
+
+# Таблицы, сообщения об удалении из которых не передаются процессам. В сообщении только первичный ключ, а документ
+# удалённой записи удаляет журнал удалений (--tombstones); связи с ней удаляются каскадно и приходят отдельными
+# сообщениями связующих таблиц, которые заново денормализуют затронутые документы.
+SKIPPED_DELETES = {'public.film_work', 'public.person', 'public.genre'}
+
+
+@dataclass
+class Relation:
+    """Описание таблицы из сообщения Relation протокола pgoutput."""
+    table: str
+    columns: List[str] = field(default_factory=list)
+
+
+class PgOutputDecoder:
+    """Разбирает сообщения логической репликации в формате pgoutput (proto_version 1).
+
+    Значения колонок приходят в текстовом представлении PostgreSQL и отдаются строками, как их отдаёт сервер.
+    """
+
+    def __init__(self):
+        self.relations: Dict[int, Relation] = {}
+
+    @staticmethod
+    def _read_string(data: bytes, offset: int) -> Tuple[str, int]:
+        end = data.index(b'\0', offset)
+        return data[offset:end].decode(), end + 1
+
+    @staticmethod
+    def _read_tuple(data: bytes, offset: int, columns: List[str]) -> Tuple[dict, int]:
+        (column_count,) = struct.unpack_from('!h', data, offset)
+        offset += 2
+        row = {}
+        for column in columns[:column_count]:
+            kind = data[offset:offset + 1]
+            offset += 1
+            if kind == b't':
+                (length,) = struct.unpack_from('!i', data, offset)
+                offset += 4
+                row[column] = data[offset:offset + length].decode()
+                offset += length
+            elif kind == b'n':
+                row[column] = None
+            # b'u' — неизменённое TOAST значение, его нет в сообщении.
+        return row, offset
+
+    def _decode_relation(self, data: bytes) -> None:
+        (relation_id,) = struct.unpack_from('!I', data, 1)
+        namespace, offset = self._read_string(data, 5)
+        name, offset = self._read_string(data, offset)
+        offset += 1  # replica identity
+        (column_count,) = struct.unpack_from('!h', data, offset)
+        offset += 2
+        relation = Relation(table=f'{namespace}.{name}')
+        for _ in range(column_count):
+            offset += 1  # flags
+            column, offset = self._read_string(data, offset)
+            offset += 8  # type oid, typmod
+            relation.columns.append(column)
+        self.relations[relation_id] = relation
+
+    def decode(self, data: bytes) -> Optional[Tuple[str, str, dict]]:
+        """Возвращает (действие, таблица, строка) для Insert/Update/Delete и None для остальных сообщений.
+
+        Для Delete строка содержит колонки replica identity удалённой записи.
+        """
+        kind = data[:1]
+        if kind == b'R':
+            self._decode_relation(data)
+            return None
+        if kind not in (b'I', b'U', b'D'):
+            return None
+
+        (relation_id,) = struct.unpack_from('!I', data, 1)
+        relation = self.relations[relation_id]
+        offset = 5
+        tuple_kind = data[offset:offset + 1]
+        if kind == b'U' and tuple_kind in (b'K', b'O'):
+            # Пропускаем старую версию строки, нужна только новая.
+            _, offset = self._read_tuple(data, offset + 1, relation.columns)
+        row, _ = self._read_tuple(data, offset + 1, relation.columns)
+        return kind.decode(), relation.table, row
+
+
+class ReplicationSource:
+    """Источник изменений из слота логической репликации PostgreSQL.
+
+    Отдаёт изменения батчами строк, сгруппированных по таблицам, в том же виде, в каком их отдаёт
+    get_updated_postgres_entries. Позиция в WAL (LSN) последней полностью обработанной транзакции сохраняется в State
+    и подтверждается серверу только после commit, поэтому после перезапуска чтение продолжается без потерь.
+    """
+
+    def __init__(self, dsn: str, state: State, slot_name: str = 'etl_slot',
+                 publication: str = PUBLICATION_NAME, feedback_interval: float = 10.0):
+        self.dsn = dsn
+        self.state = state
+        self.slot_name = slot_name
+        self.publication = publication
+        self.feedback_interval = feedback_interval
+        self.decoder = PgOutputDecoder()
+
+        self._connection = None
+        self._cursor = None
+        self._last_feedback = 0.0
+        # Строки незавершённой транзакции, которые уже прочитаны из потока.
+        self._pending: Changes = {}
+
+    @property
+    def state_key(self) -> str:
+        return f'replication.{self.slot_name}.lsn'
+
+    @retry('postgres', exceptions=CONNECTION_ERRORS)
+    def connect(self) -> None:
+        """Подключается к слоту репликации, создавая его при первом запуске, и начинает чтение с сохраненного LSN."""
+        self._connection = psycopg2.connect(self.dsn, connection_factory=psycopg2.extras.LogicalReplicationConnection)
+        self._cursor = self._connection.cursor()
+        try:
+            self._cursor.create_replication_slot(self.slot_name, output_plugin='pgoutput')
+            logger.info("Created replication slot {}", self.slot_name)
+        except psycopg2.errors.DuplicateObject:
+            pass
+        start_lsn = self.state.state_get_key(self.state_key, '0/0')
+        self._cursor.start_replication(slot_name=self.slot_name, decode=False, start_lsn=start_lsn,
+                                       options={'proto_version': '1', 'publication_names': self.publication})
+        self.decoder = PgOutputDecoder()
+        self._pending = {}
+        logger.info("Started logical replication from slot {} at {}", self.slot_name, start_lsn)
+
+    def _send_feedback(self, flush_lsn: int = 0) -> None:
+        self._cursor.send_feedback(flush_lsn=flush_lsn, reply=True)
+        self._last_feedback = time.monotonic()
+
+    def read_batch(self, batch_size: int, timeout: float) -> Tuple[Changes, Optional[int]]:
+        """Читает изменения до batch_size строк или до таймаута.
+
+        Батч всегда заканчивается на границе транзакции.
+
+        :return: Изменённые строки по таблицам и LSN последней прочитанной транзакции (None, если транзакций не было).
+        """
+        if self._cursor is None:
+            self.connect()
+
+        changes: Changes = {}
+        row_count = 0
+        commit_lsn = None
+        deadline = time.monotonic() + timeout
+        try:
+            while True:
+                message = self._cursor.read_message()
+                if message is None:
+                    if time.monotonic() - self._last_feedback > self.feedback_interval:
+                        self._send_feedback()
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0 or (changes and not self._pending):
+                        break
+                    select.select([self._cursor], [], [], min(remaining, self.feedback_interval))
+                    continue
+
+                if message.payload[:1] == b'C':
+                    for table, rows in self._pending.items():
+                        changes.setdefault(table, []).extend(rows)
+                        row_count += len(rows)
+                    self._pending = {}
+                    # Commit: Int8 flags, Int64 LSN коммита, Int64 LSN конца транзакции.
+                    (commit_lsn,) = struct.unpack_from('!Q', message.payload, 10)
+                    if row_count >= batch_size:
+                        break
+                    continue
+
+                decoded = self.decoder.decode(message.payload)
+                if decoded:
+                    action, table, row = decoded
+                    if action == 'D' and table in SKIPPED_DELETES:
+                        continue
+                    self._pending.setdefault(table, []).append(row)
+        except CONNECTION_ERRORS:
+            logger.opt(exception=True).warning("Lost replication connection, reconnecting.")
+            # Незавершённая транзакция будет прочитана заново с сохраненного LSN.
+            self.close()
+
+        return changes, commit_lsn
+
+    @retry('postgres', exceptions=CONNECTION_ERRORS)
+    def commit(self, lsn: int) -> None:
+        """Сохраняет LSN обработанных изменений и подтверждает его серверу, позволяя освободить WAL."""
+        self.state.state_set_key(self.state_key, lsn_to_string(lsn))
+        if self._cursor is not None:
+            self._send_feedback(flush_lsn=lsn)
+        logger.debug("Committed replication position {}", lsn_to_string(lsn))
+
+    def close(self) -> None:
+        if self._connection is not None:
+            try:
+                self._connection.close()
+            except CONNECTION_ERRORS:
+                pass
+        self._connection = None
+        self._cursor = None
+
+
+def lsn_to_string(lsn: int) -> str:
+    """Переводит LSN в текстовый формат PostgreSQL (X/X)."""
+    return f'{lsn >> 32:X}/{lsn & 0xFFFFFFFF:X}'
+
+
+def run_replication(source: ReplicationSource, etl_processes: Sequence, batch_size: int, timeout: float) -> int:
+    """Читает один батч изменений из слота, передаёт строки процессам соответствующих таблиц и сохраняет LSN.
+
+    :return: Количество обработанных строк.
+    """
+    changes, lsn = source.read_batch(batch_size, timeout)
+    processed = 0
+    if changes:
+        logger.info("Received {} changed rows from replication slot",
+                    sum(len(rows) for rows in changes.values()))
+        for etl_process in etl_processes:
+            processed += etl_process.load(changes)
+    if lsn is not None:
+        source.commit(lsn)
+    return processed
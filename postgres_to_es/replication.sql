@@ -0,0 +1,17 @@
+-- Публикация для чтения изменений ETL демоном через логическую репликацию (--change-source replication).
+-- Требует wal_level=logical на сервере.
+DROP PUBLICATION IF EXISTS etl_publication;
+CREATE PUBLICATION etl_publication FOR TABLE film_work, person, genre, person_film_work, genre_film_work;
+
+-- Для связующих таблиц сообщения об удалении должны содержать film_work_id, а не только первичный ключ.
+ALTER TABLE person_film_work REPLICA IDENTITY FULL;
+ALTER TABLE genre_film_work REPLICA IDENTITY FULL;
+
+-- Журнал удалений из tombstone_triggers.sql, если он установлен.
+DO $$
+BEGIN
+    IF to_regclass('public.etl_tombstone') IS NOT NULL THEN
+        ALTER PUBLICATION etl_publication ADD TABLE public.etl_tombstone;
+    END IF;
+END;
+$$;
@@ -0,0 +1,288 @@
+"""Повторы вызовов внешних зависимостей и circuit breaker для каждой из них.
+
+У каждого вызова своё состояние повторов: пауза растёт экспоненциально с джиттером, начиная с минимальной, и
+ограничивается бюджетом попыток и времени. Ошибки вызовов одной зависимости (PostgreSQL, ElasticSearch, Redis)
+считает её CircuitBreaker: после нескольких ошибок подряд он открывается, и вызовы не отправляют запросы, а ждут
+пробного вызова. Как только пробный вызов проходит, breaker закрывается и все вызовы сразу продолжают работу.
+"""
+import asyncio
+import random
+import threading
+import time
+from dataclasses import dataclass
+from functools import wraps
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple, Type
+
+from loguru import logger
+
+from postgres_to_es.metrics import BREAKER_OPEN, RETRIES
+
+
+class CircuitOpenError(Exception):
+    """Зависимость недоступна: breaker открыт, и бюджет ожидания вызова исчерпан."""
+
+
+class CircuitBreaker:
+    """Состояние доступности одной зависимости.
+
+    closed — вызовы идут как обычно; open — после failure_threshold ошибок подряд вызовы ждут reset_timeout секунд;
+    half_open — один пробный вызов, от результата которого зависит, закроется breaker или снова откроется.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    # Как часто вызовы проверяют breaker, пока идёт пробный вызов.
+    PROBE_POLL_INTERVAL = 0.1
+
+    def __init__(self, name: str, failure_threshold: int = 3, reset_timeout: float = 5.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._lock = threading.Lock()
+
+    def wait_time(self) -> float:
+        """Сколько секунд вызов должен подождать перед запросом к зависимости; 0 — можно выполнять сейчас."""
+        with self._lock:
+            if self.state == self.CLOSED:
+                return 0.0
+            if self.state == self.HALF_OPEN:
+                return self.PROBE_POLL_INTERVAL
+            remaining = self._opened_at + self.reset_timeout - time.monotonic()
+            if remaining > 0:
+                return remaining
+            # Этот вызов становится пробным.
+            self.state = self.HALF_OPEN
+            return 0.0
+
+    def record_success(self) -> None:
+        with self._lock:
+            if self.state != self.CLOSED:
+                logger.info("{} is available again, closing circuit breaker.", self.name)
+            self.state = self.CLOSED
+            self._failures = 0
+
+    def release_probe(self) -> None:
+        """Пробный вызов прерван не ошибкой зависимости: следующий вызов снова станет пробным."""
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self.state = self.OPEN
+                self._opened_at = time.monotonic() - self.reset_timeout
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            if self.state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    logger.warning("{} is unavailable, opening circuit breaker for {} seconds.",
+                                   self.name, self.reset_timeout)
+                self.state = self.OPEN
+                self._opened_at = time.monotonic()
+
+
+BREAKERS: Dict[str, CircuitBreaker] = {
+    'postgres': CircuitBreaker('PostgreSQL'),
+    'elastic': CircuitBreaker('ElasticSearch'),
+    'redis': CircuitBreaker('Redis'),
+}
+for _dependency, _breaker in BREAKERS.items():
+    BREAKER_OPEN.labels(_dependency).set_function(lambda breaker=_breaker: breaker.state != CircuitBreaker.CLOSED)
+
+
+@dataclass(frozen=True)
+class RetryPolicy:
+    """Паузы между повторами одного вызова и бюджет повторов.
+
+    Пауза перед n-м повтором — start_sleep_time * factor^(n-1), но не больше border_sleep_time, умноженная на
+    случайный коэффициент от 1 - jitter до 1, чтобы вызовы из разных потоков не повторялись одновременно.
+
+    :param max_attempts: Максимальное количество неудачных попыток; None — без ограничения.
+    :param max_elapsed: Максимальное время вызова вместе с повторами и ожиданием breaker в секундах; None — без
+        ограничения.
+    """
+    start_sleep_time: float = 0.1
+    factor: float = 2
+    border_sleep_time: float = 10
+    jitter: float = 0.5
+    max_attempts: Optional[int] = None
+    max_elapsed: Optional[float] = None
+
+    def delay(self, attempt: int) -> float:
+        delay = min(self.start_sleep_time * self.factor ** (attempt - 1), self.border_sleep_time)
+        return delay * random.uniform(1 - self.jitter, 1)
+
+    def exhausted(self, attempts: int, elapsed: float) -> bool:
+        return ((self.max_attempts is not None and attempts >= self.max_attempts)
+                or (self.max_elapsed is not None and elapsed >= self.max_elapsed))
+
+
+# Политика по умолчанию для вызовов, которым политика не передана явно; задаётся при запуске демона.
+default_policy = RetryPolicy()
+
+
+def configure_retries(policy: RetryPolicy, failure_threshold: int, reset_timeout: float) -> None:
+    """Задаёт политику повторов по умолчанию и параметры всех breakers."""
+    global default_policy
+    default_policy = policy
+    for breaker in BREAKERS.values():
+        breaker.failure_threshold = failure_threshold
+        breaker.reset_timeout = reset_timeout
+
+
+class _Attempts:
+    """Состояние повторов одного вызова."""
+
+    def __init__(self, name: str, dependency: Optional[str], policy: Optional[RetryPolicy]):
+        self.name = name
+        self.dependency = dependency
+        self.breaker = BREAKERS.get(dependency)
+        self.policy = policy or default_policy
+        self.started = time.monotonic()
+        self.failures = 0
+        self.error: Optional[BaseException] = None
+
+    def before_call(self) -> float:
+        """Пауза перед следующей попыткой из-за открытого breaker; 0 — можно выполнять вызов."""
+        wait = self.breaker.wait_time() if self.breaker else 0.0
+        if wait:
+            self.error = self.error or CircuitOpenError(f"{self.breaker.name} is unavailable")
+            self._check_budget(wait)
+        return wait
+
+    def succeeded(self) -> None:
+        if self.breaker:
+            self.breaker.record_success()
+
+    def interrupted(self) -> None:
+        if self.breaker:
+            self.breaker.release_probe()
+
+    def failed(self, error: BaseException) -> float:
+        """Учитывает ошибку и возвращает паузу перед повтором или пробрасывает ошибку, если бюджет исчерпан."""
+        self.failures += 1
+        self.error = error
+        RETRIES.labels(self.name, self.dependency or '').inc()
+        if self.breaker:
+            self.breaker.record_failure()
+        logger.opt(exception=True).warning("Call {} failed, attempt {}.", self.name, self.failures)
+        wait = self.policy.delay(self.failures)
+        self._check_budget(wait)
+        return wait
+
+    def _check_budget(self, wait: float) -> None:
+        if self.policy.exhausted(self.failures, time.monotonic() - self.started + wait):
+            raise self.error
+
+
+def retry(breaker: Optional[str] = None, policy: Optional[RetryPolicy] = None,
+          exceptions: Tuple[Type[BaseException], ...] = (Exception,),
+          giveup: Optional[Callable[[BaseException], bool]] = None):
+    """Повторяет вызов функции после ошибки по policy, учитывая ошибки в breaker зависимости.
+
+    :param breaker: Имя зависимости из BREAKERS; None — без breaker.
+    :param policy: Политика повторов; None — политика по умолчанию.
+    :param exceptions: Ошибки недоступности зависимости, после которых вызов повторяется. Остальные ошибки
+        пробрасываются сразу и не учитываются в breaker.
+    :param giveup: Возвращает True для ошибки из exceptions, повтор которой ничего не изменит.
+    """
+
+    def func_wrapper(func):
+        @wraps(func)
+        def inner(*args, **kwargs):
+            attempts = _Attempts(func.__qualname__, breaker, policy)
+            while True:
+                wait = attempts.before_call()
+                if not wait:
+                    try:
+                        result = func(*args, **kwargs)
+                    except exceptions as error:
+                        if giveup is not None and giveup(error):
+                            attempts.interrupted()
+                            raise
+                        wait = attempts.failed(error)
+                    except BaseException:
+                        attempts.interrupted()
+                        raise
+                    else:
+                        attempts.succeeded()
+                        return result
+                time.sleep(wait)
+
+        return inner
+
+    return func_wrapper
+
+
+def async_retry(breaker: Optional[str] = None, policy: Optional[RetryPolicy] = None,
+                exceptions: Tuple[Type[BaseException], ...] = (Exception,),
+                giveup: Optional[Callable[[BaseException], bool]] = None):
+    """Аналог retry для асинхронных функций: ждёт повтора, не блокируя event loop."""
+
+    def func_wrapper(func):
+        @wraps(func)
+        async def inner(*args, **kwargs):
+            attempts = _Attempts(func.__qualname__, breaker, policy)
+            while True:
+                wait = attempts.before_call()
+                if not wait:
+                    try:
+                        result = await func(*args, **kwargs)
+                    except exceptions as error:
+                        if giveup is not None and giveup(error):
+                            attempts.interrupted()
+                            raise
+                        wait = attempts.failed(error)
+                    except BaseException:
+                        attempts.interrupted()
+                        raise
+                    else:
+                        attempts.succeeded()
+                        return result
+                await asyncio.sleep(wait)
+
+        return inner
+
+    return func_wrapper
+
+
+def retry_stream(name: str, read: Callable[[Optional[List[dict]]], Iterable[List[dict]]],
+                 breaker: Optional[str] = None, policy: Optional[RetryPolicy] = None,
+                 exceptions: Tuple[Type[BaseException], ...] = (Exception,)) -> Iterator[List[dict]]:
+    """Отдаёт батчи потока read, после ошибки чтения продолжая его с места остановки.
+
+    Повторяется только чтение: read(last_batch) начинает новый поток после последней строки last_batch (None — с
+    начала). Ошибки получателя батчей не перехватываются и не повторяются — генератор пробрасывает их вызывающему.
+
+    :param name: Имя вызова в логах и метриках повторов.
+    """
+    attempts = _Attempts(name, breaker, policy)
+    last_batch = None
+    while True:
+        wait = attempts.before_call()
+        if wait:
+            time.sleep(wait)
+            continue
+        batches = iter(read(last_batch))
+        try:
+            while True:
+                try:
+                    batch = next(batches)
+                except StopIteration:
+                    attempts.succeeded()
+                    return
+                except exceptions as error:
+                    wait = attempts.failed(error)
+                    break
+                except BaseException:
+                    attempts.interrupted()
+                    raise
+                yield batch
+                last_batch = batch
+        finally:
+            close = getattr(batches, 'close', None)
+            if close is not None:
+                close()
+        time.sleep(wait)
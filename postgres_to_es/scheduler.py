@@ -0,0 +1,207 @@
+"""Параллельный запуск producers, у каждого из которых своя частота опроса и приоритет.
+
+Каждый producer работает в своём потоке с общими для всех пулами соединений PostgreSQL и ElasticSearch. Producer,
+нашедший изменения, сразу запускается снова; producer без изменений ждёт всё дольше, от poll_period до
+max_poll_period. Уведомления ChangeListener будят producers изменившихся таблиц, не дожидаясь конца паузы.
+"""
+import heapq
+import itertools
+import threading
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional, Sequence
+
+from loguru import logger
+
+from postgres_to_es.notify import ChangeListener
+
+# Наибольшее количество соединений PostgreSQL, одновременно занятых одним producer: серверный курсор изменений
+# (--catch-up), серверный курсор связей и запрос денормализации. Пул должен вмещать столько соединений для каждого
+# одновременно работающего producer, иначе producers, занявшие часть соединений, ждут друг друга бесконечно.
+CONNECTIONS_PER_PRODUCER = 3
+
+
+def connections_per_producer(catch_up: bool) -> int:
+    """Наибольшее количество соединений PostgreSQL, одновременно занятых одним producer.
+
+    Без --catch-up изменения читаются обычным запросом, соединение которого освобождается до загрузки батча.
+    """
+    return CONNECTIONS_PER_PRODUCER if catch_up else CONNECTIONS_PER_PRODUCER - 1
+
+# Изменения фильмов — самый частый путь, связи фильмов — следующий; справочники с большим fan-out идут последними.
+DEFAULT_PRIORITIES: Dict[str, int] = {
+    'public.film_work': 2,
+    'public.person_film_work': 1,
+    'public.genre_film_work': 1,
+}
+
+
+@dataclass(frozen=True)
+class ProducerSchedule:
+    """Частота опроса и приоритет producer.
+
+    :param poll_period: Пауза после цикла без изменений; после каждого следующего пустого цикла она удваивается.
+    :param max_poll_period: Наибольшая пауза между опросами простаивающего producer.
+    :param priority: Если слотов для запуска меньше, чем producers, свободный слот первым получает producer с
+        большим приоритетом.
+    """
+    poll_period: float = 2
+    max_poll_period: float = 30
+    priority: int = 0
+
+    def idle_delay(self, idle_runs: int) -> float:
+        """Пауза перед опросом после idle_runs циклов подряд без изменений."""
+        return min(self.poll_period * 2 ** (idle_runs - 1), max(self.max_poll_period, self.poll_period))
+
+
+def parse_schedules(specs: Iterable[str], default: ProducerSchedule) -> Dict[str, ProducerSchedule]:
+    """Разбирает расписания таблиц вида schema.table=poll_period[:priority].
+
+    Таблицы без расписания получают default с приоритетом из DEFAULT_PRIORITIES.
+    """
+    schedules = {table: ProducerSchedule(default.poll_period, default.max_poll_period, priority)
+                 for table, priority in DEFAULT_PRIORITIES.items()}
+    for spec in specs:
+        table, _, value = spec.partition('=')
+        poll_period, _, priority = value.partition(':')
+        if not table or not poll_period:
+            raise ValueError(f"Invalid producer schedule {spec!r}, expected schema.table=poll_period[:priority]")
+        schedules[table] = ProducerSchedule(
+            float(poll_period), default.max_poll_period,
+            int(priority) if priority else DEFAULT_PRIORITIES.get(table, default.priority),
+        )
+    return schedules
+
+
+class PrioritySlots:
+    """Семафор, который при нехватке слотов отдаёт освободившийся слот ожидающему с наибольшим приоритетом.
+
+    Ожидающие с одинаковым приоритетом получают слоты в порядке очереди.
+    """
+
+    def __init__(self, count: int):
+        self._free = count
+        self._waiting = []
+        self._order = itertools.count()
+        self._condition = threading.Condition()
+
+    def acquire(self, priority: int) -> None:
+        with self._condition:
+            ticket = (-priority, next(self._order))
+            heapq.heappush(self._waiting, ticket)
+            while self._waiting[0] != ticket or not self._free:
+                self._condition.wait()
+            heapq.heappop(self._waiting)
+            self._free -= 1
+            # Следующий в очереди может получить ещё один свободный слот.
+            self._condition.notify_all()
+
+    def release(self) -> None:
+        with self._condition:
+            self._free += 1
+            self._condition.notify_all()
+
+
+class _Producer:
+    """Состояние одного producer в планировщике."""
+
+    def __init__(self, process, schedule: ProducerSchedule):
+        self.process = process
+        self.schedule = schedule
+        self.wakeup = threading.Event()
+        self.idle_runs = 0
+
+    @property
+    def name(self) -> str:
+        return ', '.join(sorted(self.process.tables))
+
+
+class ProducerScheduler:
+    """Запускает producers параллельно, каждый по своему расписанию.
+
+    Расписание producer, который обрабатывает несколько таблиц, берётся по самой частой и самой приоритетной из них.
+
+    :param etl_processes: Producers с методом run() и множеством tables.
+    :param schedules: Расписания по таблицам.
+    :param default_schedule: Расписание таблиц, которых нет в schedules.
+    :param listener: Источник уведомлений об изменениях таблиц.
+    :param fallback_poll_period: Если уведомлений нет столько секунд, все producers будятся страховочным опросом.
+    :param workers: Сколько producers могут работать одновременно; 0 — все. Если producers больше, ожидающий
+        producer с высоким приоритетом может не пропускать producers с низким приоритетом, пока находит изменения.
+    """
+
+    def __init__(self, etl_processes: Sequence, schedules: Dict[str, ProducerSchedule],
+                 default_schedule: ProducerSchedule = ProducerSchedule(),
+                 listener: Optional[ChangeListener] = None, fallback_poll_period: float = 60, workers: int = 0):
+        self.producers: List[_Producer] = [
+            _Producer(process, self.schedule_for(process, schedules, default_schedule)) for process in etl_processes
+        ]
+        self.listener = listener
+        self.fallback_poll_period = fallback_poll_period
+        self._slots = PrioritySlots(workers or len(self.producers))
+        self._stopped = threading.Event()
+
+    @staticmethod
+    def schedule_for(process, schedules: Dict[str, ProducerSchedule],
+                     default_schedule: ProducerSchedule) -> ProducerSchedule:
+        table_schedules = [schedules.get(table, default_schedule) for table in process.tables]
+        return ProducerSchedule(
+            poll_period=min(schedule.poll_period for schedule in table_schedules),
+            max_poll_period=min(schedule.max_poll_period for schedule in table_schedules),
+            priority=max(schedule.priority for schedule in table_schedules),
+        )
+
+    def _run_producer(self, producer: _Producer) -> None:
+        while not self._stopped.is_set():
+            self._slots.acquire(producer.schedule.priority)
+            try:
+                processed = producer.process.run()
+            except Exception:
+                # Бюджет повторов исчерпан; состояние не сдвинуто, producer повторит попытку после паузы.
+                logger.opt(exception=True).error("ETL process for tables {} failed.", producer.name)
+                processed = 0
+            finally:
+                self._slots.release()
+
+            if processed:
+                producer.idle_runs = 0
+                continue
+            producer.idle_runs += 1
+            delay = producer.schedule.idle_delay(producer.idle_runs)
+            logger.debug("No changes for tables {}, next poll in {} seconds", producer.name, delay)
+            if producer.wakeup.wait(delay):
+                producer.idle_runs = 0
+            producer.wakeup.clear()
+
+    def _dispatch_notifications(self) -> None:
+        """Будит producers таблиц, об изменении которых пришло уведомление."""
+        while not self._stopped.is_set():
+            changed_tables = self.listener.wait(self.fallback_poll_period)
+            logger.debug("Woken up by changes in tables: {}", changed_tables or 'all')
+            for producer in self.producers:
+                if changed_tables is None or producer.process.tables & changed_tables:
+                    producer.wakeup.set()
+
+    def run(self) -> None:
+        """Запускает потоки producers и работает до остановки."""
+        threads = [threading.Thread(target=self._run_producer, args=(producer,), name=f'producer-{i}', daemon=True)
+                   for i, producer in enumerate(self.producers)]
+        for producer in self.producers:
+            logger.info("Scheduling tables {}: poll period {}-{} seconds, priority {}", producer.name,
+                        producer.schedule.poll_period, producer.schedule.max_poll_period, producer.schedule.priority)
+        if self.listener:
+            # Подписываемся до первого прохода producers, чтобы не потерять изменения, сделанные во время него.
+            self.listener.connect()
+        for thread in threads:
+            thread.start()
+        try:
+            if self.listener:
+                self._dispatch_notifications()
+            for thread in threads:
+                thread.join()
+        finally:
+            self.stop()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        for producer in self.producers:
+            producer.wakeup.set()
@@ -1,9 +1,21 @@
 import dbm
-from typing import Protocol
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import Dict, Iterable, Optional, Protocol, Sequence, Tuple
 
 from redis import Redis
+from redis.exceptions import ConnectionError as RedisConnectionError, TimeoutError as RedisTimeoutError
 
-from postgres_to_es.utils import backoff
+from postgres_to_es.metrics import record_checkpoint
+from postgres_to_es.retry import retry
+from postgres_to_es.utils import datetime_to_iso_string
+
+# Ошибки недоступности Redis, после которых операция повторяется.
+REDIS_ERRORS = (RedisConnectionError, RedisTimeoutError)
 
 
 class State(Protocol):
@@ -14,6 +26,26 @@ class State(Protocol):
     def state_get_key(self, key, default: str = None) -> str:
         ...
 
+    def state_set_keys(self, values: Dict[str, str]) -> None:
+        """Записывает несколько значений одной операцией."""
+        ...
+
+    def state_get_keys(self, keys: Sequence[str]) -> Dict[str, Optional[str]]:
+        """Читает несколько значений одной операцией; отсутствующим ключам соответствует None."""
+        ...
+
+    def state_get_fields(self, name: str, fields: Sequence[str]) -> Dict[str, Optional[str]]:
+        """Читает поля словаря name одной операцией; отсутствующим полям соответствует None."""
+        ...
+
+    def state_set_fields(self, name: str, values: Dict[str, str]) -> None:
+        """Записывает поля словаря name одной операцией."""
+        ...
+
+    def state_delete_fields(self, name: str, fields: Sequence[str]) -> None:
+        """Удаляет поля словаря name одной операцией."""
+        ...
+
 
 class DBMState(State):
     def state_set_key(self, key, value: str) -> None:
@@ -30,22 +62,239 @@ class DBMState(State):
 
             return db[key].decode()
 
+    def state_set_keys(self, values: Dict[str, str]) -> None:
+        with dbm.open('state', 'c') as db:
+            for key, value in values.items():
+                db[key] = value.encode()
+
+    def state_get_keys(self, keys: Sequence[str]) -> Dict[str, Optional[str]]:
+        with dbm.open('state', 'c') as db:
+            return {key: db[key].decode() if key in db else None for key in keys}
+
+    def state_get_fields(self, name: str, fields: Sequence[str]) -> Dict[str, Optional[str]]:
+        values = self.state_get_keys([f'{name}.{field}' for field in fields])
+        return {field: values[f'{name}.{field}'] for field in fields}
+
+    def state_set_fields(self, name: str, values: Dict[str, str]) -> None:
+        self.state_set_keys({f'{name}.{field}': value for field, value in values.items()})
+
+    def state_delete_fields(self, name: str, fields: Sequence[str]) -> None:
+        with dbm.open('state', 'c') as db:
+            for field in fields:
+                if f'{name}.{field}' in db:
+                    del db[f'{name}.{field}']
+
 
 class RedisState:
-    def __init__(self, redis_adapter: Redis):
+    """Состояние в Redis с локальной копией последних прочитанных и записанных значений.
+
+    Демон — единственный писатель своих ключей, поэтому значение, которое уже есть в локальной копии, читается без
+    обращения к Redis. Запись сразу уходит в Redis: несколько значений пишутся одной атомарной командой MSET.
+    Локальная копия хранит не больше max_cached_keys значений и вытесняет давно не использованные.
+
+    Словари (state_*_fields) хранятся в hash Redis под ключом name и в локальную копию не попадают: их полей может
+    быть столько же, сколько документов в индексе.
+    """
+
+    def __init__(self, redis_adapter: Redis, max_cached_keys: int = 100_000):
         self.redis_adapter = redis_adapter
+        self.max_cached_keys = max_cached_keys
+        self._cache: 'OrderedDict[str, Optional[str]]' = OrderedDict()
+        self._lock = threading.Lock()
 
-    @backoff()
+    def _remember(self, values: Dict[str, Optional[str]]) -> None:
+        """Кладёт значения в локальную копию и вытесняет самые давно использованные. Вызывается под _lock."""
+        for key, value in values.items():
+            self._cache[key] = value
+            self._cache.move_to_end(key)
+        while len(self._cache) > self.max_cached_keys:
+            self._cache.popitem(last=False)
+
+    @retry('redis', exceptions=REDIS_ERRORS)
     def state_set_key(self, key, value: str) -> None:
         self.redis_adapter.set(key, value.encode())
+        with self._lock:
+            self._remember({key: value})
 
-    @backoff()
     def state_get_key(self, key, default: str = None) -> str:
-        data = self.redis_adapter.get(key)
-        if data:
-            data = data.decode()
-        else:
-            self.state_set_key(key, default)
-            data = default
-
-        return data
+        data = self.state_get_keys([key])[key]
+        return default if data is None else data
+
+    @retry('redis', exceptions=REDIS_ERRORS)
+    def state_set_keys(self, values: Dict[str, str]) -> None:
+        if not values:
+            return
+        self.redis_adapter.mset({key: value.encode() for key, value in values.items()})
+        with self._lock:
+            self._remember(values)
+
+    @retry('redis', exceptions=REDIS_ERRORS)
+    def state_get_keys(self, keys: Sequence[str]) -> Dict[str, Optional[str]]:
+        values = {}
+        missing = []
+        with self._lock:
+            for key in keys:
+                if key in self._cache:
+                    self._cache.move_to_end(key)
+                    values[key] = self._cache[key]
+                else:
+                    missing.append(key)
+        if missing:
+            values.update(self.preload(missing))
+        return {key: values[key] for key in keys}
+
+    def preload(self, keys: Iterable[str]) -> Dict[str, Optional[str]]:
+        """Читает ключи из Redis одной командой MGET в локальную копию и возвращает их значения."""
+        keys = list(keys)
+        if not keys:
+            return {}
+        values = {key: value.decode() if value is not None else None
+                  for key, value in zip(keys, self.redis_adapter.mget(keys))}
+        with self._lock:
+            self._remember(values)
+        return values
+
+    @retry('redis', exceptions=REDIS_ERRORS)
+    def state_get_fields(self, name: str, fields: Sequence[str]) -> Dict[str, Optional[str]]:
+        fields = list(fields)
+        if not fields:
+            return {}
+        return {field: value.decode() if value is not None else None
+                for field, value in zip(fields, self.redis_adapter.hmget(name, fields))}
+
+    @retry('redis', exceptions=REDIS_ERRORS)
+    def state_set_fields(self, name: str, values: Dict[str, str]) -> None:
+        if values:
+            self.redis_adapter.hset(name, mapping={field: value.encode() for field, value in values.items()})
+
+    @retry('redis', exceptions=REDIS_ERRORS)
+    def state_delete_fields(self, name: str, fields: Sequence[str]) -> None:
+        if fields:
+            self.redis_adapter.hdel(name, *fields)
+
+
+# Режимы надёжности SQLiteState: значение PRAGMA synchronous.
+SQLITE_DURABILITY = {
+    'full': 'FULL',
+    'normal': 'NORMAL',
+    'off': 'OFF',
+}
+
+
+class SQLiteState:
+    """Локальное состояние в SQLite в режиме WAL для запуска без Redis.
+
+    Соединение открывается один раз. Несколько ключей пишутся одной транзакцией.
+
+    :param durability: full — fsync WAL при каждом коммите, normal — fsync только при checkpoint WAL (коммит может
+        потеряться при сбое ОС, но не при падении демона), off — без fsync.
+    :param group_commit_interval: Если больше нуля, записи копятся в открытой транзакции и коммитятся не чаще раза в
+        столько секунд (group commit). При падении теряются записи за последний интервал, и демон повторно загрузит
+        соответствующие изменения.
+    """
+
+    def __init__(self, path: str = 'state.sqlite3', durability: str = 'full', group_commit_interval: float = 0.0):
+        self.group_commit_interval = group_commit_interval
+        self._connection = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute(f'PRAGMA synchronous={SQLITE_DURABILITY[durability]}')
+        self._connection.execute('CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT NOT NULL) '
+                                 'WITHOUT ROWID')
+        self._connection.execute('CREATE TABLE IF NOT EXISTS fields (name TEXT, field TEXT, value TEXT NOT NULL, '
+                                 'PRIMARY KEY (name, field)) WITHOUT ROWID')
+        self._lock = threading.Lock()
+        self._in_transaction = False
+        self._last_commit = time.monotonic()
+        self._closed = threading.Event()
+        if group_commit_interval > 0:
+            threading.Thread(target=self._commit_periodically, name='sqlite-state-commit', daemon=True).start()
+
+    def _commit_periodically(self) -> None:
+        """Коммитит накопленные записи, даже если новых записей больше не будет."""
+        while not self._closed.wait(self.group_commit_interval):
+            self.flush()
+
+    def _commit(self) -> None:
+        if self._in_transaction:
+            self._connection.execute('COMMIT')
+            self._in_transaction = False
+        self._last_commit = time.monotonic()
+
+    def state_set_key(self, key, value: str) -> None:
+        self.state_set_keys({key: value})
+
+    def state_get_key(self, key, default: str = None) -> str:
+        data = self.state_get_keys([key])[key]
+        return default if data is None else data
+
+    def _write(self, statement: str, rows: Iterable[Sequence[str]]) -> None:
+        """Выполняет statement для каждой строки rows в транзакции с учётом group commit."""
+        with self._lock:
+            if not self._in_transaction:
+                self._connection.execute('BEGIN')
+                self._in_transaction = True
+            self._connection.executemany(statement, rows)
+            if time.monotonic() - self._last_commit >= self.group_commit_interval:
+                self._commit()
+
+    def _read(self, query: str, params: Sequence[str], keys: Sequence[str]) -> Dict[str, Optional[str]]:
+        """Читает пары (ключ, значение) запросом query с условием IN по keys после параметров params."""
+        values = dict.fromkeys(keys)
+        keys = list(values)
+        with self._lock:
+            # Ограничение SQLite на количество параметров в запросе.
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+                values.update(self._connection.execute(query.format(",".join("?" * len(chunk))),
+                                                       [*params, *chunk]))
+        return values
+
+    def state_set_keys(self, values: Dict[str, str]) -> None:
+        self._write('INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)', values.items())
+
+    def state_get_keys(self, keys: Sequence[str]) -> Dict[str, Optional[str]]:
+        return self._read('SELECT key, value FROM state WHERE key IN ({})', (), keys)
+
+    def state_get_fields(self, name: str, fields: Sequence[str]) -> Dict[str, Optional[str]]:
+        return self._read('SELECT field, value FROM fields WHERE name = ? AND field IN ({})', (name,), fields)
+
+    def state_set_fields(self, name: str, values: Dict[str, str]) -> None:
+        self._write('INSERT OR REPLACE INTO fields (name, field, value) VALUES (?, ?, ?)',
+                    [(name, field, value) for field, value in values.items()])
+
+    def state_delete_fields(self, name: str, fields: Sequence[str]) -> None:
+        self._write('DELETE FROM fields WHERE name = ? AND field = ?', [(name, field) for field in fields])
+
+    def flush(self) -> None:
+        """Коммитит накопленные записи."""
+        with self._lock:
+            self._commit()
+
+    def close(self) -> None:
+        self._closed.set()
+        self.flush()
+        with self._lock:
+            self._connection.close()
+
+
+def checkpoint_keys(table: str, es_index: str) -> Tuple[str, str]:
+    """Ключи состояния producer: время и id последней обработанной записи."""
+    return f'{table}.{es_index}.updated_at', f'{table}.{es_index}.last_id'
+
+
+def get_checkpoint(state: State, table: str, es_index: str) -> Tuple[datetime, str]:
+    """Возвращает сохраненное состояние producer: время и id последней обработанной записи."""
+    updated_at_key, last_id_key = checkpoint_keys(table, es_index)
+    values = state.state_get_keys([updated_at_key, last_id_key])
+    updated_at = values[updated_at_key] or datetime_to_iso_string(datetime.fromtimestamp(0, tz=timezone.utc))
+    last_id = values[last_id_key] or str(uuid.UUID(int=0))
+    if values[updated_at_key]:
+        record_checkpoint(table, es_index, datetime.fromisoformat(updated_at))
+    return datetime.fromisoformat(updated_at), last_id
+
+
+def set_checkpoint(state: State, table: str, es_index: str, updated_at: str, last_id: str) -> None:
+    """Сохраняет состояние producer: время в ISO формате и id последней обработанной записи вместе, одной записью."""
+    updated_at_key, last_id_key = checkpoint_keys(table, es_index)
+    state.state_set_keys({updated_at_key: updated_at, last_id_key: last_id})
+    record_checkpoint(table, es_index, datetime.fromisoformat(updated_at))
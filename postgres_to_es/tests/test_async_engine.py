@@ -0,0 +1,82 @@
+import asyncio
+import json
+import uuid
+from types import SimpleNamespace
+
+import pytest
+from elasticsearch.serializer import JSONSerializer
+
+from postgres_to_es import elastic
+from postgres_to_es.async_engine import async_bulk_index, run_pipeline_forever
+from postgres_to_es.deadletter import DeadLetterFile
+from postgres_to_es.elastic import BulkSettings
+from postgres_to_es.retry import RetryPolicy
+
+
+class RejectingElastic:
+    """Первый раз отклоняет документы из rejected с заданным кодом, затем принимает всё."""
+
+    def __init__(self, rejected):
+        self.rejected = dict(rejected)
+        self.requests = 0
+        self.transport = SimpleNamespace(serializer=JSONSerializer())
+
+    async def bulk(self, body, *args, **kwargs):
+        self.requests += 1
+        lines = [json.loads(line) for line in body.splitlines() if line]
+        items = []
+        for action in lines[::2]:
+            meta = action['index']
+            status = self.rejected.pop(meta['_id'], 201)
+            result = {'_index': meta['_index'], '_id': meta['_id'], 'status': status}
+            if status >= 300:
+                result['error'] = {'type': 'rejected'}
+            items.append({'index': result})
+        return {'errors': any('error' in item['index'] for item in items), 'items': items}
+
+
+@pytest.fixture(autouse=True)
+def no_item_retry_sleep(monkeypatch):
+    monkeypatch.setattr(elastic, 'ITEM_RETRY_POLICY', RetryPolicy(start_sleep_time=0, max_attempts=5))
+
+
+def test_async_bulk_index_retries_rejected_and_dead_letters_invalid(tmp_path):
+    docs = [{'id': str(uuid.uuid4()), 'title': f'Film {i}'} for i in range(3)]
+    es = RejectingElastic({docs[0]['id']: 429, docs[1]['id']: 400})
+    dead_letters = DeadLetterFile(str(tmp_path / 'dead_letters.ndjson'), track_failed=True)
+
+    count = asyncio.run(async_bulk_index(es, 'movies', docs, BulkSettings(dead_letters=dead_letters)))
+
+    assert count == 2
+    assert es.requests == 2
+    assert dead_letters.take_failed('movies', [doc['id'] for doc in docs]) == {docs[1]['id']}
+
+
+class Pipeline:
+    def __init__(self, table: str, error: Exception = None):
+        self.process = type('Process', (), {'table': table})
+        self.error = error
+        self.runs = 0
+
+    async def run(self) -> int:
+        self.runs += 1
+        if self.error:
+            raise self.error
+        return 1 if self.runs < 5 else 0
+
+
+def test_failing_pipeline_does_not_block_others():
+    healthy = Pipeline('public.genre')
+    failing = Pipeline('public.film_work', RuntimeError('bulk failed'))
+
+    async def run():
+        loops = [asyncio.ensure_future(run_pipeline_forever(pipeline, poll_period=0.01))
+                 for pipeline in (failing, healthy)]
+        await asyncio.sleep(0.1)
+        for loop in loops:
+            loop.cancel()
+        await asyncio.gather(*loops, return_exceptions=True)
+
+    asyncio.run(run())
+    assert healthy.runs > 5
+    assert failing.runs > 1
@@ -0,0 +1,29 @@
+import uuid
+
+import pytest
+
+from postgres_to_es.fingerprint import FingerprintStore
+from postgres_to_es.state import SQLiteState
+
+
+@pytest.fixture
+def state(tmp_path):
+    state = SQLiteState(str(tmp_path / 'state.sqlite3'))
+    yield state
+    state.close()
+
+
+def test_unchanged_documents_are_skipped_and_forgotten_are_deleted(state):
+    store = FingerprintStore(state)
+    docs = [{'id': str(uuid.uuid4()), 'title': f'Film {i}'} for i in range(3)]
+
+    changed, fingerprints = store.changed('movies', docs)
+    assert changed == docs
+    store.save('movies', fingerprints)
+
+    assert store.changed('movies', docs)[0] == []
+
+    store.forget('movies', [docs[0]['id']])
+    assert store.changed('movies', docs)[0] == [docs[0]]
+    assert state.state_get_fields('fingerprint.movies', [docs[0]['id']]) == {docs[0]['id']: None}
+    assert state._connection.execute('SELECT count(*) FROM fields').fetchone() == (2,)
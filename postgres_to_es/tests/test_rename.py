@@ -0,0 +1,83 @@
+import threading
+import uuid
+
+from postgres_to_es.daemon import RenameETLProcessConfig, build_etl_processes
+from postgres_to_es.fingerprint import FingerprintStore
+from postgres_to_es.tests.test_replication_load import FakePostgres
+
+
+class FilmsPostgres(FakePostgres):
+    """Персона снималась в film_ids; сами фильмы денормализуются в пустой результат."""
+
+    def __init__(self, film_ids):
+        super().__init__()
+        self.film_ids = film_ids
+
+    def stream(self, query, params, batch_size, itersize):
+        self.queries.append(query.prefix)
+        return iter([[{'id': film_id} for film_id in self.film_ids]])
+
+
+class Indices:
+    def __init__(self):
+        self.refreshed = []
+
+    def refresh(self, index):
+        self.refreshed.append(index)
+
+
+class RenamingElastic:
+    def __init__(self, lock: threading.Lock, version_conflicts: int):
+        self.indices = Indices()
+        self.lock = lock
+        self.version_conflicts = version_conflicts
+        self.calls = []
+
+    def update_by_query(self, index, body, **kwargs):
+        assert self.lock.locked()
+        assert self.indices.refreshed == [index]
+        self.calls.append(kwargs)
+        return {'updated': 2, 'version_conflicts': self.version_conflicts}
+
+
+class DictState:
+    def __init__(self, fields=None):
+        self.fields = fields or {}
+
+    def state_delete_fields(self, name, fields):
+        for field in fields:
+            self.fields.get(name, {}).pop(field, None)
+
+
+def rename_process(postgres, elastic, fingerprints, lock) -> RenameETLProcessConfig:
+    processes = build_etl_processes(postgres, elastic, None, partial_renames=True, fingerprints=fingerprints,
+                                    index_locks={'movies': lock, 'persons': threading.Lock(),
+                                                 'genres': threading.Lock()})
+    return next(process for process in processes
+                if isinstance(process, RenameETLProcessConfig) and process.table == 'public.person')
+
+
+def test_rename_forgets_fingerprints_and_redenormalizes_conflicts():
+    film_ids = [str(uuid.uuid4()), str(uuid.uuid4())]
+    postgres = FilmsPostgres(film_ids)
+    lock = threading.Lock()
+    elastic = RenamingElastic(lock, version_conflicts=1)
+    state = DictState({'fingerprint.movies': {film_id: 'hash' for film_id in film_ids + ['other']}})
+
+    rename_process(postgres, elastic, FingerprintStore(state), lock).pipeline().send(
+        [{'id': uuid.uuid4(), 'full_name': 'New Name'}])
+
+    assert elastic.calls[0]['conflicts'] == 'proceed'
+    assert state.fields == {'fingerprint.movies': {'other': 'hash'}}
+    assert 'denormalize_films' in postgres.queries
+
+
+def test_rename_without_conflicts_does_not_redenormalize():
+    postgres = FilmsPostgres([str(uuid.uuid4())])
+    lock = threading.Lock()
+    elastic = RenamingElastic(lock, version_conflicts=0)
+
+    rename_process(postgres, elastic, FingerprintStore(DictState()), lock).pipeline().send(
+        [{'id': uuid.uuid4(), 'full_name': 'New Name'}])
+
+    assert 'denormalize_films' not in postgres.queries
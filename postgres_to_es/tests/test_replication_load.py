@@ -0,0 +1,56 @@
+import uuid
+
+from postgres_to_es.daemon import build_etl_processes, coalesce_etl_processes
+
+
+class FakePostgres:
+    """Удалённые записи: денормализующие запросы ничего не находят."""
+
+    def __init__(self):
+        self.queries = []
+
+    def query(self, query, params):
+        self.queries.append(query.prefix)
+        return []
+
+    def stream(self, query, params, batch_size, itersize):
+        self.queries.append(query.prefix)
+        return iter([])
+
+
+class FakeElastic:
+    """Любое обращение к ElasticSearch — ошибка: загружать нечего."""
+
+
+def delete_rows():
+    """Строки сообщений об удалении фильма и его связей (у связующих таблиц REPLICA IDENTITY FULL)."""
+    film_id = str(uuid.uuid4())
+    return {
+        'public.film_work': [{'id': film_id}],
+        'public.person_film_work': [{'id': str(uuid.uuid4()), 'film_work_id': film_id,
+                                     'person_id': str(uuid.uuid4()), 'role': 'actor', 'created_at': None}],
+        'public.genre_film_work': [{'id': str(uuid.uuid4()), 'film_work_id': film_id,
+                                    'genre_id': str(uuid.uuid4()), 'created_at': None}],
+    }
+
+
+def test_load_skips_deleted_documents():
+    postgres = FakePostgres()
+    processes = build_etl_processes(postgres, FakeElastic(), state=None)
+    changes = delete_rows()
+
+    loaded = sum(process.load(changes) for process in processes)
+
+    assert loaded == 3
+    assert 'denormalize_films' in postgres.queries
+
+
+def test_coalesced_load_skips_deleted_documents():
+    postgres = FakePostgres()
+    processes = coalesce_etl_processes(build_etl_processes(postgres, FakeElastic(), state=None))
+    changes = delete_rows()
+
+    loaded = sum(process.load(changes) for process in processes)
+
+    assert loaded == 3
+    assert 'denormalize_films' in postgres.queries
@@ -0,0 +1,60 @@
+import psycopg2
+import pytest
+from elasticsearch import NotFoundError, TransportError, helpers
+
+from postgres_to_es.elastic import ELASTIC_ERRORS, is_request_error
+from postgres_to_es.postgres import CONNECTION_ERRORS
+from postgres_to_es.retry import BREAKERS, CircuitBreaker, RetryPolicy, retry
+
+POLICY = RetryPolicy(start_sleep_time=0, max_attempts=3)
+
+
+def failing(error: BaseException, **options):
+    calls = []
+
+    @retry(policy=POLICY, **options)
+    def call():
+        calls.append(error)
+        raise error
+
+    return call, calls
+
+
+@pytest.mark.parametrize('error', [psycopg2.ProgrammingError('syntax error'), RuntimeError('bug')])
+def test_postgres_query_errors_are_not_retried(error):
+    call, calls = failing(error, exceptions=CONNECTION_ERRORS)
+    with pytest.raises(type(error)):
+        call()
+    assert len(calls) == 1
+
+
+@pytest.mark.parametrize('error', [NotFoundError(404, 'index_not_found_exception', {}),
+                                   helpers.BulkIndexError('1 document(s) failed to index.', [])])
+def test_elastic_request_errors_are_not_retried(error):
+    call, calls = failing(error, exceptions=ELASTIC_ERRORS, giveup=is_request_error)
+    with pytest.raises(type(error)):
+        call()
+    assert len(calls) == 1
+
+
+@pytest.mark.parametrize('error', [psycopg2.OperationalError('server closed the connection'),
+                                   TransportError(503, 'unavailable', {}), TransportError(429, 'rejected', {})])
+def test_unavailability_is_retried(error):
+    exceptions = CONNECTION_ERRORS if isinstance(error, psycopg2.Error) else ELASTIC_ERRORS
+    call, calls = failing(error, exceptions=exceptions, giveup=is_request_error)
+    with pytest.raises(type(error)):
+        call()
+    assert len(calls) == POLICY.max_attempts
+
+
+def test_request_error_does_not_open_breaker(monkeypatch):
+    breaker = CircuitBreaker('test', failure_threshold=1)
+    monkeypatch.setitem(BREAKERS, 'test', breaker)
+
+    @retry('test', POLICY, exceptions=ELASTIC_ERRORS, giveup=is_request_error)
+    def call():
+        raise NotFoundError(404, 'index_not_found_exception', {})
+
+    with pytest.raises(NotFoundError):
+        call()
+    assert breaker.state == CircuitBreaker.CLOSED
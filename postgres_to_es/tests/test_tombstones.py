@@ -0,0 +1,40 @@
+import threading
+import uuid
+
+from postgres_to_es import daemon
+from postgres_to_es.daemon import TombstoneETLProcess, build_etl_processes
+from postgres_to_es.tests.test_replication_load import FakeElastic, FakePostgres
+
+
+class TombstonePostgres(FakePostgres):
+    def query(self, query, params):
+        rows = super().query(query, params)
+        return [{'pruned': 0}] if query.prefix == 'prune_tombstones' else rows
+
+
+def tombstone(table_name: str, row_id: str, film_work_id: str = None) -> dict:
+    return {'table_name': table_name, 'row_id': row_id, 'film_work_id': film_work_id, 'person_id': None,
+            'genre_id': None, 'deleted_at': None}
+
+
+def test_link_tombstone_of_previously_deleted_film_is_skipped(monkeypatch):
+    postgres = TombstonePostgres()
+    locks = {index: threading.Lock() for index in ('movies', 'persons', 'genres')}
+    deleted = []
+
+    def bulk_delete(es, index, ids, settings, aliases=None):
+        assert locks[index].locked()
+        deleted.extend(ids)
+        return len(ids)
+
+    monkeypatch.setattr(daemon, 'bulk_delete', bulk_delete)
+    processes = build_etl_processes(postgres, FakeElastic(), state=None, index_locks=locks)
+    film_id, other_film_id = str(uuid.uuid4()), str(uuid.uuid4())
+
+    TombstoneETLProcess(postgres, None, processes).load({'public.etl_tombstone': [
+        tombstone('public.person_film_work', str(uuid.uuid4()), film_id),
+        tombstone('public.film_work', other_film_id),
+    ]})
+
+    assert 'denormalize_films' in postgres.queries
+    assert deleted == [other_film_id]
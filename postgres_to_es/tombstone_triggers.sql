@@ -0,0 +1,58 @@
+-- Журнал удалений для ETL демона (флаг --tombstones).
+-- Триггеры записывают в etl_tombstone удалённые строки фильмов, персон, жанров и связующих таблиц. Демон читает журнал
+-- как обычный producer по deleted_at: удаляет документы из индексов и заново денормализует затронутые фильмы.
+CREATE TABLE IF NOT EXISTS public.etl_tombstone (
+    id uuid PRIMARY KEY DEFAULT md5(random()::text || clock_timestamp()::text)::uuid,
+    table_name text NOT NULL,
+    row_id uuid NOT NULL,
+    film_work_id uuid,
+    person_id uuid,
+    genre_id uuid,
+    deleted_at timestamp with time zone NOT NULL DEFAULT now()
+);
+CREATE INDEX IF NOT EXISTS etl_tombstone_deleted_at_id_idx ON public.etl_tombstone (deleted_at, id);
+
+-- Удалённые строки приходят одной transition table на запрос; связи берутся из колонок, если они есть в таблице.
+CREATE OR REPLACE FUNCTION etl_record_tombstones() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO public.etl_tombstone (table_name, row_id, film_work_id, person_id, genre_id)
+    SELECT TG_TABLE_SCHEMA || '.' || TG_TABLE_NAME,
+           d.id,
+           (to_jsonb(d) ->> 'film_work_id')::uuid,
+           (to_jsonb(d) ->> 'person_id')::uuid,
+           (to_jsonb(d) ->> 'genre_id')::uuid
+    FROM deleted d;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS etl_record_tombstones ON film_work;
+CREATE TRIGGER etl_record_tombstones AFTER DELETE ON film_work
+    REFERENCING OLD TABLE AS deleted FOR EACH STATEMENT EXECUTE FUNCTION etl_record_tombstones();
+
+DROP TRIGGER IF EXISTS etl_record_tombstones ON person;
+CREATE TRIGGER etl_record_tombstones AFTER DELETE ON person
+    REFERENCING OLD TABLE AS deleted FOR EACH STATEMENT EXECUTE FUNCTION etl_record_tombstones();
+
+DROP TRIGGER IF EXISTS etl_record_tombstones ON genre;
+CREATE TRIGGER etl_record_tombstones AFTER DELETE ON genre
+    REFERENCING OLD TABLE AS deleted FOR EACH STATEMENT EXECUTE FUNCTION etl_record_tombstones();
+
+DROP TRIGGER IF EXISTS etl_record_tombstones ON person_film_work;
+CREATE TRIGGER etl_record_tombstones AFTER DELETE ON person_film_work
+    REFERENCING OLD TABLE AS deleted FOR EACH STATEMENT EXECUTE FUNCTION etl_record_tombstones();
+
+DROP TRIGGER IF EXISTS etl_record_tombstones ON genre_film_work;
+CREATE TRIGGER etl_record_tombstones AFTER DELETE ON genre_film_work
+    REFERENCING OLD TABLE AS deleted FOR EACH STATEMENT EXECUTE FUNCTION etl_record_tombstones();
+
+-- Если настроена логическая репликация (replication.sql), журнал читается из того же слота.
+DO $$
+BEGIN
+    IF EXISTS (SELECT 1 FROM pg_publication WHERE pubname = 'etl_publication')
+       AND NOT EXISTS (SELECT 1 FROM pg_publication_tables
+                       WHERE pubname = 'etl_publication' AND tablename = 'etl_tombstone') THEN
+        ALTER PUBLICATION etl_publication ADD TABLE public.etl_tombstone;
+    END IF;
+END;
+$$;
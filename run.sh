@@ -23,9 +23,25 @@ case $1 in
     docker-compose logs -f
   ;;
   load_es_index)
-    curl  -XPUT http://localhost:9200/movies -H 'Content-Type: application/json' -d @movies.es.schema.json
-    curl  -XPUT http://localhost:9200/persons -H 'Content-Type: application/json' -d @persons.es.schema.json
-    curl  -XPUT http://localhost:9200/genres -H 'Content-Type: application/json' -d @genres.es.schema.json
+    for index in movies persons genres; do
+      curl  -XPUT http://localhost:9200/${index}_v1 -H 'Content-Type: application/json' -d @${index}.es.schema.json
+      curl  -XPOST http://localhost:9200/_aliases -H 'Content-Type: application/json' -d "{\"actions\": [{\"add\": {\"index\": \"${index}_v1\", \"alias\": \"${index}\"}}]}"
+    done
+  ;;
+  install_triggers)
+    docker-compose exec -T postgres psql -U ${PG_USER} -d ${PG_DB} < postgres_to_es/notify_triggers.sql
+  ;;
+  install_tombstones)
+    docker-compose exec -T postgres psql -U ${PG_USER} -d ${PG_DB} < postgres_to_es/tombstone_triggers.sql
+  ;;
+  setup_replication)
+    docker-compose exec -T postgres psql -U ${PG_USER} -d ${PG_DB} < postgres_to_es/replication.sql
+  ;;
+  full_reindex)
+    docker-compose run --rm -v $(pwd):/schemas:ro etl sh -c 'python -m postgres_to_es.daemon --postgres-url postgresql://${PG_USER}:${PG_PASS}@${PG_HOST}/${PG_DB} --elastic-url ${ES_URL} --redis-host ${REDIS_HOST} --full-reindex --schemas-dir /schemas'
+  ;;
+  blue_green_reindex)
+    docker-compose run --rm -v $(pwd):/schemas:ro etl sh -c 'python -m postgres_to_es.daemon --postgres-url postgresql://${PG_USER}:${PG_PASS}@${PG_HOST}/${PG_DB} --elastic-url ${ES_URL} --redis-host ${REDIS_HOST} --blue-green-reindex --schemas-dir /schemas'
   ;;
   start_etl)
     docker-compose up etl